@@ -0,0 +1,111 @@
+"""Compression throughput benchmark
+
+Compresses a synthetic corpus (text-like, binary-like and random data) with each
+setting and reports throughput in MB/s and the compression ratio.
+
+    python benchmarks/bench_compression.py --size 256 --json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from compression import Compression
+
+MIB = 1024 * 1024
+
+WORDS = [b"backup", b"bucket", b"archive", b"restore", b"folder", b"config", b"server", b"error", b"request",
+         b"stream", b"value", b"2021-01-01", b"INFO", b"DEBUG", b"=", b"/var/log", b"{", b"}", b"\n"]
+
+
+def write_corpus(path, size):
+    # Thirds of text-like, structured binary and incompressible data
+    rng = random.Random(42)
+    third = size // 3
+    with open(path, "wb") as f:
+        written = 0
+        while written < third:
+            line = b" ".join(rng.choice(WORDS) for _ in range(12)) + b"\n"
+            f.write(line)
+            written += len(line)
+
+        written = 0
+        record = bytes(rng.getrandbits(8) for _ in range(64))
+        while written < third:
+            f.write(record[:48] + rng.getrandbits(128).to_bytes(16, "little"))
+            written += 64
+
+        f.write(os.urandom(size - 2 * third))
+
+
+def run(compression, corpus):
+    cat = subprocess.Popen(["cat", corpus], stdout=subprocess.PIPE)
+    zstd = compression.get_pipe(cat.stdout)
+    cat.stdout.close()
+
+    start = time.perf_counter()
+    compressed = 0
+    while True:
+        chunk = zstd.stdout.read(MIB)
+        if not chunk:
+            break
+        compressed += len(chunk)
+    zstd.wait()
+    cat.wait()
+    return time.perf_counter() - start, compressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=128, help="corpus size in MiB")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 3, 9, 19])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 0])
+    parser.add_argument("--long", type=int, nargs="*", default=[27])
+    parser.add_argument("--native", action="store_true", help="also benchmark python-zstandard")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    settings = []
+    for level in args.levels:
+        for threads in args.threads:
+            for long_window in [None] + args.long:
+                settings.append(Compression(level, threads, long_window))
+                if args.native:
+                    settings.append(Compression(level, threads, long_window, native=True))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = os.path.join(tmpdir, "corpus")
+        write_corpus(corpus, args.size * MIB)
+        size = os.path.getsize(corpus)
+
+        for compression in settings:
+            elapsed, compressed = run(compression, corpus)
+            result = {
+                "setting": str(compression),
+                "level": compression.level,
+                "threads": compression.threads,
+                "long": compression.long_window,
+                "native": compression.native,
+                "input_bytes": size,
+                "output_bytes": compressed,
+                "seconds": round(elapsed, 3),
+                "mb_per_s": round(size / MIB / elapsed, 1),
+                "ratio": round(size / compressed, 3),
+            }
+            results.append(result)
+            if not args.json:
+                print(f"{result['setting']:<40} {result['mb_per_s']:>8} MB/s  ratio {result['ratio']}", flush=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
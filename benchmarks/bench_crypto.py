@@ -0,0 +1,83 @@
+"""Encryption throughput benchmark
+
+Encrypts and decrypts random data with the openssl subprocess stages and the
+in-process AES-256-GCM stages and reports throughput in MB/s.
+
+    python benchmarks/bench_crypto.py --size 512 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backup import get_openssl_pipe_symmetric
+from crypto import generate_key, get_encrypt_pipe, get_decrypt_pipe
+from restore import get_openssl_pipe_symmetric_decrypt
+
+MIB = 1024 * 1024
+
+IMPLEMENTATIONS = {
+    "openssl": (get_openssl_pipe_symmetric, get_openssl_pipe_symmetric_decrypt),
+    "native": (get_encrypt_pipe, get_decrypt_pipe),
+}
+
+
+def run(get_pipe, key, path, output=None):
+    cat = subprocess.Popen(["cat", path], stdout=subprocess.PIPE)
+    stage = get_pipe(key, cat.stdout)
+    cat.stdout.close()
+
+    start = time.perf_counter()
+    with open(output or os.devnull, "wb") as f:
+        while True:
+            chunk = stage.stdout.read(MIB)
+            if not chunk:
+                break
+            f.write(chunk)
+    stage.wait()
+    cat.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="data size in MiB")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    results = []
+    key = generate_key()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        plain = os.path.join(tmpdir, "plain")
+        with open(plain, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(MIB))
+        size = os.path.getsize(plain)
+
+        for name, (encrypt, decrypt) in IMPLEMENTATIONS.items():
+            encrypted = os.path.join(tmpdir, f"encrypted-{name}")
+            for direction, get_pipe, source, output in [("encrypt", encrypt, plain, encrypted),
+                                                        ("decrypt", decrypt, encrypted, None)]:
+                elapsed = run(get_pipe, key, source, output)
+                result = {
+                    "implementation": name,
+                    "direction": direction,
+                    "bytes": size,
+                    "seconds": round(elapsed, 3),
+                    "mb_per_s": round(size / MIB / elapsed, 1),
+                }
+                results.append(result)
+                if not args.json:
+                    print(f"{name:<10} {direction:<8} {result['mb_per_s']:>8} MB/s", flush=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
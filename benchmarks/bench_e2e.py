@@ -0,0 +1,357 @@
+"""End-to-end backup and restore benchmark
+
+Builds synthetic trees (many small files, few large files, compressible and
+random data), backs each one up to a local S3 stand-in and restores it again.
+Reports throughput, CPU time, peak RSS and the objects written per run.
+
+    python benchmarks/bench_e2e.py --scale 256 --json --output results.json
+    python benchmarks/bench_e2e.py --baseline results.json --max-regression 10
+
+Without --endpoint-url a moto server is started on a free port, MinIO or any
+other S3 compatible endpoint works as well. With --baseline the exit code is 1
+if throughput dropped or peak RSS grew by more than --max-regression percent.
+With --seekable in --backup-args, hard links and a few single files are also
+restored alone with --path and compared to their source.
+
+--fault-injection (native engine) kills every backup once its checkpoint holds
+a finished part and resumes it, once with the source unchanged and once after
+touching every file so the interrupted upload cannot be reused. Both resumed
+backups are restored and compared with diff -r.
+"""
+import argparse
+import filecmp
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+PYAWSBACKUP = os.path.join(SRC, "pyawsbackup.py")
+
+MIB = 1024 * 1024
+
+WORDS = [b"backup", b"bucket", b"archive", b"restore", b"folder", b"config", b"server", b"error", b"request",
+         b"stream", b"value", b"2021-01-01", b"INFO", b"DEBUG", b"=", b"/var/log", b"{", b"}", b"\n"]
+
+
+def text(rng, size):
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(WORDS) for _ in range(12)) + b"\n"
+    return bytes(out[:size])
+
+
+def write_small_files(root, size, rng):
+    # 1-16 KiB text files, 100 per directory
+    written = 0
+    n = 0
+    while written < size:
+        directory = os.path.join(root, f"d{n // 100:04}")
+        os.makedirs(directory, exist_ok=True)
+        data = text(rng, rng.randint(1024, 16 * 1024))
+        with open(os.path.join(directory, f"f{n:06}.txt"), "wb") as f:
+            f.write(data)
+        written += len(data)
+        n += 1
+    # Restoring a hard link alone needs the data of its target
+    os.link(os.path.join(root, "d0000", "f000000.txt"), os.path.join(root, "d0000", "hardlink.txt"))
+
+
+def write_large_files(root, size, rng, compressible):
+    # Four files, random data comes from os.urandom so it stays incompressible
+    block = text(rng, MIB) if compressible else None
+    for i in range(4):
+        with open(os.path.join(root, f"large{i}.bin"), "wb") as f:
+            for _ in range(max(1, size // 4 // MIB)):
+                f.write(block if compressible else os.urandom(MIB))
+
+
+SCENARIOS = {
+    "small-files": lambda root, size, rng: write_small_files(root, size, rng),
+    "large-random": lambda root, size, rng: write_large_files(root, size, rng, False),
+    "large-compressible": lambda root, size, rng: write_large_files(root, size, rng, True),
+}
+
+
+def tree_stats(root):
+    files = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return files, size
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_moto():
+    moto = shutil.which("moto_server")
+    if not moto:
+        sys.exit("moto_server not found, install moto[server] or pass --endpoint-url")
+    port = free_port()
+    server = subprocess.Popen([moto, "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = f"http://127.0.0.1:{port}"
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server, endpoint
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("moto_server did not start")
+
+
+def run(cmd, env):
+    # Waits with wait4 for the resource usage of the run, it includes the tar, zstd and openssl children
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit(f"{' '.join(cmd)} failed:\n{stderr.decode('utf-8', 'replace')}")
+    return {
+        "seconds": round(elapsed, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        "peak_rss_mb": round(usage.ru_maxrss / (MIB if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def check_selective(source, target, scenario, bucket, restore_args, env):
+    # Every regular file restored with --path on its own, hard links included, matches its source
+    paths = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(source) for name in sorted(names)]
+    for path in [p for p in paths if os.stat(p).st_nlink > 1] + paths[:3]:
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target)
+        run([sys.executable, PYAWSBACKUP, "restore", "--no-progress", "--no-color", "--path", path] + restore_args +
+            [bucket, scenario, target], env)
+        if not filecmp.cmp(path, os.path.join(target, path.lstrip("/")), shallow=False):
+            sys.exit(f"selective restore of {path} differs from the source")
+    shutil.rmtree(target)
+
+
+def checkpoint_parts(env, bucket, jobname):
+    path = os.path.join(env["XDG_CACHE_HOME"], "pyawsbackup", "checkpoints", bucket, f"{jobname}.json")
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return 0
+    return sum(len(upload.get("parts", {})) for upload in state["uploads"].values())
+
+
+def interrupt(cmd, env, bucket, jobname):
+    # Kills the whole pipeline like a crash once a part is checkpointed, the following parts are still in flight.
+    # Returns False if the backup finished first.
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    while process.poll() is None and not checkpoint_parts(env, bucket, jobname):
+        time.sleep(0.02)
+    if process.poll() is not None:
+        return False
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    return True
+
+
+def check_resume(source, target, scenario, bucket, backup_cmd, restore_cmd, env, client):
+    # Returns False if the stream fits in a single part and cannot be interrupted
+    for change in (False, True):
+        if not interrupt(backup_cmd, env, bucket, scenario):
+            return False
+        if change:
+            # New mtimes change the first tar header, the checkpointed parts no longer match
+            for dirpath, _, names in os.walk(source):
+                for name in names:
+                    os.utime(os.path.join(dirpath, name), (time.time(), time.time() + 60))
+
+        resumed = subprocess.run(backup_cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = resumed.stdout.decode("utf-8", "replace")
+        expected = "discarding the checkpoint" if change else "Resuming interrupted backup"
+        if resumed.returncode != 0 or expected not in output:
+            sys.exit(f"resuming {scenario} {'after a change ' if change else ''}failed:\n{output}")
+
+        shutil.rmtree(target)
+        os.makedirs(target)
+        run(restore_cmd + [bucket, scenario, target], env)
+        subprocess.run(["diff", "-r", source, os.path.join(target, source.lstrip("/"))], check=True,
+                       stdout=subprocess.DEVNULL)
+
+    # The abandoned backup was deleted, every backup left has its file list
+    dates = dict()
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=scenario + "/"):
+        for obj in page.get("Contents", []):
+            date, name = obj["Key"].split("/")[1:3]
+            dates.setdefault(date, []).append(name)
+    incomplete = [date for date, names in dates.items() if not any(".list" in name for name in names)]
+    if incomplete:
+        sys.exit(f"incomplete backups of {scenario} left behind: {', '.join(incomplete)}")
+    return True
+
+
+def bucket_stats(client, bucket, prefix):
+    objects = 0
+    size = 0
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects += 1
+            size += obj["Size"]
+    return objects, size
+
+
+def compare(results, baseline, max_regression):
+    # Matches runs on scenario and operation, returns the regressions
+    previous = {(r["scenario"], r["operation"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get((r["scenario"], r["operation"]))
+        if not old:
+            continue
+        throughput = (r["mb_per_s"] - old["mb_per_s"]) / old["mb_per_s"] * 100
+        rss = (r["peak_rss_mb"] - old["peak_rss_mb"]) / old["peak_rss_mb"] * 100
+        print(f"{r['scenario']:<20} {r['operation']:<8} throughput {throughput:+6.1f}%  peak rss {rss:+6.1f}%",
+              file=sys.stderr)
+        if throughput < -max_regression:
+            regressions.append(f"{r['scenario']} {r['operation']} throughput {throughput:+.1f}%")
+        if rss > max_regression:
+            regressions.append(f"{r['scenario']} {r['operation']} peak rss {rss:+.1f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=128, help="data size of every scenario in MiB")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--endpoint-url", help="S3 endpoint to use instead of starting a moto server")
+    parser.add_argument("--engine", choices=["cli", "native"], default="native")
+    parser.add_argument("--backup-args", default="-c", help="extra backup options, e.g. \"-c -e --cert pub.pem\"")
+    parser.add_argument("--restore-args", default="", help="extra restore options, e.g. \"--key priv.pem\"")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--output", help="also write the json results to this file")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=10, help="allowed regression in percent")
+    parser.add_argument("--fault-injection", action="store_true", help="also interrupt and resume every backup")
+    args = parser.parse_args()
+    if args.fault_injection and args.engine != "native":
+        parser.error("--fault-injection requires --engine native, only native uploads are resumed")
+
+    import boto3
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    server = None
+    endpoint = args.endpoint_url
+    if not endpoint:
+        server, endpoint = start_moto()
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ)
+            # The aws cli honours AWS_ENDPOINT_URL since 2.13, the catalog and stat cache start out empty
+            env["AWS_ENDPOINT_URL"] = endpoint
+            env["XDG_CACHE_HOME"] = os.path.join(tmpdir, "cache")
+            engine_args = ["--engine", "native", "--endpoint-url", endpoint] if args.engine == "native" else []
+
+            client = boto3.client("s3", endpoint_url=endpoint)
+            bucket = f"pyawsbackup-bench-{int(time.time())}"
+            client.create_bucket(Bucket=bucket)
+
+            for scenario in args.scenarios:
+                source = os.path.join(tmpdir, "source", scenario)
+                target = os.path.join(tmpdir, "target", scenario)
+                os.makedirs(source)
+                os.makedirs(target)
+                SCENARIOS[scenario](source, args.scale * MIB, random.Random(42))
+                files, size = tree_stats(source)
+
+                backup = run([sys.executable, PYAWSBACKUP, "backup", "--no-progress", "--no-color", "--jobname",
+                              scenario] + engine_args + args.backup_args.split() + [source, bucket], env)
+                objects, stored = bucket_stats(client, bucket, scenario + "/")
+                restore = run([sys.executable, PYAWSBACKUP, "restore", "--no-progress", "--no-color"] + engine_args +
+                              args.restore_args.split() + [bucket, scenario, target], env)
+
+                # A fast restore that restores the wrong thing is worthless
+                subprocess.run(["diff", "-r", source, os.path.join(target, source.lstrip("/"))], check=True,
+                               stdout=subprocess.DEVNULL)
+                if "--seekable" in args.backup_args.split():
+                    check_selective(source, os.path.join(tmpdir, "selective", scenario), scenario, bucket,
+                                    engine_args + args.restore_args.split(), env)
+                if args.fault_injection:
+                    # Small parts so that even small scenarios are uploaded in several of them
+                    backup_cmd = [sys.executable, PYAWSBACKUP, "backup", "--no-progress", "--no-color", "--jobname",
+                                  scenario, "--part-size", "5"] + engine_args + args.backup_args.split() + \
+                                 [source, bucket]
+                    restore_cmd = [sys.executable, PYAWSBACKUP, "restore", "--no-progress", "--no-color"] + \
+                                  engine_args + args.restore_args.split()
+                    if not check_resume(source, target, scenario, bucket, backup_cmd, restore_cmd, env, client):
+                        print(f"{scenario:<20} resume   skipped, the archive fits in a single part", file=sys.stderr)
+
+                for operation, result in [("backup", backup), ("restore", restore)]:
+                    result.update({
+                        "scenario": scenario,
+                        "operation": operation,
+                        "files": files,
+                        "bytes": size,
+                        "mb_per_s": round(size / MIB / result["seconds"], 1),
+                        "objects": objects,
+                        "stored_bytes": stored,
+                    })
+                    results.append(result)
+                    if not args.json:
+                        print(f"{scenario:<20} {operation:<8} {result['mb_per_s']:>8} MB/s "
+                              f"{result['cpu_seconds']:>8} s cpu {result['peak_rss_mb']:>8} MB rss "
+                              f"{objects:>4} objects", flush=True)
+
+                shutil.rmtree(source)
+                shutil.rmtree(target)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "version": 1,
+        "timestamp": int(time.time()),
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL).stdout.decode("utf-8").strip() or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale_mb": args.scale,
+        "engine": args.engine,
+        "backup_args": args.backup_args,
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""CLI startup time benchmark
+
+Runs short pyawsbackup commands many times and reports their wall time next
+to a bare interpreter start. list and list-content are answered from a
+prepared local catalog, so no request reaches S3.
+
+    python benchmarks/bench_startup.py --runs 50 --json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+PYAWSBACKUP = os.path.join(SRC, "pyawsbackup.py")
+
+BUCKET = "bench-bucket"
+JOBS = 50
+DATES = 30
+
+
+def prepare_catalog():
+    # A freshly refreshed catalog, list is answered without listing the bucket
+    sys.path.insert(0, SRC)
+    from catalog import Catalog, catalog_path
+
+    catalog = Catalog(BUCKET, path=catalog_path())
+    for job in range(JOBS):
+        catalog.add_dates(f"job{job:03}", [f"2021-01-{day + 1:02}_03-00-00" for day in range(DATES)])
+    with catalog.db:
+        catalog.db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?)", (BUCKET, time.time() + 24 * 3600))
+    catalog.close()
+
+
+COMMANDS = {
+    "python": [sys.executable, "-c", "pass"],
+    "help": [sys.executable, PYAWSBACKUP, "--help"],
+    "backup-help": [sys.executable, PYAWSBACKUP, "backup", "--help"],
+    "list": [sys.executable, PYAWSBACKUP, "list", "--no-color", BUCKET],
+    "list-job": [sys.executable, PYAWSBACKUP, "list", "--no-color", "--jobname", "job000", BUCKET],
+}
+# These check for the aws cli before touching the catalog
+NEEDS_AWS = {"list", "list-job"}
+
+
+def measure(cmd, runs, env):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return {
+        "min_ms": round(min(times) * 1000, 1),
+        "median_ms": round(statistics.median(times) * 1000, 1),
+        "mean_ms": round(statistics.mean(times) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20, help="runs per command")
+    parser.add_argument("--commands", nargs="+", choices=list(COMMANDS), default=list(COMMANDS))
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--output", help="also write the json results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The catalog is prepared in and read from the same temporary cache
+        os.environ["XDG_CACHE_HOME"] = tmpdir
+        env = dict(os.environ)
+        prepare_catalog()
+
+        for name in args.commands:
+            if name in NEEDS_AWS and not shutil.which("aws"):
+                print(f"{name:<12} skipped, the aws cli is not in PATH", file=sys.stderr)
+                continue
+            # The first run warms the page cache and the bytecode cache
+            measure(COMMANDS[name], 1, env)
+            result = measure(COMMANDS[name], args.runs, env)
+            result["command"] = name
+            results.append(result)
+            if not args.json:
+                print(f"{name:<12} {result['median_ms']:>8} ms median {result['min_ms']:>8} ms min", flush=True)
+
+    report = {
+        "version": 1,
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
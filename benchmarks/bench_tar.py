@@ -0,0 +1,117 @@
+"""Archive producer benchmark
+
+Builds a tree of many small files and times how fast tar and the in-process
+parallel producer (backup --read-concurrency) turn it into an archive stream.
+The stream is discarded, so only walking, stat, open and read are measured.
+
+    python benchmarks/bench_tar.py --files 100000 --workers 1 4 16 --json
+    python benchmarks/bench_tar.py --source /mnt/nfs/tree --drop-caches
+
+Warm page caches hide the per-file latency the parallel producer is meant for,
+--drop-caches (root, Linux) drops them before every run.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from backup import get_tar_pipe  # noqa: E402
+from tarstream import READ_SIZE  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def write_tree(root, files, rng):
+    # 1-16 KiB files, 100 per directory and 20 directories per parent
+    for n in range(files):
+        directory = os.path.join(root, f"p{n // 2000:03}", f"d{n // 100:05}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"f{n:07}"), "wb") as f:
+            f.write(rng.randbytes(rng.randint(1024, 16 * 1024)))
+
+
+def drop_caches():
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def measure(source, workers):
+    start = time.perf_counter()
+    stage = get_tar_pipe(source, None, workers)
+    size = 0
+    while True:
+        data = stage.stdout.read(READ_SIZE)
+        if not data:
+            break
+        size += len(data)
+    stage.stdout.close()
+    code = stage.wait()
+    if code not in (0, 1):
+        sys.exit(f"{stage.args[0]} exited with code {code}")
+    elapsed = time.perf_counter() - start
+    return {
+        "workers": workers,
+        "producer": "tar" if workers == 1 else "partar",
+        "seconds": round(elapsed, 3),
+        "bytes": size,
+        "mb_per_s": round(size / MIB / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000, help="files in the generated tree")
+    parser.add_argument("--source", help="existing tree to archive instead of a generated one")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="1 runs tar")
+    parser.add_argument("--runs", type=int, default=3, help="runs per worker count, the fastest counts")
+    parser.add_argument("--drop-caches", action="store_true", help="drop the page cache before every run")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--output", help="also write the json results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = args.source
+        if not source:
+            source = os.path.join(tmpdir, "tree")
+            write_tree(source, args.files, random.Random(42))
+        source = os.path.abspath(source)
+
+        for workers in args.workers:
+            runs = []
+            for _ in range(args.runs):
+                if args.drop_caches:
+                    drop_caches()
+                runs.append(measure(source, workers))
+            result = min(runs, key=lambda r: r["seconds"])
+            results.append(result)
+            if not args.json:
+                print(f"{result['producer']:<8} {workers:>3} workers {result['seconds']:>8} s "
+                      f"{result['mb_per_s']:>8} MB/s", flush=True)
+
+    report = {
+        "version": 1,
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "files": None if args.source else args.files,
+        "drop_caches": args.drop_caches,
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,9 @@ setuptools.setup(
     packages=setuptools.find_packages(where="src"),
     python_requires=">=3.6",
     install_requires=["Click", "clint"],
+    extras_require={
+        "native": ["boto3", "zstandard", "cryptography", "numpy"],
+    },
     entry_points={
         "console_scripts": [
             "pyawsbackup = pyawsbackup:cli"
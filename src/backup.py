@@ -3,9 +3,23 @@ import click
 import os
 import json
 import sys
+import tempfile
 from datetime import datetime
 from clint.textui import colored, indent
-from utils import check_folder_exists, color_macro, s3_url
+from utils import check_folder_exists, color_macro, get_pv_pipe, s3_url
+from mtree import parse_mtree, diff_mtree, write_mtree, get_manifest_pipe
+from seekable import SeekableCompression, Uncompressed
+from crypto import GCM_CIPHER, SALT_SIZE, decrypt_asymmetric, encrypt_asymmetric, generate_key, get_encrypt_pipe, \
+    native_crypto_available
+from restore import fetch_meta, iter_pipeline, open_list, wait_pipeline
+from catalog import Catalog, list_objects
+from throttle import get_throttle_pipe
+from metrics import link, wait_stage
+from checkpoint import Checkpoint, ResumeError
+from volumes import get_volume_pipe, volume_name, volume_salt
+from statcache import StatCache, stat_cache_path
+from partar import get_partar_pipe
+from prune import delete_objects
 
 
 def get_s3_pipe(s3_url, storage_class, input):
@@ -22,27 +36,33 @@ def get_s3_pipe(s3_url, storage_class, input):
     return aws
 
 
-def get_pv_pipe(input):
-    pv = subprocess.Popen(
-        ["pv", "-f"],
-        stdin=input if input else subprocess.PIPE,
-        stdout=subprocess.PIPE
-    )
-    return pv
-
-
-def get_openssl_pipe_symmetric(key, input):
+def get_openssl_pipe_symmetric(key, input, salt=None):
+    # A fixed salt makes the output reproducible, resumed uploads rely on it
+    salt_args = ["-S", salt] if salt else ["-salt"]
     if sys.platform == "linux":
-        cmd = ["openssl", "enc", "-aes-256-ctr", "-salt", "-pass", f"pass:{key}", "-pbkdf2"]
+        cmd = ["openssl", "enc", "-aes-256-ctr"] + salt_args + ["-pass", f"pass:{key}", "-pbkdf2"]
     elif sys.platform == "darwin":
         # macos ships with LibreSSL which doesnt support -pbkdf2 for whatever reason
-        cmd = ["openssl", "enc", "-aes-256-ctr", "-salt", "-pass", f"pass:{key}"]
-
+        cmd = ["openssl", "enc", "-aes-256-ctr"] + salt_args + ["-pass", f"pass:{key}"]
+
+    if not salt:
+        openssl = subprocess.Popen(
+            cmd,
+            stdin=input if input else subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        return openssl
+
+    # openssl only writes the salt header for random salts, write it first so restores cannot tell the difference
+    r, w = os.pipe()
+    os.write(w, b"Salted__" + bytes.fromhex(salt))
     openssl = subprocess.Popen(
         cmd,
         stdin=input if input else subprocess.PIPE,
-        stdout=subprocess.PIPE
+        stdout=w
     )
+    os.close(w)
+    openssl.stdout = os.fdopen(r, "rb")
     return openssl
 
 
@@ -55,14 +75,39 @@ def get_openssl_pipe_asymmetric(cert):
     return openssl
 
 
-def get_tar_pipe(folder, compress):
+def wrap_keys(cert, tarkey, listkey):
+    # Checkpoints only keep the symmetric keys encrypted with the cert, like the metafile does
+    data = json.dumps({"tarkey": tarkey, "listkey": listkey}).encode("utf-8")
+    if native_crypto_available():
+        return encrypt_asymmetric(cert, data).hex()
+    return subprocess.run(["openssl", "rsautl", "-encrypt", "-pubin", "-inkey", cert], input=data,
+                          stdout=subprocess.PIPE, check=True).stdout.hex()
+
+
+def unwrap_keys(key, wrapped):
+    data = bytes.fromhex(wrapped)
+    if native_crypto_available():
+        data = decrypt_asymmetric(key, data)
+    else:
+        data = subprocess.run(["openssl", "rsautl", "-decrypt", "-inkey", key], input=data, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout
+    keys = json.loads(data.decode("utf-8"))
+    return keys["tarkey"], keys["listkey"]
+
+
+def get_tar_pipe(folder, filelist=None, workers=1):
+    if workers > 1:
+        # Stats and reads files with a pool of workers, for trees limited by per-file latency
+        return get_partar_pipe(folder, filelist, workers)
+
     tar_name = "gtar" if sys.platform == "darwin" else "tar"
-    if compress:
-        #if sys.platform == "darwin":
-        #    raise RuntimeError("Compression with zstd not supported on macos with BSD tar")
-        backup_cmd = [tar_name, "-I", "zstd", "--warning=no-file-changed", "-C", "/", "-cf", "-", folder]
+    if filelist:
+        # Only archive the NUL separated paths in filelist, directories are not descended into
+        source = ["--null", "--no-recursion", "--verbatim-files-from", "-T", filelist]
     else:
-        backup_cmd = [tar_name, "--warning=no-file-changed", "-C", "/", "-cf", "-", folder]
+        source = [folder]
+
+    backup_cmd = [tar_name, "--warning=no-file-changed", "-C", "/", "-cf", "-"] + source
 
     backup_tar = subprocess.Popen(
         backup_cmd,
@@ -71,29 +116,45 @@ def get_tar_pipe(folder, compress):
     return backup_tar
 
 
-def build_upload_pipeline_symmetric(input, dry_run, progress, encrypt, key, storage_class, bucket, destfile):
+def build_upload_pipeline_symmetric(input, dry_run, progress, encrypt, key, storage_class, bucket, destfile, engine=None,
+                                    compression=None, cipher=None, throttle=None, metrics=None, salt=None,
+                                    checkpoint=None, hold=False):
     # Build subprocess chain
     pipe = [input]
 
-    if encrypt:
-        openssl = get_openssl_pipe_symmetric(key, pipe[-1].stdout)
+    if compression:
+        zstd = compression.get_pipe(link(pipe, metrics))
+        pipe.append(zstd)
+
+    if encrypt and cipher == GCM_CIPHER:
+        aes = get_encrypt_pipe(key, link(pipe, metrics), bytes.fromhex(salt) if salt else None)
+        pipe.append(aes)
+    elif encrypt:
+        openssl = get_openssl_pipe_symmetric(key, link(pipe, metrics), salt)
         pipe.append(openssl)
 
     if progress:
-        pv = get_pv_pipe(pipe[-1].stdout)
+        pv = get_pv_pipe(link(pipe, metrics))
         pipe.append(pv)
 
+    if throttle:
+        limit = get_throttle_pipe(throttle, link(pipe, metrics))
+        pipe.append(limit)
+
     if dry_run:
         # TODO use dd
         pass
+    elif engine:
+        upload = engine.get_pipe(bucket, destfile, storage_class, link(pipe, metrics), checkpoint, hold)
+        pipe.append(upload)
     else:
-        aws = get_s3_pipe(s3_url(bucket, destfile), storage_class, pipe[-1].stdout)
+        aws = get_s3_pipe(s3_url(bucket, destfile), storage_class, link(pipe, metrics))
         pipe.append(aws)
 
     return pipe
 
 
-def build_upload_pipeline_asymmetric(dry_run, progress, encrypt, cert, storage_class, bucket, destfile):
+def build_upload_pipeline_asymmetric(dry_run, progress, encrypt, cert, storage_class, bucket, destfile, engine=None):
     # Build subprocess pipeline chain
     pipe = []
     if encrypt:
@@ -107,6 +168,9 @@ def build_upload_pipeline_asymmetric(dry_run, progress, encrypt, cert, storage_c
     if dry_run:
         # TODO use dd
         pass
+    elif engine:
+        upload = engine.get_pipe(bucket, destfile, storage_class, pipe[-1].stdout if len(pipe) > 0 else None)
+        pipe.append(upload)
     else:
         aws = get_s3_pipe(s3_url(bucket, destfile), storage_class, pipe[-1].stdout if len(pipe) > 0 else None)
         pipe.append(aws)
@@ -114,8 +178,159 @@ def build_upload_pipeline_asymmetric(dry_run, progress, encrypt, cert, storage_c
     return pipe
 
 
+def get_cat_pipe(path):
+    cat = subprocess.Popen(
+        ["cat", path],
+        stdout=subprocess.PIPE
+    )
+    return cat
+
+
+def upload_file(path, dry_run, encrypt, key, bucket, destfile, engine, cipher):
+    pipeline = build_upload_pipeline_symmetric(get_cat_pipe(path), dry_run, False, encrypt, key, None, bucket, destfile,
+                                               engine, cipher=cipher)
+    wait_pipeline(pipeline)
+
+
+def wait_upload_pipeline(pipe, metrics=None):
+    # The upload is only completed once every stage in front of it exited cleanly, a truncated stream
+    # must not end up as a backup that looks complete
+    for i in range(1, len(pipe)):
+        pipe[i - 1].stdout.close()
+
+    errors = []
+    resume_error = None
+    for stage in pipe[:-1]:
+        try:
+            code = wait_stage(stage, metrics)
+        except ResumeError as e:
+            resume_error = e
+            continue
+        except RuntimeError as e:
+            errors.append(str(e))
+            continue
+        # tar exits with 1 if files changed while they were read, the archive is still consistent
+        if code != 0 and not (os.path.basename(stage.args[0]) in ("tar", "gtar", "partar") and code == 1):
+            errors.append(f"{stage.args[0]} exited with code {code}")
+
+    upload = pipe[-1]
+    if hasattr(upload, "release"):
+        upload.release(not errors)
+    try:
+        if wait_stage(upload, metrics) != 0:
+            errors.append(f"{upload.args[0]} exited with code {upload.returncode}")
+    except ResumeError as e:
+        resume_error = e
+    except RuntimeError as e:
+        errors.append(str(e))
+
+    # Stages in front of an upload that refused to resume fail with broken pipes, the caller starts over
+    if resume_error:
+        raise resume_error
+    # Later stages usually only fail as a consequence of the first failure
+    if errors:
+        raise RuntimeError(errors[0])
+
+
+def write_path_list(path, entries):
+    # NUL separated so that any byte except NUL may appear in a path
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.write(os.fsencode(entry) + b"\0")
+
+
+def find_base(bucket, jobname, key, engine, date=None):
+    # Returns (date, file list) of the given or else the most recent backup of the job, or None. The catalog
+    # lists through the engine, so native backups do not need the aws cli.
+    catalog = Catalog(bucket, engine)
+    try:
+        if not date:
+            # Another host may have backed up the job since the last refresh, only newer dates are listed
+            catalog.refresh_job(jobname)
+            date = catalog.latest(jobname, refresh=False)
+            if not date:
+                return None
+        backup_content = catalog.files(jobname, date)
+    except Exception as e:
+        raise RuntimeError(f"Could not list backups of {bucket}/{jobname}: {e}")
+    finally:
+        catalog.close()
+
+    meta = fetch_meta(bucket, jobname, date, key, backup_content, engine)
+    pipe = open_list(bucket, jobname, date, "list", meta, backup_content, engine)
+    if pipe is None:
+        return None
+
+    return date, parse_mtree(iter_pipeline(pipe))
+
+
+def build_upload_pipeline_chunked(input, progress, chunk_store, manifest, throttle=None, metrics=None):
+    # Build subprocess chain
+    pipe = [input]
+
+    if progress:
+        pv = get_pv_pipe(link(pipe, metrics))
+        pipe.append(pv)
+
+    if throttle:
+        # Limits the stream before deduplication, chunks that already exist are never uploaded
+        limit = get_throttle_pipe(throttle, link(pipe, metrics))
+        pipe.append(limit)
+
+    writer = chunk_store.get_pipe(manifest, link(pipe, metrics))
+    pipe.append(writer)
+
+    return pipe
+
+
+def build_upload_pipeline_volumes(input, progress, volume_size, concurrency, open_volume, wait_volume, metrics=None):
+    # Build subprocess chain, every volume gets its own compression, encryption and upload pipeline
+    pipe = [input]
+
+    if progress:
+        pv = get_pv_pipe(link(pipe, metrics))
+        pipe.append(pv)
+
+    writer = get_volume_pipe(volume_size, concurrency, open_volume, wait_volume, link(pipe, metrics))
+    pipe.append(writer)
+
+    return pipe
+
+
+def abandon(checkpoint, bucket, jobname, engine):
+    checkpoint.discard(engine.client)
+    # Objects the abandoned backup already completed must not look like a backup of their own
+    keys = list(list_objects(bucket, os.path.join(jobname, checkpoint.state["date"]) + "/", engine))
+    if keys:
+        delete_objects(bucket, keys, engine)
+
+
+def do_backup(compression, encrypt, cert, storage_class, jobname, progress, color, dry_run, incremental, key, engine,
+              chunk_store, seekable, cipher, throttle, read_throttle, metrics, resume, volume_size, volume_concurrency,
+              stat_cache, read_concurrency, folder, bucket):
+    def run(resume):
+        run_backup(compression, encrypt, cert, storage_class, jobname, progress, color, dry_run, incremental, key, engine,
+                   chunk_store, seekable, cipher, throttle, read_throttle, metrics, resume, volume_size,
+                   volume_concurrency, stat_cache, read_concurrency, folder, bucket)
+
+    try:
+        run(resume)
+    except ResumeError as e:
+        # The source changed since the interrupted run, none of its parts can be reused
+        yellow = color_macro(color, colored.yellow)
+        print()
+        print(f"{yellow('Warning')}: {e}, discarding the checkpoint and starting a new backup", flush=True)
+        name = jobname or os.path.basename(os.path.normpath(folder))
+        checkpoint = Checkpoint.load(bucket, name)
+        if checkpoint:
+            abandon(checkpoint, bucket, name, engine)
+        run(False)
+
+
 # Encryption logic heavily inspired and partly adopted by https://github.com/leanderseidlitz/aws-backup/blob/master/awsbackup.sh
-def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color, dry_run, folder, bucket):
+def run_backup(compression, encrypt, cert, storage_class, jobname, progress, color, dry_run, incremental, key, engine,
+               chunk_store, seekable, cipher, throttle, read_throttle, metrics, resume, volume_size, volume_concurrency,
+               stat_cache, read_concurrency, folder, bucket):
     # Colors
     yellow = color_macro(color, colored.yellow)
     cyan = color_macro(color, colored.cyan)
@@ -126,7 +341,7 @@ def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color,
     if not jobname:
         jobname = os.path.basename(os.path.normpath(folder))
 
-    #if compress and sys.platform == "darwin":
+    #if compression and sys.platform == "darwin":
     #    raise RuntimeError("Compression not support on macOS")
 
     # Check if source directory exists first
@@ -136,6 +351,36 @@ def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color,
     if dry_run and not check_folder_exists(bucket):
         raise click.UsageError(f"no directory found at dest path {bucket}")
 
+    if dry_run and incremental:
+        raise click.UsageError("incremental backups are not supported with dry-run")
+
+    # Multipart uploads of the native engine can be resumed, the chunk store skips existing chunks anyway
+    checkpoint = None
+    options = {"folder": folder, "compression": str(compression) if compression else None, "encrypt": encrypt,
+               "cipher": cipher, "seekable": seekable, "incremental": incremental, "volume_size": volume_size}
+    if engine and not dry_run and not chunk_store:
+        checkpoint = Checkpoint.load(bucket, jobname)
+        if checkpoint and (not resume or checkpoint.state["options"] != options or "keys" not in checkpoint.state):
+            # Parts written with other options cannot be reused
+            checkpoint.discard(engine.client)
+            checkpoint = None
+
+    tarkey = None
+    listkey = None
+    if checkpoint and checkpoint.state["keys"]:
+        # The parts of an encrypted backup can only be reused with the keys they were encrypted with
+        try:
+            if not key:
+                raise RuntimeError("option key is missing")
+            tarkey, listkey = unwrap_keys(key, checkpoint.state["keys"])
+        except Exception as e:
+            print(f"{yellow('Warning')}: cannot resume the encrypted backup from {checkpoint.state['date']} "
+                  f"({e}), pass its private key with --key, starting a new backup")
+            abandon(checkpoint, bucket, jobname, engine)
+            checkpoint = None
+    if checkpoint:
+        date = checkpoint.state["date"]
+
     # Print what we are going to do
     if dry_run:
         print(f"Backing up {cyan(folder)} to local folder {cyan(bucket)} (dry-run)")
@@ -143,6 +388,14 @@ def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color,
         print(f"Backing up {cyan(folder)} to AWS S3 bucket {yellow(bucket)} (class = {yellow(storage_class)})")
 
     print(f"Jobname: {cyan(jobname)}")
+    if checkpoint:
+        print(f"Resuming interrupted backup from {yellow(date)}")
+    if compression:
+        print(f"Compression: {cyan(str(compression))}")
+    if encrypt:
+        print(f"Encryption: {cyan(cipher or 'aes-256-ctr (openssl)')}")
+    if volume_size:
+        print(f"Volumes: {cyan(str(volume_size // 1024 // 1024))} MiB")
 
 
     # Create the parent directory first
@@ -157,31 +410,56 @@ def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color,
         except:
             raise RuntimeError(f"Could not create job directory at path {jobdir}")
 
-    tarkey = None
-    listkey = None
-    if encrypt:
+    base = None
+    if incremental:
+        print("Looking up previous backup...", end="", flush=True)
+        if not checkpoint:
+            base = find_base(bucket, jobname, key, engine)
+        elif checkpoint.state["base"]:
+            # The resumed stream has to be diffed against the same backup as before
+            base = find_base(bucket, jobname, key, engine, checkpoint.state["base"])
+        if base:
+            print(green("DONE"), flush=True)
+            print(f"Incremental backup based on {yellow(base[0])}")
+        else:
+            print(yellow("NONE"), flush=True)
+            print("No previous backup found, falling back to full backup")
+
+    salt = None
+    if checkpoint:
+        salt = checkpoint.state["salt"]
+    elif encrypt:
         # Generate symmetric keys for tar + list
         print("Generating symmetric keys for encryption...", end="", flush=True)
-        try:
-            tarkey = subprocess.check_output(
-                ["openssl", "rand", "-hex", "16"],
-                stderr=subprocess.DEVNULL
-            ).decode("utf-8").splitlines()[0]
-            listkey = subprocess.check_output(
-                ["openssl", "rand", "-hex", "16"],
-                stderr=subprocess.DEVNULL
-            ).decode("utf-8").splitlines()[0]
-            print(green("DONE"), flush=True)
-        except:
-            raise RuntimeError(f"Could not generate symmetric keys for backup job")
+        tarkey = generate_key()
+        listkey = generate_key()
+        print(green("DONE"), flush=True)
 
+    if engine and not dry_run and not chunk_store and not checkpoint:
+        if encrypt:
+            # A resumed run has to reproduce the encrypted stream byte for byte
+            salt = os.urandom(SALT_SIZE if cipher == GCM_CIPHER else 8).hex()
+        checkpoint = Checkpoint.create(bucket, jobname, {
+            "bucket": bucket, "date": date, "options": options,
+            "keys": wrap_keys(cert, tarkey, listkey) if encrypt else None, "salt": salt, "base": base[0] if base else None,
+        })
+
+    if encrypt or base:
         # Generate Metafile contents
-        meta_content = {
-            "tarkey": tarkey,
-            "listkey": listkey
-        }
+        meta_content = dict()
+        if encrypt:
+            meta_content["tarkey"] = tarkey
+            meta_content["listkey"] = listkey
+        if encrypt and cipher:
+            meta_content["cipher"] = cipher
+        if base:
+            meta_content["type"] = "incremental"
+            meta_content["base"] = base[0]
 
         meta_bin = json.dumps(meta_content).encode("utf-8")
+        if encrypt and cipher:
+            # Encrypt in-process, the pipeline only uploads
+            meta_bin = encrypt_asymmetric(cert, meta_bin)
         if encrypt:
             meta_name = f"{jobname}.meta.enc"
         else:
@@ -190,49 +468,158 @@ def do_backup(compress, encrypt, cert, storage_class, jobname, progress, color,
         print("Sending Metafile...", end="" if not progress else "\n", flush=True)
 
         # Build chain from back to front
-        meta_pipeline = build_upload_pipeline_asymmetric(dry_run, progress, encrypt, cert, None, bucket,
-                                                         os.path.join(jobdir_name, meta_name))
-        meta_pipeline[0].communicate(meta_bin)
-        for i in range(1, len(meta_pipeline)):
-            meta_pipeline[i - 1].stdout.close()
-            meta_pipeline[i].wait()
-
-        print(green("DONE"), flush=True)
-
-    # Send file list
-    print("Sending file list...", flush=True)
-    file_list_name = f"{jobname}.list.aes" if encrypt else f"{jobname}.list"
-
-    filelist_tar = subprocess.Popen(
-        ["bsdtar", "-C", "/", "-cf", "-", "--format", "mtree", "--options=sha256", folder],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL
-    )
-
-    file_list_pipeline = build_upload_pipeline_symmetric(filelist_tar, dry_run, False, encrypt, listkey, None, bucket,
-                                                         os.path.join(jobdir_name, file_list_name))
-
-    for i in range(1, len(file_list_pipeline)):
-        file_list_pipeline[i - 1].stdout.close()
-        file_list_pipeline[i].wait()
-
-    print(green("DONE"), flush=True)
+        meta_pipeline = build_upload_pipeline_asymmetric(dry_run, progress, encrypt and not cipher, cert, None, bucket,
+                                                         os.path.join(jobdir_name, meta_name), engine)
+        if meta_pipeline:
+            # communicate() would swallow the stdout meant for the next stage
+            meta_pipeline[0].stdin.write(meta_bin)
+            meta_pipeline[0].stdin.close()
+        wait_pipeline(meta_pipeline)
 
-    # Send actual backup
-    print("Sending backup...", flush=True)
-    backup_name = f"{jobname}.tar"
-    if compress:
-        backup_name = f"{backup_name}.zstd"
-    if encrypt:
-        backup_name = f"{backup_name}.aes"
+        if encrypt:
+            # The base date in plain text, prune plans retention without the private key. Empty for full backups.
+            base_pipeline = build_upload_pipeline_asymmetric(dry_run, False, False, None, None, bucket,
+                                                             os.path.join(jobdir_name, f"{jobname}.base"), engine)
+            if base_pipeline:
+                base_pipeline[0].stdin.write((base[0] if base else "").encode("utf-8"))
+                base_pipeline[0].stdin.close()
+            wait_pipeline(base_pipeline)
 
-    backup_tar = get_tar_pipe(folder, compress)
+        print(green("DONE"), flush=True)
 
-    backup_pipeline = build_upload_pipeline_symmetric(backup_tar, dry_run, progress, encrypt, tarkey, storage_class, bucket,
-                                                      os.path.join(jobdir_name, backup_name))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        changed_path = None
+        if base:
+            # Only stat the tree, file contents are hashed while the changed files stream into the archive
+            print("Scanning for changes...", end="", flush=True)
+            current = parse_mtree(subprocess.check_output(
+                ["bsdtar", "-C", "/", "-cf", "-", "--format", "mtree", folder],
+                stderr=subprocess.DEVNULL
+            ).splitlines())
+            changed, deleted = diff_mtree(base[1], current)
+            print(green("DONE"), flush=True)
+            print(f"{cyan(str(len(changed)))} new or changed, {cyan(str(len(deleted)))} deleted entries")
+
+            changed_path = os.path.join(tmpdir, "changed")
+            write_path_list(changed_path, changed)
+
+            # Send tombstones for deleted entries
+            print("Sending deleted list...", flush=True)
+            deleted_path = os.path.join(tmpdir, "deleted")
+            write_path_list(deleted_path, deleted)
+            deleted_name = f"{jobname}.deleted.aes" if encrypt else f"{jobname}.deleted"
+            upload_file(deleted_path, dry_run, encrypt, listkey, bucket, os.path.join(jobdir_name, deleted_name), engine,
+                        cipher)
+            print(green("DONE"), flush=True)
 
-    for i in range(1, len(backup_pipeline)):
-        backup_pipeline[i - 1].stdout.close()
-        backup_pipeline[i].wait()
+        # Send actual backup
+        print("Sending backup...", flush=True)
+        backup_name = f"{jobname}.tar"
+        if compression:
+            backup_name = f"{backup_name}.zstd"
+        if encrypt:
+            backup_name = f"{backup_name}.aes"
+
+        if metrics:
+            metrics.begin()
+        backup_tar = get_tar_pipe(folder, changed_path, read_concurrency)
+        source = [backup_tar]
+        if read_throttle:
+            # tar blocks on the full pipe, limiting the stream limits its disk reads
+            source.append(get_throttle_pipe(read_throttle, link(source, metrics)))
+        # Builds the file list from the tar stream, every file is read only once
+        cache = StatCache(stat_cache_path(bucket, jobname)) if stat_cache and not dry_run else None
+        manifest = get_manifest_pipe(link(source, metrics), cache)
+        for stage in source:
+            stage.stdout.close()
+
+        if chunk_store:
+            # The chunk store compresses chunks itself, the manifest replaces the tar object
+            backup_pipeline = build_upload_pipeline_chunked(manifest, progress, chunk_store,
+                                                            os.path.join(jobdir_name, f"{jobname}.chunks"), throttle,
+                                                            metrics)
+        elif volume_size:
+            suffix = backup_name[len(jobname):]
+
+            def open_volume(index, source):
+                return build_upload_pipeline_symmetric(source, dry_run, False, encrypt, tarkey, storage_class, bucket,
+                                                       os.path.join(jobdir_name, volume_name(jobname, index, suffix)),
+                                                       engine, compression, cipher, throttle, metrics,
+                                                       volume_salt(salt, index), checkpoint)
+
+            def wait_volume(pipeline):
+                wait_upload_pipeline(pipeline, metrics)
+                if metrics:
+                    metrics.add(pipeline)
+
+            backup_pipeline = build_upload_pipeline_volumes(manifest, progress, volume_size, volume_concurrency,
+                                                            open_volume, wait_volume, metrics)
+        else:
+            stage = compression
+            if seekable:
+                # Independent frames plus a member index allow restoring single files with range requests
+                stage = SeekableCompression(compression) if compression else Uncompressed()
+            backup_pipeline = build_upload_pipeline_symmetric(manifest, dry_run, progress, encrypt, tarkey, storage_class,
+                                                              bucket, os.path.join(jobdir_name, backup_name), engine,
+                                                              stage, cipher, throttle, metrics, salt, checkpoint,
+                                                              hold=True)
+
+        wait_upload_pipeline(source + backup_pipeline, metrics)
+        if metrics:
+            metrics.add(source + backup_pipeline)
+            metrics.publish("backup", jobname)
+
+        # Send file list
+        print("Sending file list...", flush=True)
+        entries = manifest.entries()
+        if base:
+            # Unchanged entries keep the digests of the previous file list
+            entries = {path: entries.get(path) or base[1][path] for path in current
+                       if path in entries or path in base[1]}
+        file_list_path = os.path.join(tmpdir, "list")
+        with open(file_list_path, "wb") as f:
+            write_mtree(entries, f)
+        file_list_name = f"{jobname}.list.aes" if encrypt else f"{jobname}.list"
+        upload_file(file_list_path, dry_run, encrypt, listkey, bucket, os.path.join(jobdir_name, file_list_name), engine,
+                    cipher)
+
+        if volume_size:
+            writer = backup_pipeline[-1]
+            print(f"Sending volume manifest ({cyan(str(len(writer.sizes)))} volumes)...", flush=True)
+            volumes_path = os.path.join(tmpdir, "volumes")
+            with open(volumes_path, "w") as f:
+                json.dump(writer.manifest([volume_name(jobname, i, suffix) for i in range(len(writer.sizes))]), f)
+            volumes_name = f"{jobname}.volumes.aes" if encrypt else f"{jobname}.volumes"
+            upload_file(volumes_path, dry_run, encrypt, listkey, bucket, os.path.join(jobdir_name, volumes_name), engine,
+                        cipher)
+
+        if seekable:
+            print("Sending archive index...", flush=True)
+            index_path = os.path.join(tmpdir, "index")
+            with open(index_path, "w") as f:
+                json.dump(next(s for s in backup_pipeline if hasattr(s, "index")).index(), f)
+            index_name = f"{jobname}.index.aes" if encrypt else f"{jobname}.index"
+            upload_file(index_path, dry_run, encrypt, listkey, bucket, os.path.join(jobdir_name, index_name), engine,
+                        cipher)
 
     print(green("DONE"))
+
+    if not dry_run:
+        catalog = Catalog(bucket)
+        try:
+            catalog.add_backup(jobname, date)
+        finally:
+            catalog.close()
+    if checkpoint:
+        checkpoint.remove()
+    if cache:
+        # Only a completed backup may vouch for the digests
+        cache.save(entries)
+        cache.close()
+        if cache.hits:
+            print(f"{cyan(str(cache.hits))} files unchanged since the last backup, not hashed again")
+
+    if chunk_store:
+        stats = backup_pipeline[-1].stats
+        print(f"{cyan(str(stats['chunks']))} chunks, {cyan(str(stats['new_chunks']))} new "
+              f"({cyan(str(stats['uploaded_bytes'] // 1024 // 1024))} MiB uploaded)")
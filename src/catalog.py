@@ -0,0 +1,178 @@
+import json
+import os
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from chunkstore import CHUNK_PREFIX, LEASE_PREFIX
+
+# Listings younger than this are served from the catalog without asking S3
+CATALOG_TTL = 15 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, refreshed REAL);
+CREATE TABLE IF NOT EXISTS jobs (bucket TEXT, job TEXT, PRIMARY KEY (bucket, job));
+CREATE TABLE IF NOT EXISTS backups (bucket TEXT, job TEXT, date TEXT, PRIMARY KEY (bucket, job, date));
+CREATE TABLE IF NOT EXISTS files (bucket TEXT, job TEXT, date TEXT, name TEXT, size INTEGER,
+                                  PRIMARY KEY (bucket, job, date, name));
+"""
+
+
+def catalog_path():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "pyawsbackup", "catalog.sqlite")
+
+
+def list_prefix(bucket, prefix, engine=None, start_after=None):
+    # One level of ListObjectsV2 with delimiter, returns (child prefixes, [(object name, size)])
+    if engine:
+        args = {"Bucket": bucket, "Prefix": prefix, "Delimiter": "/"}
+        if start_after:
+            args["StartAfter"] = start_after
+        pages = engine.client.get_paginator("list_objects_v2").paginate(**args)
+    else:
+        cmd = ["aws", "s3api", "list-objects-v2", "--bucket", bucket, "--prefix", prefix, "--delimiter", "/",
+               "--output", "json"]
+        if start_after:
+            cmd += ["--start-after", start_after]
+        # The cli follows continuation tokens itself and merges the pages, adaptive retries back off on SlowDown
+        env = dict(os.environ)
+        env.setdefault("AWS_RETRY_MODE", "adaptive")
+        env.setdefault("AWS_MAX_ATTEMPTS", "10")
+        out = subprocess.check_output(cmd, env=env).decode("utf-8")
+        pages = [json.loads(out)] if out.strip() else []
+
+    prefixes = []
+    objects = []
+    for page in pages:
+        prefixes += [p["Prefix"][len(prefix):].strip("/") for p in page.get("CommonPrefixes") or []]
+        objects += [(o["Key"][len(prefix):], o["Size"]) for o in page.get("Contents") or []]
+    return prefixes, objects
+
+
+def list_objects(bucket, prefix, engine=None):
+    # Every object below prefix by key, with its size, etag, storage class and modification time
+    if engine:
+        pages = engine.client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix)
+    else:
+        out = subprocess.check_output(["aws", "s3api", "list-objects-v2", "--bucket", bucket, "--prefix", prefix,
+                                       "--output", "json"]).decode("utf-8")
+        pages = [json.loads(out)] if out.strip() else []
+
+    objects = dict()
+    for page in pages:
+        objects.update({o["Key"]: o for o in page.get("Contents") or []})
+    return objects
+
+
+class Catalog:
+    # Local cache of the jobs, dates and files of a bucket, backup dates never change once written
+    def __init__(self, bucket, engine=None, refresh=False, path=None, ttl=CATALOG_TTL, concurrency=None):
+        self.bucket = bucket
+        self.engine = engine
+        # A native engine's connection pool is sized for its concurrency
+        self.concurrency = concurrency or (engine.concurrency if engine else 8)
+        self.ttl = ttl
+        path = path or catalog_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.refreshed = False
+
+        if refresh:
+            self.refresh(full=True)
+
+    def close(self):
+        self.db.close()
+
+    def is_stale(self):
+        row = self.db.execute("SELECT refreshed FROM buckets WHERE bucket = ?", (self.bucket,)).fetchone()
+        return row is None or time.time() - row[0] > self.ttl
+
+    def ensure_fresh(self):
+        if not self.refreshed and self.is_stale():
+            self.refresh()
+
+    def refresh(self, full=False):
+        # Incremental refreshes only ask for dates newer than the newest known date of every job
+        jobs, _ = list_prefix(self.bucket, "", self.engine)
+        jobs = [j for j in jobs if j not in (CHUNK_PREFIX, LEASE_PREFIX)]
+        with self.db:
+            if full:
+                for table in ("jobs", "backups", "files"):
+                    self.db.execute(f"DELETE FROM {table} WHERE bucket = ?", (self.bucket,))
+            known = set(self.query("SELECT job FROM jobs WHERE bucket = ?"))
+            for job in known - set(jobs):
+                self.forget(job)
+
+            # Job prefixes are listed concurrently, sqlite is only touched from this thread
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for job, dates in zip(jobs, executor.map(self.list_job, jobs, [self.latest(j, False) for j in jobs])):
+                    self.add_dates(job, dates)
+            self.db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?)", (self.bucket, time.time()))
+        self.refreshed = True
+
+    def list_job(self, job, latest):
+        # "/" sorts right before "0", so this skips every key below the latest date
+        start_after = f"{job}/{latest}0" if latest else None
+        dates, _ = list_prefix(self.bucket, job + "/", self.engine, start_after)
+        return dates
+
+    def refresh_job(self, job):
+        self.add_dates(job, self.list_job(job, self.latest(job, refresh=False)))
+
+    def add_dates(self, job, dates):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO jobs VALUES (?, ?)", (self.bucket, job))
+            self.db.executemany("INSERT OR IGNORE INTO backups VALUES (?, ?, ?)",
+                                [(self.bucket, job, date) for date in dates])
+
+    def forget(self, job, date=None):
+        with self.db:
+            for table in ("backups", "files"):
+                if date:
+                    self.db.execute(f"DELETE FROM {table} WHERE bucket = ? AND job = ? AND date = ?",
+                                    (self.bucket, job, date))
+                else:
+                    self.db.execute(f"DELETE FROM {table} WHERE bucket = ? AND job = ?", (self.bucket, job))
+            if not date:
+                self.db.execute("DELETE FROM jobs WHERE bucket = ? AND job = ?", (self.bucket, job))
+
+    def query(self, sql, *args):
+        return [row[0] for row in self.db.execute(sql, (self.bucket,) + args)]
+
+    def jobs(self):
+        self.ensure_fresh()
+        return self.query("SELECT job FROM jobs WHERE bucket = ? ORDER BY job")
+
+    def dates(self, job):
+        self.ensure_fresh()
+        return self.query("SELECT date FROM backups WHERE bucket = ? AND job = ? ORDER BY date", job)
+
+    def latest(self, job, refresh=True):
+        if refresh:
+            self.ensure_fresh()
+        dates = self.query("SELECT MAX(date) FROM backups WHERE bucket = ? AND job = ?", job)
+        return dates[0] if dates else None
+
+    def has_date(self, job, date):
+        if date in self.dates(job):
+            return True
+        # The backup may have been written by another host since the last refresh
+        self.refresh_job(job)
+        return date in self.dates(job)
+
+    def files(self, job, date):
+        names = self.query("SELECT name FROM files WHERE bucket = ? AND job = ? AND date = ? ORDER BY name", job, date)
+        if names:
+            return names
+
+        _, objects = list_prefix(self.bucket, f"{job}/{date}/", self.engine)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                [(self.bucket, job, date, name, size) for name, size in objects])
+        return sorted(name for name, _ in objects)
+
+    def add_backup(self, job, date):
+        # Written after a successful backup so the next list or restore does not need a refresh
+        self.add_dates(job, [date])
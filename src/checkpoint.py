@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+from catalog import catalog_path
+
+# Only the owner may read the state of an unfinished backup, its symmetric keys are stored encrypted with the cert
+CHECKPOINT_MODE = 0o600
+
+
+class ResumeError(RuntimeError):
+    # The regenerated stream differs from the interrupted upload, the source changed in between
+    pass
+
+
+def checkpoint_path(bucket, jobname):
+    return os.path.join(os.path.dirname(catalog_path()), "checkpoints", bucket, f"{jobname}.json")
+
+
+class Checkpoint:
+    # Durable state of an unfinished backup: its date, wrapped keys and salts, and the parts S3 already has
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, bucket, jobname):
+        path = checkpoint_path(bucket, jobname)
+        try:
+            with open(path) as f:
+                return cls(path, json.load(f))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Torn writes cannot happen, but a hand edited file might not parse
+            return None
+
+    @classmethod
+    def create(cls, bucket, jobname, state):
+        checkpoint = cls(checkpoint_path(bucket, jobname), dict(state, uploads=dict()))
+        checkpoint.save()
+        return checkpoint
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, CHECKPOINT_MODE)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def upload(self, key):
+        return self.state["uploads"].get(key)
+
+    def start_upload(self, key, upload_id, part_size):
+        with self.lock:
+            self.state["uploads"][key] = {"upload_id": upload_id, "part_size": part_size}
+            self.save()
+
+    def add_part(self, key, part_number, etag):
+        # Written after every part, a crash loses at most the parts in flight
+        with self.lock:
+            self.state["uploads"][key].setdefault("parts", dict())[str(part_number)] = etag
+            self.save()
+
+    def finish_upload(self, key):
+        with self.lock:
+            self.state["uploads"].pop(key, None)
+            self.save()
+
+    def discard(self, client=None):
+        # Unfinished multipart uploads are billed until they are aborted
+        if client:
+            for key, upload in self.state["uploads"].items():
+                try:
+                    client.abort_multipart_upload(Bucket=self.state["bucket"], Key=key, UploadId=upload["upload_id"])
+                except Exception:
+                    pass
+        self.remove()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,360 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from compression import SAMPLE_SIZE, is_incompressible
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_PREFIX = "chunks"
+READ_SIZE = 4 * 1024 * 1024
+# Markers of running chunked backups and chunk collections, next to the chunk store
+LEASE_PREFIX = "leases"
+# A lease is rewritten this often while it is held, one that was not for LEASE_EXPIRY belongs to a process that died
+LEASE_REFRESH = 5 * 60
+LEASE_EXPIRY = timedelta(minutes=30)
+# Seconds between checks while a backup waits for a chunk collection to finish
+LEASE_POLL = 30
+
+# Gear table for the rolling hash, the seed must never change or chunk boundaries shift
+_gear_rng = random.Random(0x70796177)
+GEAR = tuple(_gear_rng.getrandbits(64) for _ in range(256))
+MASK64 = 0xFFFFFFFFFFFFFFFF
+# Bytes hashed per numpy pass, the hashes of a pass stay in the CPU cache
+SCAN_SIZE = 64 * 1024
+
+
+class Chunker:
+    # Content defined chunking with a gear rolling hash, cut points skip the first min_size bytes of a chunk
+    def __init__(self, avg_size=1024 * 1024):
+        if avg_size & (avg_size - 1):
+            raise ValueError("average chunk size must be a power of two")
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 4
+        bits = avg_size.bit_length() - 1
+        # Only the high bits of a gear hash depend on the whole 64 byte window
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+        self.gear = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+
+    def cut(self, data, start, end):
+        if end - start <= self.min_size:
+            return end
+        end = min(end, start + self.max_size)
+        if self.gear is not None:
+            return self.cut_numpy(data, start + self.min_size, end)
+        h = 0
+        mask = self.mask
+        gear = GEAR
+        for i in range(start + self.min_size, end):
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            if not h & mask:
+                return i + 1
+        return end
+
+    def cut_numpy(self, data, first, end):
+        # Same cut points as the loop above. The hash after byte i is the sum of gear[data[i - k]] << k over the
+        # 64 bytes up to i, which log2(64) shifted additions compute for a whole block at once.
+        mask = numpy.uint64(self.mask)
+        for block in range(first, end, SCAN_SIZE):
+            # Bytes before first never enter the hash, like h = 0 in the loop
+            lo = max(first, block - 63)
+            hi = min(end, block + SCAN_SIZE)
+            h = self.gear[numpy.frombuffer(data, numpy.uint8, hi - lo, lo)]
+            for shift in (1, 2, 4, 8, 16, 32):
+                h[shift:] += h[:-shift] << numpy.uint64(shift)
+            hits = numpy.flatnonzero((h[block - lo:] & mask) == 0)
+            if len(hits):
+                return block + int(hits[0]) + 1
+        return end
+
+    def chunks(self, stream):
+        buf = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            while not eof and len(buf) - pos < self.max_size:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    eof = True
+                    break
+                if pos:
+                    del buf[:pos]
+                    pos = 0
+                buf += data
+
+            if pos >= len(buf):
+                return
+
+            end = self.cut(buf, pos, len(buf))
+            yield bytes(buf[pos:end])
+            pos = end
+
+
+def chunk_key(digest, compressed):
+    return f"{CHUNK_PREFIX}/{digest[:2]}/{digest}{'.zst' if compressed else ''}"
+
+
+class ChunkStore:
+    # Bucket-level store of content addressed chunks shared by all jobs
+    def __init__(self, client, bucket, storage_class=None, compress=False, avg_chunk_size=1024 * 1024, concurrency=8,
+                 adaptive=False):
+        self.client = client
+        self.bucket = bucket
+        self.storage_class = storage_class
+        self.compress = compress
+        self.adaptive = adaptive
+        self.chunker = Chunker(avg_chunk_size)
+        self.concurrency = concurrency
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load_index(self):
+        # The chunk objects themselves are the index, there is no separate state that could diverge
+        index = dict()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{CHUNK_PREFIX}/"):
+            for obj in page.get("Contents", []):
+                name = obj["Key"].rsplit("/", 1)[1]
+                digest, _, ext = name.partition(".")
+                index[digest] = ext == "zst"
+        self.index = index
+        return index
+
+    def get_pipe(self, manifest_key, input):
+        writer = ChunkWriter(self, manifest_key, input)
+        writer.start()
+        return writer
+
+    def should_compress(self, data):
+        if not self.compress:
+            return False
+        # Chunks of already compressed data are stored as they are
+        return not (self.adaptive and is_incompressible(data[:SAMPLE_SIZE]))
+
+    def put_chunk(self, digest, data, compressed):
+        if compressed:
+            import zstandard
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+        extra_args = {"StorageClass": self.storage_class} if self.storage_class else dict()
+        self.client.put_object(Bucket=self.bucket, Key=chunk_key(digest, compressed), Body=data, **extra_args)
+        return len(data)
+
+    def get_chunk(self, digest, compressed):
+        data = self.client.get_object(Bucket=self.bucket, Key=chunk_key(digest, compressed))["Body"].read()
+        if compressed:
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError(f"Chunk {digest} is corrupt")
+        return data
+
+    def read_manifest(self, manifest_key):
+        body = self.client.get_object(Bucket=self.bucket, Key=manifest_key)["Body"].read().decode("utf-8")
+        return parse_manifest(body)
+
+    def get_reader(self, manifest, output=None, thaw=None):
+        reader = ChunkReader(self, manifest, output, thaw)
+        reader.start()
+        return reader
+
+
+class Lease:
+    # Marker object that chunked backups and prune's chunk collection check for each other. Both write their own
+    # lease before they list the other's, so of two that start at the same time at least one sees the other.
+    def __init__(self, client, bucket, name):
+        self.client = client
+        self.bucket = bucket
+        self.key = f"{LEASE_PREFIX}/{name}"
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    def put(self):
+        body = json.dumps({"host": socket.gethostname(), "pid": os.getpid()}).encode("utf-8")
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+
+    def acquire(self):
+        self.put()
+        self.refresher = threading.Thread(target=self.refresh, daemon=True)
+        self.refresher.start()
+
+    def refresh(self):
+        while not self.stopped.wait(LEASE_REFRESH):
+            try:
+                self.put()
+            except Exception:
+                # A missed refresh only shortens the lease, the next one retries
+                pass
+
+    def release(self):
+        self.stopped.set()
+        if self.refresher:
+            self.refresher.join()
+        self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+def live_leases(client, bucket, kind):
+    # Names of the leases of kind ("backup" or "prune") that were refreshed recently
+    now = datetime.now(timezone.utc)
+    leases = []
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{LEASE_PREFIX}/{kind}/"):
+        leases += [o["Key"][len(LEASE_PREFIX) + 1:] for o in page.get("Contents", [])
+                   if now - o["LastModified"] < LEASE_EXPIRY]
+    return leases
+
+
+def parse_manifest(body):
+    # One "sha256 size z|r" line per chunk, in stream order
+    manifest = []
+    for line in body.splitlines():
+        digest, size, kind = line.split(" ")
+        manifest.append((digest, int(size), kind == "z"))
+    return manifest
+
+
+class ChunkWriter(threading.Thread):
+    # Last stage of the backup pipeline, splits the stream into chunks and uploads the missing ones
+    def __init__(self, store, manifest_key, input):
+        super(ChunkWriter, self).__init__(daemon=True)
+        self.store = store
+        self.manifest_key = manifest_key
+        self.args = ["chunkstore", manifest_key]
+        self.stdin = None
+        self.stdout = None
+        self.returncode = None
+        self.error = None
+        self.stats = {"chunks": 0, "new_chunks": 0, "bytes": 0, "uploaded_bytes": 0}
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+
+    def run(self):
+        try:
+            self.write()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Chunk upload failed: {self.error}")
+        return self.returncode
+
+    def upload(self, digest, data, compressed, slots):
+        try:
+            uploaded = self.store.put_chunk(digest, data, compressed)
+            with self.store.lock:
+                self.stats["uploaded_bytes"] += uploaded
+        finally:
+            slots.release()
+
+    def write(self):
+        # Chunks may only be reused while no chunk collection can delete them, from before the index is listed
+        # until the manifest referencing them is uploaded
+        lease = Lease(self.store.client, self.store.bucket, f"backup/{self.manifest_key}")
+        lease.acquire()
+        try:
+            waiting = False
+            while live_leases(self.store.client, self.store.bucket, "prune"):
+                if not waiting:
+                    print("prune is collecting unreferenced chunks, waiting for it to finish", file=sys.stderr,
+                          flush=True)
+                    waiting = True
+                time.sleep(LEASE_POLL)
+            self.upload_chunks()
+        finally:
+            lease.release()
+
+    def upload_chunks(self):
+        store = self.store
+        index = store.load_index()
+        manifest = []
+        # Bounds the number of chunks held in memory while waiting for upload
+        slots = threading.BoundedSemaphore(store.concurrency * 2)
+        futures = []
+        with ThreadPoolExecutor(max_workers=store.concurrency) as executor:
+            for data in store.chunker.chunks(self.input):
+                digest = hashlib.sha256(data).hexdigest()
+                self.stats["chunks"] += 1
+                self.stats["bytes"] += len(data)
+                if digest not in index:
+                    index[digest] = store.should_compress(data)
+                    self.stats["new_chunks"] += 1
+                    slots.acquire()
+                    futures.append(executor.submit(self.upload, digest, data, index[digest], slots))
+                manifest.append(f"{digest} {len(data)} {'z' if index[digest] else 'r'}\n")
+
+                if any(f.done() and f.exception() for f in futures):
+                    break
+                futures = [f for f in futures if not f.done() or f.exception()]
+
+        for f in futures:
+            f.result()
+
+        # Only publish the manifest once every chunk it references exists
+        store.client.put_object(Bucket=store.bucket, Key=self.manifest_key, Body="".join(manifest).encode("utf-8"))
+
+
+class ChunkReader(threading.Thread):
+    # First stage of the restore pipeline, downloads chunks in parallel and writes them in manifest order.
+    # With a thaw every chunk is downloaded once it is readable, the stream starts before the last one thawed.
+    def __init__(self, store, manifest, output=None, thaw=None):
+        super(ChunkReader, self).__init__(daemon=True)
+        self.store = store
+        self.manifest = manifest
+        self.thaw = thaw
+        self.args = ["chunkstore"]
+        self.returncode = None
+        self.error = None
+
+        if output:
+            self.stdout = None
+            self.output = output
+        else:
+            r, w = os.pipe()
+            self.stdout = os.fdopen(r, "rb")
+            self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            self.read()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Chunk download failed: {self.error}")
+        return self.returncode
+
+    def fetch(self, digest, compressed):
+        if self.thaw:
+            self.thaw.wait(chunk_key(digest, compressed))
+        return self.store.get_chunk(digest, compressed)
+
+    def read(self):
+        window = self.store.concurrency * 2
+        with ThreadPoolExecutor(max_workers=self.store.concurrency) as executor:
+            pending = []
+            for digest, size, compressed in self.manifest:
+                pending.append(executor.submit(self.fetch, digest, compressed))
+                if len(pending) >= window:
+                    self.output.write(pending.pop(0).result())
+            for f in pending:
+                self.output.write(f.result())
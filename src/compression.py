@@ -0,0 +1,280 @@
+import os
+import struct
+import subprocess
+import threading
+from tarstream import READ_SIZE, TarIndexer
+
+# Window log used when decompressing, large enough for any --long window zstd accepts
+MAX_WINDOW_LOG = 31
+
+# Files with these extensions are already compressed, they are stored without trying
+COMPRESSED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "avif", "jxl",
+    "mp4", "m4v", "mkv", "mov", "avi", "webm", "mp3", "m4a", "aac", "ogg", "opus", "flac",
+    "zip", "gz", "tgz", "bz2", "xz", "txz", "zst", "zstd", "lz4", "lzma", "br", "7z", "rar",
+    "jar", "apk", "docx", "xlsx", "pptx", "odt", "epub",
+    "gpg", "pgp", "age", "aes", "enc",
+}
+# Other files are sampled, files smaller than MIN_SAMPLE are always compressed
+SAMPLE_SIZE = 64 * 1024
+MIN_SAMPLE = 4 * 1024
+# A sample that zstd -1 cannot shrink below this ratio marks the file as incompressible
+INCOMPRESSIBLE_RATIO = 0.95
+
+# Raw zstd frames: magic, frame header without content size and a 128 KiB window, then raw blocks
+ZSTD_MAGIC = struct.pack("<I", 0xFD2FB528)
+RAW_FRAME_HEADER = ZSTD_MAGIC + bytes([0x00, 7 << 3])
+MAX_BLOCK_SIZE = 128 * 1024
+
+
+class Compression:
+    # zstd settings for the compression stage of the upload pipeline
+    def __init__(self, level=3, threads=0, long_window=None, native=False, adaptive=False):
+        if not 1 <= level <= 22:
+            raise ValueError("zstd compression level must be between 1 and 22")
+        if long_window is not None and not 10 <= long_window <= MAX_WINDOW_LOG:
+            raise ValueError(f"zstd window log must be between 10 and {MAX_WINDOW_LOG}")
+        self.level = level
+        self.threads = threads
+        self.long_window = long_window
+        self.native = native
+        self.adaptive = adaptive
+
+    def __str__(self):
+        desc = f"zstd -{self.level} -T{self.threads}"
+        if self.long_window:
+            desc = f"{desc} --long={self.long_window}"
+        if self.adaptive:
+            return f"{desc} (python-zstandard, adaptive)"
+        return f"{desc} (python-zstandard)" if self.native else desc
+
+    def command(self):
+        cmd = ["zstd", "-q", "-c", f"-{self.level}", f"-T{self.threads}"]
+        if self.level > 19:
+            cmd.append("--ultra")
+        if self.long_window:
+            cmd.append(f"--long={self.long_window}")
+        return cmd
+
+    def get_pipe(self, input):
+        if self.adaptive:
+            stage = AdaptiveZstdCompress(self, input)
+            stage.start()
+            return stage
+
+        if self.native:
+            stage = NativeZstdCompress(self, input)
+            stage.start()
+            return stage
+
+        zstd = subprocess.Popen(
+            self.command(),
+            stdin=input,
+            stdout=subprocess.PIPE
+        )
+        return zstd
+
+
+def get_zstd_decompress_pipe(input):
+    zstd = subprocess.Popen(
+        ["zstd", "-q", "-d", "-c", f"--long={MAX_WINDOW_LOG}"],
+        stdin=input,
+        stdout=subprocess.PIPE
+    )
+    return zstd
+
+
+class NativeZstdCompress(threading.Thread):
+    # In-process replacement for the zstd subprocess, behaves like a Popen with a stdout pipe
+    def __init__(self, compression, input, chunk_size=1024 * 1024):
+        super(NativeZstdCompress, self).__init__(daemon=True)
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.args = ["python-zstandard"]
+        self.returncode = None
+        self.error = None
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def compressor(self):
+        import zstandard
+
+        kwargs = dict()
+        if self.compression.long_window:
+            kwargs["enable_ldm"] = True
+            kwargs["window_log"] = self.compression.long_window
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.compression.level,
+            threads=-1 if self.compression.threads == 0 else self.compression.threads,
+            **kwargs
+        )
+        return zstandard.ZstdCompressor(compression_params=params)
+
+    def run(self):
+        try:
+            self.compressor().copy_stream(self.input, self.output, read_size=self.chunk_size,
+                                          write_size=self.chunk_size)
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Compression failed: {self.error}")
+        return self.returncode
+
+
+def raw_blocks(data, last=False):
+    # Block header: 3 bytes little endian, bit 0 last block, bits 1-2 type (0 is raw), bits 3-23 size
+    out = bytearray()
+    for pos in range(0, len(data), MAX_BLOCK_SIZE):
+        block = data[pos:pos + MAX_BLOCK_SIZE]
+        out += (len(block) << 3).to_bytes(3, "little") + block
+    if last:
+        out += (1).to_bytes(3, "little")
+    return bytes(out)
+
+
+def is_incompressible(sample):
+    import zstandard
+    return len(zstandard.ZstdCompressor(level=1).compress(sample)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+
+class CompressibilityIndexer(TarIndexer):
+    # Decides per file whether its data is compressed, records the byte ranges of the stream stored raw
+    def __init__(self):
+        super(CompressibilityIndexer, self).__init__()
+        self.raw_ranges = []
+        self.undecided = None
+        self.sample = bytearray()
+        self.raw_files = 0
+
+    def on_header(self, header):
+        if header["type"] not in "07\0" or header["size"] < MIN_SAMPLE:
+            return
+        # The header was just consumed, the data starts here
+        data_range = (self.offset, self.offset + header["size"])
+        if header["path"].rpartition(".")[2].lower() in COMPRESSED_EXTENSIONS:
+            self.add_raw(data_range)
+        else:
+            self.undecided = data_range
+            self.sample = bytearray()
+
+    def on_data(self, data):
+        if self.undecided:
+            self.sample += data[:SAMPLE_SIZE - len(self.sample)]
+            if len(self.sample) >= SAMPLE_SIZE:
+                self.decide()
+
+    def on_end(self):
+        if self.undecided:
+            self.decide()
+
+    def decide(self):
+        if is_incompressible(bytes(self.sample)):
+            self.add_raw(self.undecided)
+        self.undecided = None
+        self.sample = bytearray()
+
+    def add_raw(self, data_range):
+        self.raw_ranges.append(data_range)
+        self.raw_files += 1
+
+    def decided_until(self):
+        # Bytes before this offset are classified for good
+        return self.undecided[0] if self.undecided else self.offset
+
+
+class AdaptiveZstdCompress(NativeZstdCompress):
+    # Compresses the tar stream like zstd, except the data of incompressible files which goes into raw zstd blocks.
+    # The output is a sequence of ordinary zstd frames, zstd -d restores it unchanged.
+    def __init__(self, compression, input, chunk_size=READ_SIZE):
+        super(AdaptiveZstdCompress, self).__init__(compression, input, chunk_size)
+        self.args = ["zstd-adaptive"]
+        self.indexer = CompressibilityIndexer()
+        self.compressor_obj = None
+        self.raw_open = False
+        self.raw_bytes = 0
+
+    def run(self):
+        try:
+            self.compress()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def compress(self):
+        import zstandard
+
+        pending = bytearray()
+        # Stream offset of the first byte in pending
+        pending_start = 0
+        while True:
+            data = self.input.read(self.chunk_size)
+            if data:
+                self.indexer.feed(data)
+                pending += data
+            # Everything after the start of a file that is still being sampled has to wait for the decision
+            until = self.indexer.decided_until() if data else pending_start + len(pending)
+            self.emit(pending_start, bytes(pending[:until - pending_start]))
+            del pending[:until - pending_start]
+            pending_start = until
+            if not data:
+                break
+
+        self.end_raw()
+        if self.compressor_obj:
+            self.output.write(self.compressor_obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+
+    def emit(self, start, data):
+        ranges = self.indexer.raw_ranges
+        pos = start
+        end = start + len(data)
+        while pos < end:
+            # Ranges are in stream order, drop the ones already written
+            while ranges and ranges[0][1] <= pos:
+                ranges.pop(0)
+            if ranges and ranges[0][0] <= pos:
+                stop = min(end, ranges[0][1])
+                self.write_raw(data[pos - start:stop - start])
+            else:
+                stop = min(end, ranges[0][0]) if ranges else end
+                self.write_compressed(data[pos - start:stop - start])
+            pos = stop
+
+    def write_compressed(self, data):
+        self.end_raw()
+        if not self.compressor_obj:
+            self.compressor_obj = self.compressor().compressobj()
+        self.output.write(self.compressor_obj.compress(data))
+
+    def write_raw(self, data):
+        import zstandard
+
+        if self.compressor_obj:
+            # A frame can only hold one kind of content here, finish the compressed one
+            self.output.write(self.compressor_obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+            self.compressor_obj = None
+        if not self.raw_open:
+            self.output.write(RAW_FRAME_HEADER)
+            self.raw_open = True
+        self.output.write(raw_blocks(data))
+        self.raw_bytes += len(data)
+
+    def end_raw(self):
+        if self.raw_open:
+            self.output.write(raw_blocks(b"", last=True))
+            self.raw_open = False
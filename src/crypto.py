@@ -0,0 +1,178 @@
+import os
+import secrets
+import struct
+import threading
+
+# Stream format written by the native encryption stage:
+#   magic (8) | salt (16) | segment size (4) | segments
+# Every segment holds segment size bytes of plaintext (the last one may be shorter) followed by
+# a 16 byte GCM tag. The nonce is the segment number plus a flag marking the last segment, so
+# reordered, dropped or truncated segments fail authentication.
+GCM_CIPHER = "aes-256-gcm-stream"
+MAGIC = b"PYABGCM1"
+SALT_SIZE = 16
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + SALT_SIZE + 4
+SEGMENT_SIZE = 1024 * 1024
+
+
+def native_crypto_available():
+    import importlib.util
+    return importlib.util.find_spec("cryptography") is not None
+
+
+def generate_key():
+    return secrets.token_hex(16)
+
+
+def derive_key(passphrase, salt):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=MAGIC).derive(passphrase.encode("utf-8"))
+
+
+def nonce(index, last):
+    return struct.pack(">QI", index, 1 if last else 0)
+
+
+def parse_header(header):
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("not an encrypted pyawsbackup stream")
+    salt = header[len(MAGIC):len(MAGIC) + SALT_SIZE]
+    segment_size = struct.unpack(">I", header[len(MAGIC) + SALT_SIZE:HEADER_SIZE])[0]
+    return salt, segment_size
+
+
+def encrypt_asymmetric(cert, data):
+    # PKCS#1 v1.5 like openssl rsautl, metafiles stay readable by either implementation
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+    with open(cert, "rb") as f:
+        public_key = load_pem_public_key(f.read())
+    return public_key.encrypt(data, padding.PKCS1v15())
+
+
+def decrypt_asymmetric(key, data):
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    with open(key, "rb") as f:
+        private_key = load_pem_private_key(f.read(), password=None)
+    return private_key.decrypt(data, padding.PKCS1v15())
+
+
+class SegmentDecryptor:
+    # Decrypts single segments, used for sequential streams as well as range reads
+    def __init__(self, passphrase, header):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        salt, self.segment_size = parse_header(header)
+        self.aead = AESGCM(derive_key(passphrase, salt))
+
+    def stored_size(self, index):
+        # Offset of segment index in the stored object
+        return HEADER_SIZE + index * (self.segment_size + TAG_SIZE)
+
+    def decrypt(self, index, segment, last):
+        return self.aead.decrypt(nonce(index, last), segment, None)
+
+
+class CryptoStage(threading.Thread):
+    # Common plumbing of the in-process stages, behaves like a Popen with stdin and stdout pipes
+    def __init__(self, input):
+        super(CryptoStage, self).__init__(daemon=True)
+        self.returncode = None
+        self.error = None
+
+        if input:
+            # The pipeline closes its copy of the previous stage's stdout, keep our own
+            self.stdin = None
+            self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        else:
+            r, w = os.pipe()
+            self.stdin = os.fdopen(w, "wb")
+            self.input = os.fdopen(r, "rb")
+
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            self.process()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"{self.args[0]} failed: {self.error!r}")
+        return self.returncode
+
+
+class NativeEncrypt(CryptoStage):
+    def __init__(self, passphrase, input, segment_size=SEGMENT_SIZE, salt=None):
+        super(NativeEncrypt, self).__init__(input)
+        self.passphrase = passphrase
+        self.segment_size = segment_size
+        self.salt = salt
+        self.args = ["aes-256-gcm-encrypt"]
+
+    def process(self):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        salt = self.salt or os.urandom(SALT_SIZE)
+        aead = AESGCM(derive_key(self.passphrase, salt))
+        self.output.write(MAGIC + salt + struct.pack(">I", self.segment_size))
+
+        # Read one segment ahead to know which segment is the last one
+        index = 0
+        segment = self.input.read(self.segment_size)
+        while True:
+            following = self.input.read(self.segment_size) if len(segment) == self.segment_size else b""
+            last = not following
+            self.output.write(aead.encrypt(nonce(index, last), segment, None))
+            if last:
+                return
+            segment = following
+            index += 1
+
+
+class NativeDecrypt(CryptoStage):
+    def __init__(self, passphrase, input):
+        super(NativeDecrypt, self).__init__(input)
+        self.passphrase = passphrase
+        self.args = ["aes-256-gcm-decrypt"]
+
+    def process(self):
+        decryptor = SegmentDecryptor(self.passphrase, self.input.read(HEADER_SIZE))
+        stored_segment = decryptor.segment_size + TAG_SIZE
+
+        index = 0
+        segment = self.input.read(stored_segment)
+        while True:
+            following = self.input.read(stored_segment) if len(segment) == stored_segment else b""
+            self.output.write(decryptor.decrypt(index, segment, not following))
+            if not following:
+                return
+            segment = following
+            index += 1
+
+
+def get_encrypt_pipe(key, input, salt=None):
+    stage = NativeEncrypt(key, input, salt=salt)
+    stage.start()
+    return stage
+
+
+def get_decrypt_pipe(key, input):
+    stage = NativeDecrypt(key, input)
+    stage.start()
+    return stage
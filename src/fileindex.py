@@ -0,0 +1,111 @@
+import heapq
+import os
+import sqlite3
+from fnmatch import fnmatchcase
+from catalog import catalog_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (date TEXT PRIMARY KEY, entries INTEGER);
+CREATE TABLE IF NOT EXISTS entries (date TEXT, path BLOB, type TEXT, size INTEGER, mtime REAL, sha256 BLOB,
+                                    PRIMARY KEY (date, path)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_sha256 ON entries (sha256) WHERE sha256 IS NOT NULL;
+"""
+
+# Indexing inserts into two b-trees in file list order, a large page cache keeps them from thrashing
+CACHE_SIZE_KIB = 256 * 1024
+
+SELECT = "SELECT date, path, type, size, mtime, sha256 FROM entries"
+# Rows inserted per executemany, bounds the memory used while indexing a large file list
+INSERT_BATCH = 10000
+
+
+def file_index_path(bucket, jobname):
+    return os.path.join(os.path.dirname(catalog_path()), "fileindex", bucket, f"{jobname}.sqlite")
+
+
+def literal_prefix(pattern):
+    # Part of a glob pattern before its first wildcard, every match starts with it
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+def prefix_end(prefix):
+    # Smallest byte string greater than every string starting with prefix, None if there is none
+    prefix = prefix.rstrip(b"\xff")
+    return prefix[:-1] + bytes([prefix[-1] + 1]) if prefix else None
+
+
+class FileIndex:
+    # Local index of the file lists of every backup of a job, a backup's list never changes once uploaded
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def dates(self):
+        return [row[0] for row in self.db.execute("SELECT date FROM snapshots ORDER BY date")]
+
+    def add(self, date, entries):
+        # entries yields (path, mtree attrs), the snapshot only counts as indexed once all of them are in
+        count = 0
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE date = ?", (date,))
+            batch = []
+            for path, attrs in entries:
+                size = attrs.get("size")
+                mtime = attrs.get("time")
+                digest = attrs.get("sha256digest")
+                batch.append((date, os.fsencode(path), attrs.get("type", "file"), int(size) if size else None,
+                              float(mtime) if mtime else None, bytes.fromhex(digest) if digest else None))
+                if len(batch) == INSERT_BATCH:
+                    count += self.insert(batch)
+                    batch = []
+            count += self.insert(batch)
+            self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?)", (date, count))
+        return count
+
+    def insert(self, batch):
+        self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", batch)
+        return len(batch)
+
+    def forget(self, date):
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE date = ?", (date,))
+            self.db.execute("DELETE FROM snapshots WHERE date = ?", (date,))
+
+    def query(self, dates, pattern=None, sha256=None):
+        # Yields (date, path, type, size, mtime, sha256) of the entries of dates, ordered by path and date
+        if sha256:
+            # Few entries share a digest, the digest index finds them across all snapshots
+            dates = set(dates)
+            rows = [row for row in self.db.execute(f"{SELECT} WHERE sha256 = ?", (bytes.fromhex(sha256),))
+                    if row[0] in dates]
+            rows.sort(key=lambda row: (row[1], row[0]))
+        else:
+            rows = heapq.merge(*[self.snapshot(date, pattern) for date in dates], key=lambda row: (row[1], row[0]))
+
+        for row in rows:
+            path = os.fsdecode(row[1])
+            if pattern and not fnmatchcase(path, pattern):
+                continue
+            yield (row[0], path) + tuple(row[2:5]) + (row[5].hex() if row[5] else None,)
+
+    def snapshot(self, date, pattern=None):
+        # Rows of one snapshot ordered by path, the literal prefix of pattern narrows them to a range of the primary key
+        sql = f"{SELECT} WHERE date = ?"
+        args = [date]
+        prefix = os.fsencode(literal_prefix(pattern)) if pattern else b""
+        if prefix:
+            sql += " AND path >= ?"
+            args.append(prefix)
+            end = prefix_end(prefix)
+            if end:
+                sql += " AND path < ?"
+                args.append(end)
+        return self.db.execute(sql + " ORDER BY path", args)
@@ -1,9 +1,17 @@
 import subprocess
+import click
 import sys
-import os
-from utils import color_macro, s3_url
-from clint.textui import puts, colored
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from utils import color_macro, parse_date
+from fileindex import FileIndex, file_index_path
+from mtree import iter_mtree
+from restore import discard_pipeline, fetch_meta, iter_pipeline, open_list
+from clint.textui import puts, colored
+
+# ls style type column of the mtree entry types
+TYPE_CHARS = {"file": "-", "dir": "d", "link": "l", "char": "c", "block": "b", "fifo": "p"}
 
 def do_list_buckets(color):
     cyan = color_macro(color, colored.cyan)
@@ -12,81 +20,125 @@ def do_list_buckets(color):
         [date, name] = line.rsplit(" ", 1)
         puts(cyan(name))
 
-def do_list(jobname, color, bucket):
+def do_list(jobname, color, catalog):
     cyan = color_macro(color, colored.cyan)
 
     try:
-        out = subprocess.check_output(["aws", "s3", "ls", s3_url(bucket, None)]).decode("utf-8")
+        jobs = catalog.jobs()
     except:
-        raise RuntimeError(f"Could not list bucket {bucket}, please double check the name")
-
-    backups = [x.rsplit(" ", 1)[1].strip("/") for x in out.splitlines()]
-    backup_map = dict()
-    for backup in backups:
-        if jobname and not jobname == backup:
-            continue
-
-        try:
-            dir_out = subprocess.check_output(["aws", "s3", "ls", s3_url(bucket, backup + "/")]).decode("utf-8")
-        except:
-            raise RuntimeError(f"Could not list bucket {bucket}, please double check the name")
-
-        backup_map[backup] = [x.rsplit(" ", 1)[1].strip("/") for x in dir_out.splitlines()]
+        raise RuntimeError(f"Could not list bucket {catalog.bucket}, please double check the name")
 
     if jobname:
-        for date in backup_map[jobname]:
+        for date in catalog.dates(jobname):
             puts(date)
     else:
-        for backup in backups:
-            dates_sorted = sorted(backup_map[backup])
-            most_recent = dates_sorted[-1]
-            puts(f"{cyan(backup)}\t\t {most_recent}")
+        for backup in jobs:
+            most_recent = catalog.latest(backup)
+            if most_recent:
+                puts(f"{cyan(backup)}\t\t {most_recent}")
+
+
+def open_file_list(bucket, jobname, date, key, backup_content, engine):
+    meta = fetch_meta(bucket, jobname, date, key, backup_content, engine)
+    return open_list(bucket, jobname, date, "list", meta, backup_content, engine)
+
+
+def discard_file_list(future):
+    # Lists opened ahead of a failure are not read any more
+    if not future.cancelled() and not future.exception() and future.result():
+        discard_pipeline(future.result())
+
 
+def format_time(mtime):
+    return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S") if mtime is not None else "-"
 
-def do_list_filelist(color, date, bucket, jobname):
+
+def do_list_filelist(color, date, all_dates, key, pattern, sha256, engine, catalog, concurrency, bucket, jobname):
     cyan = color_macro(color, colored.cyan)
     red = color_macro(color, colored.red)
     green = color_macro(color, colored.green)
     yellow = color_macro(color, colored.yellow)
 
-    if not date:
+    if all_dates:
+        try:
+            dates = catalog.dates(jobname)
+        except:
+            raise RuntimeError(f"Could not list bucket {bucket}/{jobname}, please double check the name and jobname")
+        if not dates:
+            raise RuntimeError(f"No backups found for {bucket}/{jobname}, please double check the name and jobname")
+        print(f"Searching {cyan(str(len(dates)))} backups", file=sys.stderr)
+    elif not date:
         print("No date supplied, listing most recent backup", file=sys.stderr)
         try:
-            out = subprocess.check_output(["aws", "s3", "ls", s3_url(bucket, jobname + "/")]).decode("utf-8")
+            date = catalog.latest(jobname)
         except:
             raise RuntimeError(f"Could not list bucket {bucket}/{jobname}, please double check the name and jobname")
-
-        dates = [x.rsplit(" ", 1)[1].strip("/") for x in out.splitlines()]
-        dates_sorted = sorted(dates)
-        date = dates_sorted[-1]
+        if not date:
+            raise RuntimeError(f"No backups found for {bucket}/{jobname}, please double check the name and jobname")
         print(f"Most recent backup: {yellow(date)}", file=sys.stderr)
+        dates = [date]
     else:
-        try:
-            datetime.strptime(date, "%Y-%m-%d_%H-%M-%S")
-        except:
-            raise RuntimeError(f"date ({date}) has invalid date format, expected %Y-%m-%d_%H-%M-%S")
+        parse_date(date)
 
-        try:
-            print(f"Checking if backup for {yellow(date)} exists...", end="", file=sys.stderr)
-            # Check if backup with that date actually exists
-            out = subprocess.check_call(
-                ["aws", "s3", "ls", s3_url(bucket, os.path.join(jobname, date))],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            print(green("OK"))
-        except:
-            print()
+        print(f"Checking if backup for {yellow(date)} exists...", end="", file=sys.stderr)
+        if not catalog.has_date(jobname, date):
+            print(file=sys.stderr)
             raise click.BadOptionUsage("date", red(f"No backup found for date {date}"))
+        print(green("OK"), file=sys.stderr)
+        dates = [date]
 
-    # List contents of folder
+    index = FileIndex(file_index_path(bucket, jobname))
     try:
-        backup_files = subprocess.check_output(
-            ["aws", "s3", "ls", s3_url(bucket, os.path.join(jobname, date) + "/")]
-        ).decode("utf-8")
-        backup_files = [x.rsplit(" ", 1)[1].strip("/") for x in backup_files.splitlines()]
-    except:
-        raise RuntimeError(f"Could not list contents of {bucket}/{jobname}/{date}")
-
-
-
+        if all_dates:
+            # Backups deleted since they were indexed must not show up in the results
+            for stale in set(index.dates()) - set(dates):
+                index.forget(stale)
+
+        # File lists are downloaded and parsed once, later queries only read the local index
+        indexed = set(index.dates())
+        missing = [d for d in dates if d not in indexed]
+        if missing:
+            print(f"Indexing file lists of {cyan(str(len(missing)))} backups...", end="", file=sys.stderr, flush=True)
+            try:
+                contents = [catalog.files(jobname, d) for d in missing]
+            except:
+                raise RuntimeError(f"Could not list contents of {bucket}/{jobname}")
+
+            def index_list(d, future):
+                pipe = future.result()
+                if pipe is None:
+                    print(f"\n{yellow('Warning')}: backup {d} has no file list", end="", file=sys.stderr)
+                    return
+                index.add(d, iter_mtree(iter_pipeline(pipe)))
+
+            # Up to concurrency lists are downloaded while the oldest one is parsed into the index
+            window = deque()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                try:
+                    for d, backup_content in zip(missing, contents):
+                        window.append((d, executor.submit(open_file_list, bucket, jobname, d, key, backup_content,
+                                                          engine)))
+                        if len(window) >= concurrency:
+                            index_list(*window.popleft())
+                    while window:
+                        index_list(*window.popleft())
+                finally:
+                    for _, future in window:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+                    for _, future in window:
+                        discard_file_list(future)
+            print(green("DONE"), file=sys.stderr)
+
+        # Paths in the file lists are relative to /
+        matches = 0
+        for entry_date, path, entry_type, size, mtime, digest in index.query(dates, pattern and pattern.lstrip("/"),
+                                                                            sha256):
+            columns = [entry_date] if all_dates else []
+            columns += [TYPE_CHARS.get(entry_type, "?"), f"{size if size is not None else '-':>12}",
+                        format_time(mtime), path]
+            print("  ".join(columns))
+            matches += 1
+        print(f"{cyan(str(matches))} entries", file=sys.stderr)
+    finally:
+        index.close()
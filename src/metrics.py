@@ -0,0 +1,199 @@
+import json
+import os
+import resource
+import socket
+import subprocess
+import threading
+import time
+
+READ_SIZE = 1024 * 1024
+
+
+class Meter(threading.Thread):
+    # Pass-through stage between two stages, counts bytes and the time spent waiting on either side
+    def __init__(self, input):
+        super(Meter, self).__init__(daemon=True)
+        self.args = ["meter"]
+        self.returncode = None
+        self.error = None
+        self.bytes = 0
+        self.read_wait = 0
+        self.write_wait = 0
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.dup(input.fileno())
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = w
+
+    def run(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                # os.read returns whatever is available, a buffered read would wait for a full block
+                data = os.read(self.input, READ_SIZE)
+                self.read_wait += time.perf_counter() - start
+                if not data:
+                    break
+                self.bytes += len(data)
+
+                start = time.perf_counter()
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(self.output, view):]
+                self.write_wait += time.perf_counter() - start
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            os.close(self.input)
+            os.close(self.output)
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Metering failed: {self.error}")
+        return self.returncode
+
+
+def stage_name(stage):
+    return os.path.basename(str(stage.args[0]))
+
+
+class Metrics:
+    # Collects per stage throughput of a pipeline, meters are only inserted when metrics are requested
+    def __init__(self, json_path=None, textfile=None, statsd=None):
+        self.json_path = json_path
+        self.textfile = textfile
+        self.statsd = statsd
+        self.start = time.perf_counter()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = dict()
+        self.stages = dict()
+
+    def begin(self):
+        # Only the data pipeline counts, not the time spent looking up previous backups
+        self.start = time.perf_counter()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    def meter(self, upstream):
+        meter = Meter(upstream.stdout)
+        meter.start()
+        return meter
+
+    def wait(self, stage):
+        if not isinstance(stage, subprocess.Popen) or stage.returncode is not None:
+            return stage.wait()
+        # Reap the child ourselves to get its resource usage, Popen.wait discards it
+        _, status, usage = os.wait4(stage.pid, 0)
+        stage.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.cpu[id(stage)] = usage.ru_utime + usage.ru_stime
+        return stage.returncode
+
+    def add(self, pipe):
+        # Called once the pipeline finished, several pipelines of one run are summed up per stage
+        for i, stage in enumerate(pipe):
+            if isinstance(stage, Meter):
+                continue
+            meter_in = pipe[i - 1] if i > 0 and isinstance(pipe[i - 1], Meter) else None
+            meter_out = pipe[i + 1] if i + 1 < len(pipe) and isinstance(pipe[i + 1], Meter) else None
+            # A stage waits for input while the meter in front of it waits for the upstream stage,
+            # and blocks on output while the meter behind it cannot hand data on
+            row = {
+                "bytes_in": meter_in.bytes if meter_in else None,
+                "bytes_out": meter_out.bytes if meter_out else None,
+                "read_blocked_seconds": meter_in.read_wait if meter_in else 0,
+                "write_blocked_seconds": meter_out.write_wait if meter_out else 0,
+                "cpu_seconds": self.cpu.get(id(stage)),
+            }
+            total = self.stages.setdefault(stage_name(stage), dict.fromkeys(row))
+            for key, value in row.items():
+                if value is not None:
+                    total[key] = (total[key] or 0) + value
+
+    def report(self, job):
+        duration = time.perf_counter() - self.start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stages = []
+        for name, total in self.stages.items():
+            busy = max(0, duration - total["read_blocked_seconds"] - total["write_blocked_seconds"])
+            stage = {"stage": name}
+            stage.update({k: round(v, 3) if isinstance(v, float) else v for k, v in total.items()})
+            stage["busy_seconds"] = round(busy, 3)
+            stages.append(stage)
+
+        return {
+            "job": job,
+            "duration_seconds": round(duration, 3),
+            # Threads of in-process stages are not accounted separately
+            "process_cpu_seconds": round(usage.ru_utime + usage.ru_stime - self.start_usage.ru_utime -
+                                         self.start_usage.ru_stime, 3),
+            "bottleneck": max(stages, key=lambda s: s["busy_seconds"])["stage"] if stages else None,
+            "stages": stages,
+        }
+
+    def publish(self, command, job):
+        report = self.report(job)
+        if self.json_path:
+            write_json(report, self.json_path)
+        if self.textfile:
+            write_textfile(report, self.textfile, command)
+        if self.statsd:
+            send_statsd(report, self.statsd, command)
+        return report
+
+
+def link(pipe, metrics):
+    # stdout that feeds the next stage, passed through a meter when metrics are collected
+    if metrics:
+        pipe.append(metrics.meter(pipe[-1]))
+    return pipe[-1].stdout
+
+
+def wait_stage(stage, metrics=None):
+    return metrics.wait(stage) if metrics else stage.wait()
+
+
+def write_json(report, path):
+    data = json.dumps(report, indent=2)
+    if path == "-":
+        print(data)
+        return
+    with open(path, "w") as f:
+        f.write(data + "\n")
+
+
+def write_textfile(report, path, command):
+    # Prometheus node exporter textfile format, replaced atomically so a scrape never sees half a file
+    job = report["job"]
+    lines = [
+        f'pyawsbackup_duration_seconds{{command="{command}",job="{job}"}} {report["duration_seconds"]}',
+        f'pyawsbackup_process_cpu_seconds{{command="{command}",job="{job}"}} {report["process_cpu_seconds"]}',
+        f'pyawsbackup_last_run_timestamp_seconds{{command="{command}",job="{job}"}} {int(time.time())}',
+    ]
+    for s in report["stages"]:
+        for key in ("bytes_in", "bytes_out", "read_blocked_seconds", "write_blocked_seconds", "busy_seconds",
+                    "cpu_seconds"):
+            if s[key] is not None:
+                lines.append(f'pyawsbackup_stage_{key}{{command="{command}",job="{job}",stage="{s["stage"]}"}} {s[key]}')
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def send_statsd(report, address, command):
+    host, _, port = address.rpartition(":")
+    prefix = f"pyawsbackup.{command}.{report['job']}"
+    lines = [f"{prefix}.duration_seconds:{report['duration_seconds']}|g",
+             f"{prefix}.process_cpu_seconds:{report['process_cpu_seconds']}|g"]
+    for s in report["stages"]:
+        for key, value in s.items():
+            if key != "stage" and value is not None:
+                lines.append(f"{prefix}.{s['stage']}.{key}:{value}|g")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in lines:
+            sock.sendto(line.encode("utf-8"), (host or "localhost", int(port)))
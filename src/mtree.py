@@ -0,0 +1,223 @@
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from tarstream import TYPES, TarIndexer, TarParseStage
+
+# Keywords that identify a changed entry when comparing two file lists
+DIFF_KEYWORDS = ["type", "mode", "uid", "gid", "uname", "gname", "time", "size", "sha256digest", "link"]
+
+_escape = re.compile(rb"\\([0-7]{3})")
+
+# Files up to this size are hashed inline, handing them to a worker costs more than hashing them
+INLINE_HASH_SIZE = 1024 * 1024
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def unvis(name):
+    # bsdtar escapes whitespace, backslashes and non-printable bytes as \ooo
+    raw = _escape.sub(lambda m: bytes([int(m.group(1), 8)]), name.encode("utf-8", "surrogateescape"))
+    return os.fsdecode(raw)
+
+
+def vis(name):
+    out = []
+    for b in os.fsencode(name):
+        if b <= 0x20 or b >= 0x7f or b in (ord("\\"), ord("#")):
+            out.append(f"\\{b:03o}")
+        else:
+            out.append(chr(b))
+    return "".join(out)
+
+
+def normalize_path(path):
+    # Paths in the mtree are relative to / and prefixed with ./
+    if path.startswith("./"):
+        path = path[2:]
+    return path
+
+
+def parse_mtree(lines):
+    return dict(iter_mtree(lines))
+
+
+def iter_mtree(lines):
+    # Yields (path, attrs) in file order without holding the whole list
+    defaults = dict()
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "surrogateescape")
+        line = line.rstrip("\n")
+        if not line or line.startswith("#"):
+            continue
+
+        fields = line.split(" ")
+        if fields[0] == "/set":
+            defaults.update(dict(f.split("=", 1) for f in fields[1:] if "=" in f))
+            continue
+        if fields[0] == "/unset":
+            for f in fields[1:]:
+                defaults.pop(f, None)
+            continue
+
+        attrs = dict(defaults)
+        attrs.update(dict(f.split("=", 1) for f in fields[1:] if "=" in f))
+        yield normalize_path(unvis(fields[0])), attrs
+
+
+def diff_mtree(old, new):
+    # Returns (changed, deleted) path lists, both sorted
+    changed = []
+    for path, attrs in new.items():
+        prev = old.get(path)
+        # Only compare what both lists record, a stat-only list carries no digests
+        if prev is None or any(not same_value(k, prev.get(k), attrs[k]) for k in DIFF_KEYWORDS if k in attrs):
+            changed.append(path)
+
+    deleted = [path for path in old if path not in new]
+    return sorted(changed), sorted(deleted)
+
+
+def same_value(keyword, old, new):
+    if keyword == "time" and old and ("." not in old or "." not in new):
+        # Plain tar headers only store whole seconds
+        return old.split(".")[0] == new.split(".")[0]
+    return old == new
+
+
+class HashPool:
+    # Hashes large files on worker threads, all chunks of a file go to the same worker so they stay in order
+    def __init__(self, workers):
+        self.lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+        self.next = 0
+        # Bounds the chunks waiting for a worker
+        self.slots = threading.BoundedSemaphore(workers * 4)
+
+    def start(self):
+        lane = self.lanes[self.next]
+        self.next = (self.next + 1) % len(self.lanes)
+        return lane, hashlib.sha256()
+
+    def update(self, file, data):
+        lane, hash = file
+        self.slots.acquire()
+        lane.submit(self.hash_chunk, hash, data)
+
+    def hash_chunk(self, hash, data):
+        try:
+            hash.update(data)
+        finally:
+            self.slots.release()
+
+    def finish(self, file):
+        lane, hash = file
+        return lane.submit(hash.hexdigest)
+
+    def close(self):
+        for lane in self.lanes:
+            lane.shutdown()
+
+
+class ManifestBuilder(TarIndexer):
+    # Builds mtree entries with sha256 digests from the tar stream, so the files are only read once.
+    # Files the stat cache knows unchanged are not hashed at all.
+    def __init__(self, stat_cache=None, workers=HASH_WORKERS):
+        super(ManifestBuilder, self).__init__()
+        self.entries = dict()
+        self.current = None
+        self.hash = None
+        self.file = None
+        self.stat_cache = stat_cache
+        self.pool = HashPool(workers) if workers > 1 else None
+
+    def on_header(self, header):
+        attrs = {
+            "type": TYPES.get(header["type"], "file"),
+            "uid": str(header["uid"]),
+            "gid": str(header["gid"]),
+            "mode": f"{header['mode']:o}",
+            "time": header["mtime"],
+        }
+        if header["uname"]:
+            attrs["uname"] = vis(os.fsdecode(header["uname"]))
+        if header["gname"]:
+            attrs["gname"] = vis(os.fsdecode(header["gname"]))
+
+        if header["type"] == "2":
+            attrs["link"] = vis(os.fsdecode(header["link"]))
+        elif header["type"] == "1":
+            # Hard links share the contents of an entry earlier in the archive
+            target = self.entries.get(os.fsdecode(header["link"]).rstrip("/"), dict())
+            for k in ("size", "sha256digest"):
+                if k in target:
+                    attrs[k] = target[k]
+        elif attrs["type"] == "file":
+            attrs["size"] = str(header["size"])
+            digest, key = None, None
+            if self.stat_cache:
+                digest, key = self.stat_cache.lookup(header["path"], header["size"], header["mtime"])
+            if digest:
+                attrs["sha256digest"] = digest
+            elif self.pool and header["size"] > INLINE_HASH_SIZE:
+                self.file = self.pool.start()
+            else:
+                self.hash = hashlib.sha256()
+            if key:
+                self.stat_cache.add(header["path"], key, attrs)
+
+        self.current = attrs
+        self.entries[header["path"]] = attrs
+
+    def on_data(self, data):
+        if self.hash:
+            self.hash.update(data)
+        elif self.file:
+            self.pool.update(self.file, data)
+
+    def on_end(self):
+        if self.hash:
+            self.current["sha256digest"] = self.hash.hexdigest()
+        elif self.file:
+            # Resolved by resolve() once the stream ended
+            self.current["sha256digest"] = self.pool.finish(self.file)
+        self.current = None
+        self.hash = None
+        self.file = None
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
+    def resolve(self):
+        for attrs in self.entries.values():
+            if isinstance(attrs.get("sha256digest"), Future):
+                attrs["sha256digest"] = attrs["sha256digest"].result()
+        return self.entries
+
+
+class ManifestStage(TarParseStage):
+    def __init__(self, input, stat_cache=None):
+        super(ManifestStage, self).__init__(ManifestBuilder(stat_cache), input, "mtree")
+
+    def run(self):
+        try:
+            super(ManifestStage, self).run()
+        finally:
+            self.parser.close()
+
+    def entries(self):
+        return self.parser.resolve()
+
+
+def get_manifest_pipe(input, stat_cache=None):
+    stage = ManifestStage(input, stat_cache)
+    stage.start()
+    return stage
+
+
+def write_mtree(entries, f):
+    f.write(b"#mtree\n")
+    for path, attrs in entries.items():
+        fields = ["./" + vis(path)] + [f"{k}={v}" for k, v in attrs.items()]
+        f.write(" ".join(fields).encode("utf-8", "surrogateescape") + b"\n")
@@ -0,0 +1,350 @@
+import grp
+import os
+import pwd
+import stat
+import struct
+import sys
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from tarstream import BLOCK, READ_SIZE
+
+# Files up to this size are read whole by the workers, of larger ones only the start, the writer streams the rest
+PREFETCH_SIZE = 256 * 1024
+# Data read ahead of the writer by all workers together, files past it are only stat'ed ahead
+PREFETCH_MEMORY = 64 * 1024 * 1024
+# Entries handled by one pool task, larger batches spend less time handing work between threads
+BATCH_SIZE = 64
+# Batches in flight per worker
+BATCHES_AHEAD = 2
+# Subdirectories listed ahead of the walk in every directory on its current path
+LIST_AHEAD = 8
+# GNU tar pads the archive to its default record size of 20 blocks
+RECORD_SIZE = 20 * BLOCK
+
+# ustar fields of a GNU tar header, magic and version run together as "ustar  \0"
+GNU_HEADER = struct.Struct("100s8s8s8s12s12s8s1s100s8s32s32s8s8s167x")
+GNU_MAGIC = b"ustar  \0"
+
+# Exit codes of GNU tar, 1 if files changed or vanished while they were read, 2 if some could not be read
+CHANGED = 1
+FAILED = 2
+
+
+@lru_cache(maxsize=None)
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@lru_cache(maxsize=None)
+def group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def list_dir(path):
+    # Sorted (name, is directory) of the entries of path, scandir usually knows the type without a stat
+    with os.scandir(path) as it:
+        return sorted((e.name, e.is_dir(follow_symlinks=False)) for e in it)
+
+
+def read_entry(path, prefetch=True):
+    # Stat, open and prefetch, returns (stat, link target, prefetched data, open file or None). Without
+    # prefetch a file is only stat'ed and its data is None.
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return st, os.readlink(path), b"", None
+    if not stat.S_ISREG(st.st_mode) or not st.st_size:
+        return st, "", b"", None
+    if not prefetch:
+        return st, "", None, None
+    f = open(path, "rb")
+    try:
+        data = f.read(min(st.st_size, PREFETCH_SIZE))
+    except BaseException:
+        f.close()
+        raise
+    if st.st_size <= PREFETCH_SIZE:
+        f.close()
+        f = None
+    return st, "", data, f
+
+
+def read_batch(paths, budget):
+    # Runs in the pool, returns the entry or the OSError of every path. Files are prefetched until the
+    # batch holds budget bytes.
+    entries = []
+    for path in paths:
+        try:
+            entry = read_entry(path, budget > 0)
+            budget -= len(entry[2] or b"")
+        except OSError as e:
+            entry = e
+        entries.append(entry)
+    return entries
+
+
+def close_batch(future):
+    # Files prefetched for entries that are no longer written are still open
+    if not future.cancelled() and not future.exception():
+        for entry in future.result():
+            if not isinstance(entry, OSError) and entry[3]:
+                entry[3].close()
+
+
+def tar_info(name, st, linkname):
+    # Header of an entry like GNU tar writes it, None for sockets which tar skips as well
+    info = tarfile.TarInfo(name)
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    elif stat.S_ISDIR(mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+    elif stat.S_ISFIFO(mode):
+        info.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        info.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+        info.devmajor = os.major(st.st_rdev)
+        info.devminor = os.minor(st.st_rdev)
+    else:
+        return None
+    info.mode = stat.S_IMODE(mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.uname = user_name(st.st_uid)
+    info.gname = group_name(st.st_gid)
+    info.mtime = st.st_mtime_ns // 1000000000
+    return info
+
+
+def octal(value, digits):
+    return b"%0*o\0" % (digits - 1, value)
+
+
+def header(info):
+    # tarfile builds headers field by field, which is slow for millions of small files. The common case is
+    # packed here, long names and large values that need GNU extension headers are left to tarfile.
+    name = info.name.encode("utf-8", "surrogateescape") + (b"/" if info.type == tarfile.DIRTYPE else b"")
+    linkname = info.linkname.encode("utf-8", "surrogateescape")
+    uname = info.uname.encode("utf-8", "surrogateescape")
+    gname = info.gname.encode("utf-8", "surrogateescape")
+    if len(name) > 100 or len(linkname) > 100 or len(uname) > 31 or len(gname) > 31 or \
+            not 0 <= info.mtime < 8 ** 11 or info.size >= 8 ** 11 or max(info.uid, info.gid) >= 8 ** 7 or \
+            max(info.devmajor, info.devminor) >= 8 ** 7:
+        return info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+
+    devices = [octal(info.devmajor, 8), octal(info.devminor, 8)] if info.ischr() or info.isblk() else [b"", b""]
+    buf = bytearray(GNU_HEADER.pack(name, octal(info.mode, 8), octal(info.uid, 8), octal(info.gid, 8),
+                                    octal(info.size, 12), octal(info.mtime, 12), b" " * 8, info.type, linkname,
+                                    GNU_MAGIC, uname, gname, *devices))
+    buf[148:156] = b"%06o\0 " % sum(buf)
+    return bytes(buf)
+
+
+class ParallelTar(threading.Thread):
+    # First stage of a backup pipeline, replaces tar -C / -cf - for trees whose files are slow to open and stat.
+    # A pool of workers lists directories, stats and prefetches files ahead of the writer, which emits the entries
+    # of one archive in a deterministic depth first name order.
+    def __init__(self, folder, filelist=None, workers=8):
+        super(ParallelTar, self).__init__(daemon=True)
+        self.folder = folder
+        self.filelist = filelist
+        self.workers = workers
+        self.args = ["partar", str(workers)]
+        self.returncode = None
+        self.error = None
+        self.status = 0
+        self.written = 0
+        self.executor = None
+        self.links = dict()
+
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb", buffering=READ_SIZE)
+
+    def warn(self, path, message, status):
+        print(f"partar: {path.lstrip('/')}: {message}", file=sys.stderr, flush=True)
+        self.status = max(self.status, status)
+
+    def failed(self, path, e):
+        # Vanished files are not an error, tar reports them with exit code 1 as well
+        if isinstance(e, FileNotFoundError):
+            self.warn(path, "File removed before we read it", CHANGED)
+        else:
+            self.warn(path, f"Cannot open: {e.strerror or e}", FAILED)
+
+    def paths(self):
+        # Yields the absolute paths to archive, relative paths are relative to / like tar -C / sees them
+        if self.filelist:
+            # Only the NUL separated paths in filelist, directories are not descended into
+            with open(self.filelist, "rb") as f:
+                for path in f.read().split(b"\0"):
+                    if path:
+                        yield os.path.join("/", os.fsdecode(path))
+            return
+
+        root = os.path.normpath(os.path.join("/", self.folder))
+        yield root
+        if os.path.isdir(root) and not os.path.islink(root):
+            stack = [self.children(root, self.executor.submit(list_dir, root))]
+            while stack:
+                child = next(stack[-1], None)
+                if child is None:
+                    stack.pop()
+                    continue
+                path, listing = child
+                yield path
+                if listing:
+                    stack.append(self.children(path, listing))
+
+    def children(self, path, listing):
+        # Yields (path, listing or None) of the entries of a directory, the next subdirectories are listed ahead
+        try:
+            entries = listing.result()
+        except OSError as e:
+            self.failed(path, e)
+            return
+        ahead = iter([os.path.join(path, name) for name, is_dir in entries if is_dir])
+        listings = dict()
+
+        def list_ahead(n):
+            for subdir in islice(ahead, n):
+                listings[subdir] = self.executor.submit(list_dir, subdir)
+
+        list_ahead(LIST_AHEAD)
+        for name, is_dir in entries:
+            child = os.path.join(path, name)
+            if is_dir:
+                list_ahead(1)
+                yield child, listings.pop(child)
+            else:
+                yield child, None
+
+    def batches(self):
+        paths = self.paths()
+        while True:
+            batch = list(islice(paths, BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+    def run(self):
+        window = deque()
+        ahead = self.workers * BATCHES_AHEAD
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                self.executor = executor
+                try:
+                    for batch in self.batches():
+                        window.append((batch, executor.submit(read_batch, batch, PREFETCH_MEMORY // ahead)))
+                        if len(window) >= ahead:
+                            self.write_batch(*window.popleft())
+                    while window:
+                        self.write_batch(*window.popleft())
+                finally:
+                    for _, future in window:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+                    for _, future in window:
+                        close_batch(future)
+
+            # End of archive marker, padded to a full record
+            self.write(bytes(2 * BLOCK))
+            self.write(bytes(-self.written % RECORD_SIZE))
+            self.returncode = self.status
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.output.close()
+
+    def write(self, data):
+        self.output.write(data)
+        self.written += len(data)
+
+    def write_batch(self, paths, future):
+        entries = future.result()
+        for i, (path, entry) in enumerate(zip(paths, entries)):
+            try:
+                self.write_entry(path, entry)
+            except BaseException:
+                for later in entries[i + 1:]:
+                    if not isinstance(later, OSError) and later[3]:
+                        later[3].close()
+                raise
+
+    def write_entry(self, path, entry):
+        if isinstance(entry, OSError):
+            self.failed(path, entry)
+            return
+        st, linkname, data, f = entry
+        if data is None:
+            # Past the prefetch budget, the file is opened here
+            try:
+                st, linkname, data, f = read_entry(path)
+            except OSError as e:
+                self.failed(path, e)
+                return
+
+        try:
+            name = path.lstrip("/") or "."
+            info = tar_info(name, st, linkname)
+            if info is None:
+                self.warn(path, "socket ignored", 0)
+                return
+            if info.type != tarfile.DIRTYPE and st.st_nlink > 1:
+                # Later names of a file with several hard links only refer to the first one
+                first = self.links.setdefault((st.st_dev, st.st_ino), name)
+                if first != name:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = first
+                    info.size = 0
+            if not info.size:
+                self.write(header(info))
+                return
+
+            # A file that grew is cut at the size in its header, one that shrank is padded with zeros
+            left = info.size - len(data)
+            if not left:
+                # Small files go out in a single write
+                self.write(header(info) + data + bytes(-info.size % BLOCK))
+                return
+            self.write(header(info))
+            self.write(data)
+            while f and left > 0:
+                data = f.read(min(READ_SIZE, left))
+                if not data:
+                    break
+                self.write(data)
+                left -= len(data)
+            if left > 0:
+                self.status = max(self.status, CHANGED)
+                self.write(bytes(left))
+            self.write(bytes(-info.size % BLOCK))
+        finally:
+            if f:
+                f.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Archiving failed: {self.error}")
+        return self.returncode
+
+
+def get_partar_pipe(folder, filelist=None, workers=8):
+    stage = ParallelTar(folder, filelist, workers)
+    stage.start()
+    return stage
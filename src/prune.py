@@ -0,0 +1,184 @@
+import json
+import os
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from catalog import list_objects
+from chunkstore import CHUNK_PREFIX, ChunkStore, Lease, chunk_key, live_leases
+from clint.textui import colored, puts
+from restore import fetch_base
+from utils import color_macro, parse_date
+
+# DeleteObjects accepts at most this many keys per request
+DELETE_BATCH = 1000
+# Objects deleted before this many days in their class are billed for the remaining days anyway
+MIN_STORAGE_DAYS = {"STANDARD_IA": 30, "ONEZONE_IA": 30, "GLACIER_IR": 90, "GLACIER": 90, "DEEP_ARCHIVE": 180}
+# Chunks younger than this may belong to a chunked backup that has not uploaded its manifest yet
+CHUNK_GRACE = timedelta(days=1)
+
+
+def select_retained(dates, daily, weekly, monthly):
+    # Grandfather-father-son: the newest backup of each of the last daily days, weekly ISO weeks and monthly months.
+    # The most recent backup is always kept.
+    keep = set(sorted(dates)[-1:])
+    for count, period in [(daily, lambda d: d.date()), (weekly, lambda d: d.isocalendar()[:2]),
+                          (monthly, lambda d: (d.year, d.month))]:
+        periods = []
+        for date in sorted(dates, reverse=True):
+            p = period(parse_date(date))
+            if p not in periods:
+                if len(periods) == count:
+                    break
+                periods.append(p)
+                keep.add(date)
+    return keep
+
+
+def modified(obj):
+    # boto3 returns datetimes, the aws cli ISO 8601 strings
+    value = obj["LastModified"]
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value
+
+
+def early_until(objects):
+    # End of the minimum storage duration of the youngest object in a class that has one, or None
+    ends = [modified(o) + timedelta(days=MIN_STORAGE_DAYS[o["StorageClass"]]) for o in objects
+            if o.get("StorageClass") in MIN_STORAGE_DAYS]
+    end = max(ends, default=None)
+    return end if end and end > datetime.now(timezone.utc) else None
+
+
+def delete_batch(bucket, keys, engine=None):
+    # Returns the keys that could not be deleted
+    request = {"Objects": [{"Key": k} for k in keys], "Quiet": True}
+    if engine:
+        response = engine.client.delete_objects(Bucket=bucket, Delete=request)
+    else:
+        out = subprocess.check_output(["aws", "s3api", "delete-objects", "--bucket", bucket, "--delete",
+                                       json.dumps(request), "--output", "json"]).decode("utf-8")
+        response = json.loads(out) if out.strip() else dict()
+    return [f"{e['Key']}: {e.get('Message', e.get('Code'))}" for e in response.get("Errors", [])]
+
+
+def delete_objects(bucket, keys, engine=None, concurrency=8):
+    batches = [keys[i:i + DELETE_BATCH] for i in range(0, len(keys), DELETE_BATCH)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        errors = sum(executor.map(lambda batch: delete_batch(bucket, batch, engine), batches), [])
+    if errors:
+        raise RuntimeError(f"Could not delete {len(errors)} objects, e.g. {errors[0]}")
+
+
+def plan_job(bucket, jobname, key, engine, daily, weekly, monthly, early_deletion):
+    # Returns (kept dates, {date: keys to delete}, {date: end of its minimum storage duration})
+    objects = list_objects(bucket, jobname + "/", engine)
+    backups = dict()
+    for k, obj in objects.items():
+        date, _, name = k[len(jobname) + 1:].partition("/")
+        if name:
+            backups.setdefault(date, dict())[name] = obj
+
+    keep = select_retained(list(backups), daily, weekly, monthly)
+    # Incremental backups cannot be restored without the backups they are based on
+    pending = sorted(keep)
+    while pending:
+        date = pending.pop()
+        base = fetch_base(bucket, jobname, date, key, list(backups[date]), engine)
+        if base and base in backups and base not in keep:
+            keep.add(base)
+            pending.append(base)
+
+    delete = dict()
+    deferred = dict()
+    for date in sorted(set(backups) - keep):
+        until = early_until(backups[date].values()) if not early_deletion else None
+        if until:
+            deferred[date] = until
+        else:
+            delete[date] = [os.path.join(jobname, date, name) for name in backups[date]]
+    return keep, delete, deferred
+
+
+def unreferenced_chunks(bucket, engine, jobs, deleted, early_deletion):
+    # The chunk store is shared by all jobs of the bucket, a chunk is only garbage if no manifest outside deleted uses it
+    store = ChunkStore(engine.client, bucket, concurrency=engine.concurrency)
+    manifests = [k for job in jobs for k in list_objects(bucket, job + "/", engine)
+                 if k.endswith(".chunks") and k not in deleted]
+    referenced = set()
+    with ThreadPoolExecutor(max_workers=engine.concurrency) as executor:
+        for manifest in executor.map(store.read_manifest, manifests):
+            referenced.update(chunk_key(digest, compressed) for digest, _, compressed in manifest)
+
+    now = datetime.now(timezone.utc)
+    return [k for k, obj in list_objects(bucket, CHUNK_PREFIX + "/", engine).items()
+            if k not in referenced and now - modified(obj) > CHUNK_GRACE
+            and (early_deletion or not early_until([obj]))]
+
+
+def do_prune(color, key, engine, catalog, daily, weekly, monthly, early_deletion, dry_run, concurrency, bucket,
+             jobname):
+    # Colors
+    yellow = color_macro(color, colored.yellow)
+    cyan = color_macro(color, colored.cyan)
+    green = color_macro(color, colored.green)
+
+    try:
+        jobs = [jobname] if jobname else catalog.jobs()
+    except:
+        raise RuntimeError(f"Could not list bucket {bucket}, please double check the name")
+
+    puts(f"Pruning {cyan(str(len(jobs)))} jobs in AWS S3 bucket {yellow(bucket)} keeping {daily} daily, {weekly} "
+         f"weekly and {monthly} monthly backups{' (dry-run)' if dry_run else ''}")
+
+    deleted = set()
+    for job in jobs:
+        keep, delete, deferred = plan_job(bucket, job, key, engine, daily, weekly, monthly, early_deletion)
+        keys = sum(delete.values(), [])
+        puts(f"{cyan(job)}: keeping {len(keep)}, deleting {len(delete)} backups ({len(keys)} objects)")
+        for date, until in sorted(deferred.items()):
+            puts(f"  {yellow(date)} kept until {until:%Y-%m-%d}, the end of its minimum storage duration")
+        for date in delete:
+            puts(f"  {date}")
+        deleted.update(keys)
+
+        if keys and not dry_run:
+            print(f"Deleting {len(keys)} objects...", end="", flush=True)
+            delete_objects(bucket, keys, engine, concurrency)
+            for date in delete:
+                catalog.forget(job, date)
+            puts(green("DONE"))
+
+    if not any(k.endswith(".chunks") for k in deleted):
+        return
+    if not engine:
+        puts(f"{yellow('Warning')}: chunks of the deleted chunked backups are only collected with --engine native")
+        return
+
+    # A running chunked backup may reuse a chunk that no uploaded manifest references yet. Its lease keeps the
+    # chunks from being collected, ours makes backups starting from now on wait until we are done.
+    lease = Lease(engine.client, bucket, f"prune/{socket.gethostname()}-{os.getpid()}")
+    if not dry_run:
+        lease.acquire()
+    try:
+        running = live_leases(engine.client, bucket, "backup")
+        if running:
+            puts(f"{yellow('Warning')}: {len(running)} chunked backups are running "
+                 f"({', '.join(os.path.dirname(r[len('backup/'):]) for r in running)}), unreferenced chunks are not "
+                 f"collected, prune again once they are done")
+            return
+
+        # Other jobs share the chunk store, all of their manifests count
+        print("Collecting unreferenced chunks...", end="", flush=True)
+        chunks = unreferenced_chunks(bucket, engine, jobs if jobname is None else catalog.jobs(), deleted,
+                                     early_deletion)
+        puts(green("DONE"))
+        puts(f"{cyan(str(len(chunks)))} chunks no longer referenced by any backup")
+        if chunks and not dry_run:
+            print(f"Deleting {len(chunks)} chunks...", end="", flush=True)
+            delete_objects(bucket, chunks, engine, concurrency)
+            puts(green("DONE"))
+    finally:
+        if not dry_run:
+            lease.release()
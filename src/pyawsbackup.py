@@ -1,10 +1,12 @@
 import click
+import re
+import sys
 from functools import reduce
 from clint.textui import puts, colored
-from utils import check_dependencies, supports_pv, color_macro
-from backup import do_backup
-from list import do_list, do_list_buckets, do_list_filelist
-from restore import do_restore
+from utils import check_dependencies, supports_pv, color_macro, lower_priority, parse_size
+from thaw import TIERS
+
+# Subcommand modules are imported by their command, a call of list should not pay for importing backup and restore
 
 # Custom Click extension
 class RefinementOption(click.Option):
@@ -26,6 +28,12 @@ class RefinementOption(click.Option):
 
         return super(RefinementOption, self).handle_parse_result(ctx, opts, args)
 
+def get_metrics(json_path, textfile, statsd):
+    if json_path or textfile or statsd:
+        from metrics import Metrics
+        return Metrics(json_path, textfile, statsd)
+    return None
+
 # CLI Setup
 @click.group()
 def cli():
@@ -34,8 +42,19 @@ def cli():
 
 @cli.command(name="backup")
 @click.option("--compress", "-c", default=False, is_flag=True)
+@click.option("--compression-level", cls=RefinementOption, refines=["compress"], type=click.IntRange(1, 22), default=3)
+@click.option("--compression-threads", cls=RefinementOption, refines=["compress"], type=click.IntRange(0, None),
+              default=0, help="zstd worker threads, 0 uses all cores")
+@click.option("--long", "long_window", cls=RefinementOption, refines=["compress"], type=click.IntRange(10, 31),
+              help="Enable zstd long distance matching with the given window log")
+@click.option("--native-compression", cls=RefinementOption, refines=["compress"], default=False, is_flag=True,
+              help="Compress in-process with python-zstandard")
+@click.option("--adaptive-compression", cls=RefinementOption, refines=["compress"], default=False, is_flag=True,
+              help="Store files that are already compressed, e.g. media or archives, without compressing them again")
 @click.option("--encrypt", "-e", default=False, is_flag=True)
 @click.option("--cert", cls=RefinementOption, refines=["encrypt"], default="test")
+@click.option("--native-crypto", cls=RefinementOption, refines=["encrypt"], default=False, is_flag=True,
+              help="Encrypt in-process with authenticated AES-256-GCM instead of openssl")
 @click.option("--storage-class", type=click.Choice([
     # Taken from https://docs.aws.amazon.com/cli/latest/reference/s3/cp.html#options
     "STANDARD",
@@ -50,53 +69,264 @@ def cli():
 @click.option("--progress/--no-progress", default=True, is_flag=True)
 @click.option("--color/--no-color", default=True, is_flag=True)
 @click.option("--dry-run", default=False, is_flag=True)
+@click.option("--incremental", "-i", default=False, is_flag=True)
+@click.option("--key", cls=RefinementOption, refines=["incremental", "encrypt"], type=str,
+              help="Private key to read the previous backup of an incremental backup and to resume an encrypted one")
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--part-size", cls=RefinementOption, refines=["engine"], type=click.IntRange(5, 5120), default=64,
+              help="Size in MiB of the first multipart parts, later parts grow so that 10000 parts hold 5 TiB. Uploads "
+                   "buffer (upload-concurrency + 1) parts of this size, or one grown part if it is larger")
+@click.option("--upload-concurrency", cls=RefinementOption, refines=["engine"], type=click.IntRange(1, 64), default=8)
+@click.option("--resume/--no-resume", cls=RefinementOption, refines=["engine"], default=True, is_flag=True,
+              help="Continue an interrupted backup of the job from its checkpoint instead of starting over. The checkpoint "
+                   "keeps the keys of an encrypted backup wrapped with --cert, resuming it requires --key")
+@click.option("--chunked", cls=RefinementOption, refines=["engine"], default=False, is_flag=True,
+              help="Store the backup as deduplicated chunks in the bucket-level chunk store")
+@click.option("--chunk-size", cls=RefinementOption, refines=["chunked"], type=click.Choice(["256", "512", "1024", "2048", "4096"]),
+              default="1024", help="Average chunk size in KiB")
+@click.option("--seekable", default=False, is_flag=True,
+              help="Write independent zstd frames and an archive index so single paths can be restored")
+@click.option("--stat-cache/--no-stat-cache", default=True, is_flag=True,
+              help="Skip hashing files whose size, times and inode did not change since the last backup")
+@click.option("--volume-size", type=str,
+              help="Split the archive into volumes of about this size at file boundaries, e.g. 4G")
+@click.option("--volume-concurrency", cls=RefinementOption, refines=["volume_size"], type=click.IntRange(1, 64),
+              default=2, help="Volumes compressed and uploaded at the same time")
+@click.option("--read-concurrency", type=click.IntRange(1, 64), default=1,
+              help="Files opened and read at the same time, above 1 the archive is written in-process instead of by tar")
+@click.option("--upload-limit", type=str,
+              help="Upload bandwidth limit in bytes per second, e.g. 20M or 50M,09:00-18:00=5M for a daily schedule")
+@click.option("--read-limit", type=str, help="Limit on bytes read from disk per second, same format as --upload-limit")
+@click.option("--control-socket", type=click.Path(dir_okay=False),
+              help="Unix socket to change the limits at runtime (status, pause, resume, set <upload|read> <rate>)")
+@click.option("--nice", type=click.IntRange(0, 19), default=0, help="Lower the cpu priority of all stages")
+@click.option("--ionice", type=click.Choice(["idle", "best-effort"]), help="Lower the io priority of all stages")
+@click.option("--metrics-json", type=click.Path(dir_okay=False), help="Write per stage metrics as JSON, - for stdout")
+@click.option("--metrics-textfile", type=click.Path(dir_okay=False),
+              help="Write per stage metrics in the Prometheus textfile format")
+@click.option("--statsd", type=str, help="Send per stage metrics as StatsD gauges to host:port")
 @click.argument("folder")
 @click.argument("bucket")
-def backup(compress, encrypt, cert, storage_class, jobname, progress, color, dry_run, folder, bucket):
-    check_dependencies(compress, encrypt)
+def backup(compress, compression_level, compression_threads, long_window, native_compression, adaptive_compression,
+           encrypt, cert,
+           native_crypto, storage_class, jobname, progress, color, dry_run, incremental, key, engine, endpoint_url, part_size,
+           upload_concurrency, resume, chunked, chunk_size, seekable, stat_cache, volume_size, volume_concurrency, read_concurrency,
+           upload_limit, read_limit, control_socket, nice, ionice,
+           metrics_json, metrics_textfile, statsd, folder, bucket):
+    if chunked and engine != "native":
+        raise click.BadOptionUsage("chunked", "option chunked requires --engine native")
+    if chunked and encrypt:
+        raise click.BadOptionUsage("chunked", "option chunked does not support encryption yet")
+    if chunked and seekable:
+        raise click.BadOptionUsage("seekable", "options chunked and seekable are mutually exclusive")
+    if volume_size and (chunked or seekable):
+        raise click.BadOptionUsage("volume-size", "option volume-size cannot be combined with chunked or seekable")
+    if adaptive_compression and seekable:
+        raise click.BadOptionUsage("adaptive-compression", "option adaptive-compression cannot be combined with seekable")
+    if seekable and encrypt and not native_crypto and sys.platform == "darwin":
+        # LibreSSL's openssl enc has no -pbkdf2, selective restores could not derive the key of its archives
+        raise click.BadOptionUsage("seekable", "option seekable with encrypt requires --native-crypto on macOS")
+    check_dependencies(compress, encrypt, engine == "native",
+                       native_compression or adaptive_compression or chunked or seekable, native_crypto)
+    from backup import do_backup
+    from chunkstore import ChunkStore
+    from compression import Compression
+    from crypto import GCM_CIPHER
+    from s3 import S3Engine, MIB
+    from throttle import TokenBucket, ControlServer, parse_limit, install_signal_handlers
     yellow = color_macro(color, colored.yellow)
     pv_support = supports_pv()
     if not pv_support:
         puts(f"{yellow('Warning')}: progress enabled, but pv not found in PATH. Falling back to no-progress")
-    do_backup(compress, encrypt, cert, storage_class, jobname, progress and pv_support, color, dry_run, folder, bucket)
-    pass
+    upload_engine = S3Engine(endpoint_url, part_size * MIB, upload_concurrency) if engine == "native" else None
+    compression = Compression(compression_level, compression_threads, long_window, native_compression,
+                              adaptive_compression) if compress else None
+    chunk_store = None
+    if chunked:
+        chunk_store = ChunkStore(upload_engine.client, bucket, storage_class, compress, int(chunk_size) * 1024,
+                                 upload_concurrency, adaptive_compression)
+    lower_priority(nice, ionice)
+    throttle = TokenBucket(parse_limit(upload_limit), "upload") if upload_limit else None
+    read_throttle = TokenBucket(parse_limit(read_limit), "read") if read_limit else None
+    limits = [b for b in (throttle, read_throttle) if b]
+    if limits:
+        install_signal_handlers(limits)
+    control = None
+    if control_socket:
+        if not limits:
+            raise click.BadOptionUsage("control-socket", "option control-socket requires --upload-limit or --read-limit")
+        control = ControlServer(control_socket, limits)
+        control.start()
+    try:
+        do_backup(compression, encrypt, cert, storage_class, jobname, progress and pv_support, color, dry_run, incremental,
+                  key, upload_engine, chunk_store, seekable, GCM_CIPHER if native_crypto else None, throttle, read_throttle,
+                  get_metrics(metrics_json, metrics_textfile, statsd), resume,
+                  parse_size(volume_size) if volume_size else None, volume_concurrency, stat_cache, read_concurrency,
+                  folder, bucket)
+    finally:
+        if control:
+            control.close()
+
+@cli.command(name="backup-all")
+@click.option("--color/--no-color", default=True, is_flag=True)
+@click.argument("config", type=click.Path(exists=True, dir_okay=False))
+def backup_all(color, config):
+    # Every job checks its own dependencies
+    from scheduler import do_backup_all, load_config
+    do_backup_all(load_config(config), color)
 
 @cli.command(name="list-buckets")
 @click.option("--color/--no-color", default=True, is_flag=True)
 def list_buckets(color):
     check_dependencies(False, False)
+    from list import do_list_buckets
     do_list_buckets(color)
 
 @cli.command(name="list")
 @click.option("--jobname", type=str)
 @click.option("--color/--no-color", default=True, is_flag=True)
+@click.option("--refresh", is_flag=True, help="Rebuild the local catalog of the bucket from S3")
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--list-concurrency", type=click.IntRange(1, 128), default=16,
+              help="Number of job prefixes listed at the same time")
 @click.argument("bucket")
-def list(jobname, color, bucket):
-    check_dependencies(False, False)
-    do_list(jobname, color, bucket)
+def list(jobname, color, refresh, engine, endpoint_url, list_concurrency, bucket):
+    check_dependencies(False, False, engine == "native")
+    from catalog import Catalog
+    from list import do_list
+    from s3 import S3Engine
+    list_engine = S3Engine(endpoint_url, concurrency=list_concurrency) if engine == "native" else None
+    do_list(jobname, color, Catalog(bucket, list_engine, refresh, concurrency=list_concurrency))
 
 @cli.command(name="list-content")
 @click.option("--color/--no-color", default=True, is_flag=True)
 @click.option("--date", type=str)
+@click.option("--all-dates", default=False, is_flag=True,
+              help="Search every backup of the job, e.g. to find out when a file last existed")
+@click.option("--glob", "pattern", type=str, help="Only list paths matching this pattern, e.g. 'home/*/.bashrc'")
+@click.option("--sha256", type=str, help="Only list files with this content")
+@click.option("--key", type=str, help="Private key to read the file lists of encrypted backups")
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--list-concurrency", type=click.IntRange(1, 64), default=8,
+              help="File lists downloaded at the same time while indexing")
+@click.option("--refresh", is_flag=True, help="Rebuild the local catalog of the bucket from S3")
 @click.argument("bucket")
 @click.argument("jobname")
-def list_contents(color, date, bucket, jobname):
-    do_list_filelist(color, date, bucket, jobname)
+def list_contents(color, date, all_dates, pattern, sha256, key, engine, endpoint_url, list_concurrency, refresh, bucket,
+                  jobname):
+    if date and all_dates:
+        raise click.BadOptionUsage("all-dates", "options date and all-dates are mutually exclusive")
+    if sha256 and not re.fullmatch("[0-9a-fA-F]{64}", sha256):
+        raise click.BadParameter("expected 64 hex digits", param_hint="--sha256")
+    check_dependencies(False, False, engine == "native")
+    from catalog import Catalog
+    from list import do_list_filelist
+    from s3 import S3Engine
+    download_engine = S3Engine(endpoint_url, concurrency=list_concurrency) if engine == "native" else None
+    do_list_filelist(color, date, all_dates, key, pattern, sha256 and sha256.lower(), download_engine,
+                     Catalog(bucket, download_engine, refresh), list_concurrency, bucket, jobname)
 
 @cli.command(name="restore")
 @click.option("--color/--no-color", default=True, is_flag=True)
 @click.option("--progress/--no-progress", default=True, is_flag=True)
 @click.option("--date", type=str)
 @click.option("--key", type=str)
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--part-size", cls=RefinementOption, refines=["engine"], type=click.IntRange(5, 5120), default=64,
+              help="Ranged GET size in MiB")
+@click.option("--download-concurrency", cls=RefinementOption, refines=["engine"], type=click.IntRange(1, 64), default=8)
+@click.option("--path", "paths", cls=RefinementOption, refines=["engine"], type=str, multiple=True,
+              help="Only restore this path of a seekable backup, may be given multiple times")
+@click.option("--volume-concurrency", type=click.IntRange(1, 64), default=4,
+              help="Volumes of a split backup downloaded and extracted at the same time")
+@click.option("--thaw-tier", type=click.Choice(TIERS), default="Standard",
+              help="Retrieval tier for objects archived in GLACIER or DEEP_ARCHIVE")
+@click.option("--thaw-days", type=click.IntRange(1, 365), default=1, help="Days thawed objects stay readable")
+@click.option("--refresh", is_flag=True, help="Rebuild the local catalog of the bucket from S3")
+@click.option("--metrics-json", type=click.Path(dir_okay=False), help="Write per stage metrics as JSON, - for stdout")
+@click.option("--metrics-textfile", type=click.Path(dir_okay=False),
+              help="Write per stage metrics in the Prometheus textfile format")
+@click.option("--statsd", type=str, help="Send per stage metrics as StatsD gauges to host:port")
 @click.argument("bucket")
 @click.argument("jobname")
 @click.argument("target")
-def restore(color, progress, date, key, bucket, jobname, target):
+def restore(color, progress, date, key, engine, endpoint_url, part_size, download_concurrency, paths, volume_concurrency,
+            thaw_tier, thaw_days, refresh, metrics_json, metrics_textfile, statsd, bucket, jobname, target):
+    check_dependencies(False, False, engine == "native")
+    from catalog import Catalog
+    from restore import do_restore
+    from s3 import S3Engine, MIB
+    from thaw import Thaw
     yellow = color_macro(color, colored.yellow)
     pv_support = supports_pv()
     if not pv_support:
         puts(f"{yellow('Warning')}: progress enabled, but pv not found in PATH. Falling back to no-progress")
-    do_restore(color, progress and pv_support, date, key, bucket, jobname, target)
+    download_engine = S3Engine(endpoint_url, part_size * MIB, download_concurrency) if engine == "native" else None
+    do_restore(color, progress and pv_support, date, key, download_engine, Catalog(bucket, download_engine, refresh),
+               get_metrics(metrics_json, metrics_textfile, statsd), paths, volume_concurrency,
+               Thaw(bucket, download_engine, thaw_tier, thaw_days), bucket, jobname, target)
+
+@cli.command(name="verify")
+@click.option("--color/--no-color", default=True, is_flag=True)
+@click.option("--date", type=str, help="Backup to verify instead of the most recent one")
+@click.option("--key", type=str)
+@click.option("--quick", default=False, is_flag=True,
+              help="Only check that every object of the backup exists with a plausible size and etag")
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--part-size", cls=RefinementOption, refines=["engine"], type=click.IntRange(5, 5120), default=64,
+              help="Ranged GET size in MiB")
+@click.option("--download-concurrency", cls=RefinementOption, refines=["engine"], type=click.IntRange(1, 64), default=8)
+@click.option("--volume-concurrency", type=click.IntRange(1, 64), default=4,
+              help="Volumes of a split backup verified at the same time")
+@click.option("--job-concurrency", type=click.IntRange(1, 64), default=2, help="Backups verified at the same time")
+@click.option("--refresh", is_flag=True, help="Rebuild the local catalog of the bucket from S3")
+@click.argument("bucket")
+@click.argument("jobname", required=False)
+def verify(color, date, key, quick, engine, endpoint_url, part_size, download_concurrency, volume_concurrency,
+           job_concurrency, refresh, bucket, jobname):
+    # Without a jobname the latest backup of every job in the bucket is verified
+    check_dependencies(False, False, engine == "native")
+    from catalog import Catalog
+    from s3 import S3Engine, MIB
+    from verify import do_verify
+    download_engine = S3Engine(endpoint_url, part_size * MIB, download_concurrency) if engine == "native" else None
+    do_verify(color, date, key, download_engine, Catalog(bucket, download_engine, refresh), quick, volume_concurrency,
+              job_concurrency, bucket, jobname)
+
+@cli.command(name="prune")
+@click.option("--color/--no-color", default=True, is_flag=True)
+@click.option("--keep-daily", type=click.IntRange(0, None), default=7, help="Keep the newest backup of this many days")
+@click.option("--keep-weekly", type=click.IntRange(0, None), default=4, help="Keep the newest backup of this many weeks")
+@click.option("--keep-monthly", type=click.IntRange(0, None), default=12,
+              help="Keep the newest backup of this many months")
+@click.option("--key", type=str,
+              help="Private key to read the base of encrypted backups written before base dates were stored in plain")
+@click.option("--early-deletion", default=False, is_flag=True,
+              help="Also delete backups still inside the minimum storage duration of their storage class")
+@click.option("--dry-run", default=False, is_flag=True, help="Only print what would be deleted")
+@click.option("--engine", type=click.Choice(["cli", "native"]), default="cli")
+@click.option("--endpoint-url", cls=RefinementOption, refines=["engine"], type=str)
+@click.option("--delete-concurrency", type=click.IntRange(1, 64), default=8,
+              help="DeleteObjects requests of 1000 keys sent at the same time")
+@click.option("--refresh", is_flag=True, help="Rebuild the local catalog of the bucket from S3")
+@click.argument("bucket")
+@click.argument("jobname", required=False)
+def prune(color, keep_daily, keep_weekly, keep_monthly, key, early_deletion, dry_run, engine, endpoint_url,
+          delete_concurrency, refresh, bucket, jobname):
+    # Without a jobname every job in the bucket is pruned. Chunks are not collected while a chunked backup of the
+    # bucket runs, chunked backups that start meanwhile wait until the collection is done.
+    check_dependencies(False, False, engine == "native")
+    from catalog import Catalog
+    from prune import do_prune
+    from s3 import S3Engine
+    prune_engine = S3Engine(endpoint_url, concurrency=delete_concurrency) if engine == "native" else None
+    do_prune(color, key, prune_engine, Catalog(bucket, prune_engine, refresh), keep_daily, keep_weekly, keep_monthly,
+             early_deletion, dry_run, delete_concurrency, bucket, jobname)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,405 @@
 import subprocess
 import click
-import re
-from utils import color_macro, s3_url, check_folder_exists, check_file_exists
+import json
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from compression import get_zstd_decompress_pipe
+from chunkstore import CHUNK_PREFIX, ChunkStore, chunk_key
+from crypto import GCM_CIPHER, get_decrypt_pipe, decrypt_asymmetric, native_crypto_available
+from seekable import RangeReader, copy_member, hard_links, load_index, select_members, merge_ranges
+from metrics import link, wait_stage
+from thaw import list_storage_classes
+from utils import color_macro, get_pv_pipe, s3_url, s3_list, parse_date, check_folder_exists, check_file_exists
 from clint.textui import colored, puts
-from datetime import datetime
 import os
 
-def do_restore(color, progress, date, key, bucket, jobname, target):
+# Upper bound on the bytes requested at once when restoring single paths
+RESTORE_READ_SIZE = 64 * 1024 * 1024
+
+
+def get_s3_download_pipe(s3_url):
+    aws = subprocess.Popen(
+        ["aws", "s3", "cp", s3_url, "-"],
+        stdout=subprocess.PIPE
+    )
+    return aws
+
+
+def get_openssl_pipe_symmetric_decrypt(key, input):
+    if sys.platform == "linux":
+        cmd = ["openssl", "enc", "-d", "-aes-256-ctr", "-pass", f"pass:{key}", "-pbkdf2"]
+    elif sys.platform == "darwin":
+        # macos ships with LibreSSL which doesnt support -pbkdf2 for whatever reason
+        cmd = ["openssl", "enc", "-d", "-aes-256-ctr", "-pass", f"pass:{key}"]
+
+    openssl = subprocess.Popen(
+        cmd,
+        stdin=input,
+        stdout=subprocess.PIPE
+    )
+    return openssl
+
+
+def get_openssl_pipe_asymmetric_decrypt(key, input):
+    openssl = subprocess.Popen(
+        ["openssl", "rsautl", "-decrypt", "-inkey", key],
+        stdin=input,
+        stdout=subprocess.PIPE
+    )
+    return openssl
+
+
+def get_untar_pipe(target, input, exclude=None):
+    tar_name = "gtar" if sys.platform == "darwin" else "tar"
+    cmd = [tar_name, "-C", target, "-xf", "-"]
+    if exclude:
+        # Skip the exact NUL separated member names in exclude
+        cmd += ["--anchored", "--no-wildcards", "--null", "-X", exclude]
+
+    untar = subprocess.Popen(
+        cmd,
+        stdin=input
+    )
+    return untar
+
+
+def build_download_pipeline_symmetric(bucket, srcfile, key, engine=None, progress=False, cipher=None, metrics=None):
+    # Build subprocess chain, the last element's stdout carries the plaintext
+    if engine:
+        pipe = [engine.get_download_pipe(bucket, srcfile)]
+    else:
+        pipe = [get_s3_download_pipe(s3_url(bucket, srcfile))]
+
+    if progress:
+        pv = get_pv_pipe(link(pipe, metrics))
+        pipe.append(pv)
+
+    if key and cipher == GCM_CIPHER:
+        aes = get_decrypt_pipe(key, link(pipe, metrics))
+        pipe.append(aes)
+    elif key:
+        openssl = get_openssl_pipe_symmetric_decrypt(key, link(pipe, metrics))
+        pipe.append(openssl)
+
+    return pipe
+
+
+def wait_pipeline(pipe, metrics=None):
+    # Once the parent's copies of the pipes are closed, a failing stage makes its neighbours
+    # terminate with EOF or SIGPIPE, so waiting on every stage cannot hang
+    for i in range(1, len(pipe)):
+        pipe[i - 1].stdout.close()
+
+    errors = []
+    for p in pipe:
+        try:
+            if wait_stage(p, metrics) != 0:
+                errors.append(f"{p.args[0]} exited with code {p.returncode}")
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    # Later stages usually only fail as a consequence of the first failure
+    if errors:
+        raise RuntimeError(errors[0])
+
+
+def read_pipeline(pipe):
+    for i in range(1, len(pipe)):
+        pipe[i - 1].stdout.close()
+    try:
+        out = pipe[-1].stdout.read()
+    finally:
+        wait_pipeline(pipe)
+    return out
+
+
+def iter_pipeline(pipe):
+    # Yields the lines of the last stage's output, long file lists are never held in memory as a whole
+    for i in range(1, len(pipe)):
+        pipe[i - 1].stdout.close()
+    try:
+        yield from pipe[-1].stdout
+    finally:
+        wait_pipeline(pipe)
+
+
+def discard_pipeline(pipe):
+    # Stops a pipeline whose output is no longer read, its stages fail on the closed pipe
+    pipe[-1].stdout.close()
+    try:
+        wait_pipeline(pipe)
+    except RuntimeError:
+        pass
+
+
+def fetch_meta(bucket, jobname, date, key, backup_content, engine=None):
+    # Backups without any metafile are plain full backups
+    jobdir_name = os.path.join(jobname, date)
+    if f"{jobname}.meta.enc" in backup_content:
+        if not key or not check_file_exists(key):
+            raise click.BadOptionUsage("key", f"Key is missing, backup {date} is encrypted")
+
+        pipe = build_download_pipeline_symmetric(bucket, os.path.join(jobdir_name, f"{jobname}.meta.enc"), None, engine)
+        if native_crypto_available():
+            return json.loads(decrypt_asymmetric(key, read_pipeline(pipe)).decode("utf-8"))
+
+        openssl = get_openssl_pipe_asymmetric_decrypt(key, pipe[-1].stdout)
+        pipe.append(openssl)
+        return json.loads(read_pipeline(pipe).decode("utf-8"))
+    elif f"{jobname}.meta" in backup_content:
+        pipe = build_download_pipeline_symmetric(bucket, os.path.join(jobdir_name, f"{jobname}.meta"), None, engine)
+        return json.loads(read_pipeline(pipe).decode("utf-8"))
+    else:
+        return dict()
+
+
+def fetch_base(bucket, jobname, date, key, backup_content, engine=None):
+    # Date of the backup an incremental backup is based on, None for full backups. Encrypted backups keep it in a
+    # plain .base object as well, only those written before need the private key.
+    if f"{jobname}.base" in backup_content:
+        pipe = build_download_pipeline_symmetric(bucket, os.path.join(jobname, date, f"{jobname}.base"), None, engine)
+        return read_pipeline(pipe).decode("utf-8").strip() or None
+    return fetch_meta(bucket, jobname, date, key, backup_content, engine).get("base")
+
+
+def open_list(bucket, jobname, date, name, meta, backup_content, engine=None):
+    # Starts downloading and decrypting one of the NUL/newline separated lists next to a backup,
+    # returns the pipeline or None if the backup has no such list
+    jobdir_name = os.path.join(jobname, date)
+    if f"{jobname}.{name}.aes" in backup_content:
+        return build_download_pipeline_symmetric(bucket, os.path.join(jobdir_name, f"{jobname}.{name}.aes"),
+                                                 meta["listkey"], engine, cipher=meta.get("cipher"))
+    elif f"{jobname}.{name}" in backup_content:
+        return build_download_pipeline_symmetric(bucket, os.path.join(jobdir_name, f"{jobname}.{name}"), None, engine)
+    return None
+
+
+def fetch_list(bucket, jobname, date, name, meta, backup_content, engine=None):
+    pipe = open_list(bucket, jobname, date, name, meta, backup_content, engine)
+    return read_pipeline(pipe) if pipe else None
+
+
+def resolve_chain(bucket, jobname, date, key, engine=None, catalog=None):
+    # Walks the base references of incremental backups back to the last full backup
+    chain = []
+    while True:
+        try:
+            if catalog:
+                backup_content = catalog.files(jobname, date)
+            else:
+                backup_content = s3_list(bucket, os.path.join(jobname, date) + "/")
+        except:
+            raise RuntimeError(f"Could not list files in {bucket}/{jobname}/{date}")
+
+        meta = fetch_meta(bucket, jobname, date, key, backup_content, engine)
+        chain.insert(0, (date, meta, backup_content))
+
+        if meta.get("type", "full") == "full":
+            return chain
+        date = meta["base"]
+
+
+def apply_tombstones(target, deleted):
+    for path in deleted.split(b"\0"):
+        if not path:
+            continue
+        full_path = os.path.join(target, os.fsdecode(path))
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path, ignore_errors=True)
+        elif os.path.lexists(full_path):
+            os.remove(full_path)
+
+
+def archive_keys(bucket, jobname, date, meta, backup_content, engine):
+    # Keys of the objects holding the archive of a backup
+    jobdir_name = os.path.join(jobname, date)
+    if f"{jobname}.chunks" in backup_content:
+        if not engine:
+            raise click.BadOptionUsage("engine", f"Backup {date} is chunked, restoring it requires --engine native")
+        store = ChunkStore(engine.client, bucket, concurrency=engine.concurrency)
+        manifest = store.read_manifest(os.path.join(jobdir_name, f"{jobname}.chunks"))
+        return [chunk_key(digest, compressed) for digest, _, compressed in manifest]
+
+    volumes = fetch_list(bucket, jobname, date, "volumes", meta, backup_content, engine)
+    if volumes:
+        return [os.path.join(jobdir_name, v["name"]) for v in json.loads(volumes.decode("utf-8"))["volumes"]]
+
+    backup_name = next((x for x in backup_content if x.startswith(f"{jobname}.tar")), None)
+    if not backup_name:
+        raise RuntimeError(f"No archive found in {bucket}/{jobname}/{date}")
+    return [os.path.join(jobdir_name, backup_name)]
+
+
+def build_download_pipeline(bucket, jobname, date, meta, backup_content, engine, progress, metrics=None, thaw=None):
+    # Returns a subprocess chain whose last stdout carries the plain tar stream
+    if f"{jobname}.chunks" in backup_content:
+        if not engine:
+            raise click.BadOptionUsage("engine", f"Backup {date} is chunked, restoring it requires --engine native")
+        store = ChunkStore(engine.client, bucket, concurrency=engine.concurrency)
+        manifest = store.read_manifest(os.path.join(jobname, date, f"{jobname}.chunks"))
+        pipe = [store.get_reader(manifest, thaw=thaw)]
+        if progress:
+            pv = get_pv_pipe(link(pipe, metrics))
+            pipe.append(pv)
+        return pipe
+
+    backup_name = next((x for x in backup_content if x.startswith(f"{jobname}.tar")), None)
+    if not backup_name:
+        raise RuntimeError(f"No archive found in {bucket}/{jobname}/{date}")
+
+    return build_archive_pipeline(bucket, jobname, date, backup_name, meta, engine, progress, metrics, thaw)
+
+
+def build_archive_pipeline(bucket, jobname, date, backup_name, meta, engine, progress, metrics=None, thaw=None):
+    if thaw:
+        thaw.wait(os.path.join(jobname, date, backup_name))
+
+    compressed = ".zstd" in backup_name
+    encrypted = backup_name.endswith(".aes")
+
+    pipe = build_download_pipeline_symmetric(bucket, os.path.join(jobname, date, backup_name),
+                                             meta["tarkey"] if encrypted else None, engine, progress, meta.get("cipher"),
+                                             metrics)
+    if compressed:
+        zstd = get_zstd_decompress_pipe(link(pipe, metrics))
+        pipe.append(zstd)
+
+    return pipe
+
+
+def restore_volume(bucket, jobname, date, name, meta, target, engine, exclude, metrics=None, thaw=None):
+    pipe = build_archive_pipeline(bucket, jobname, date, name, meta, engine, False, metrics, thaw)
+    untar = get_untar_pipe(target, link(pipe, metrics), exclude)
+    pipe.append(untar)
+
+    try:
+        wait_pipeline(pipe, metrics)
+    except RuntimeError as e:
+        raise RuntimeError(f"Could not restore {bucket}/{jobname}/{date}/{name}: {e}")
+    return pipe
+
+
+def restore_volumes(bucket, jobname, date, meta, volumes, target, engine, concurrency, metrics=None, thaw=None):
+    # Every volume is a tar archive of whole members, so volumes are extracted concurrently
+    with tempfile.TemporaryDirectory() as tmpdir:
+        excludes = dict()
+        for path, _, volume in volumes["links"]:
+            excludes.setdefault(volume, []).append(path)
+        for volume, paths in excludes.items():
+            excludes[volume] = os.path.join(tmpdir, str(volume))
+            with open(excludes[volume], "wb") as f:
+                f.write(b"".join(os.fsencode(p) + b"\0" for p in paths))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(restore_volume, bucket, jobname, date, v["name"], meta, target, engine,
+                                       excludes.get(i), metrics, thaw)
+                       for i, v in enumerate(volumes["volumes"])]
+            pipes = [f.result() for f in futures]
+
+    if metrics:
+        for pipe in pipes:
+            metrics.add(pipe)
+
+    # Hard links to files of another volume could not be extracted before that volume existed
+    for path, link_target, _ in volumes["links"]:
+        full_path = os.path.join(target, path)
+        if os.path.lexists(full_path):
+            os.remove(full_path)
+        os.link(os.path.join(target, link_target), full_path)
+
+
+def restore_archive(bucket, jobname, date, meta, backup_content, target, engine, progress, metrics=None,
+                    volume_concurrency=1, thaw=None):
+    volumes = fetch_list(bucket, jobname, date, "volumes", meta, backup_content, engine)
+    if volumes:
+        restore_volumes(bucket, jobname, date, meta, json.loads(volumes.decode("utf-8")), target, engine,
+                        volume_concurrency, metrics, thaw)
+    else:
+        # download -> (pv) -> decrypt -> decompress -> untar, nothing is buffered on disk
+        pipe = build_download_pipeline(bucket, jobname, date, meta, backup_content, engine, progress, metrics, thaw)
+
+        untar = get_untar_pipe(target, link(pipe, metrics))
+        pipe.append(untar)
+
+        try:
+            wait_pipeline(pipe, metrics)
+        except RuntimeError as e:
+            raise RuntimeError(f"Could not restore {bucket}/{jobname}/{date}: {e}")
+        if metrics:
+            metrics.add(pipe)
+
+    deleted = fetch_list(bucket, jobname, date, "deleted", meta, backup_content, engine)
+    if deleted:
+        apply_tombstones(target, deleted)
+
+
+def select_paths(bucket, jobname, chain, paths, engine):
+    # A path is restored from the most recent backup of the chain that contains it,
+    # returns (date, meta, archive key, index, members) of every backup that has to be read
+    shadowed = set()
+    selected = []
+    for date, meta, backup_content in reversed(chain):
+        index_data = fetch_list(bucket, jobname, date, "index", meta, backup_content, engine)
+        if index_data is None:
+            raise RuntimeError(f"Backup {date} has no archive index, selective restore requires a --seekable backup")
+
+        index = load_index(index_data)
+        members = [m for m in select_members(index, paths) if m[0] not in shadowed]
+        if members:
+            backup_name = next(x for x in backup_content if x.startswith(f"{jobname}.tar"))
+            selected.append((date, meta, os.path.join(jobname, date, backup_name), index, members))
+            shadowed.update(m[0] for m in members)
+
+        # Entries deleted by this backup must not be restored from older ones
+        deleted = fetch_list(bucket, jobname, date, "deleted", meta, backup_content, engine)
+        if deleted:
+            shadowed.update(os.fsdecode(p) for p in deleted.split(b"\0") if p)
+
+    return selected
+
+
+def restore_paths(bucket, jobname, selected, target, engine, thaw=None):
+    restored = 0
+    for date, meta, key, index, members in selected:
+        if thaw:
+            thaw.wait(key)
+        reader = RangeReader(engine.client, bucket, key, index,
+                             meta["tarkey"] if key.endswith(".aes") else None, meta.get("cipher"))
+
+        # tar links to targets restored in the same pass, the other links get a copy of their target's data
+        names = set(m[0] for m in members)
+        detached = {path: t for path, t in hard_links(index, members, reader).items() if t not in names}
+        wanted = set(detached.values())
+        targets = dict()
+        for m in index["members"]:
+            if m[0] in wanted:
+                targets.setdefault(m[0], m)
+
+        untar = get_untar_pipe(target, subprocess.PIPE)
+        try:
+            for start, end in merge_ranges([m for m in members if m[0] not in detached]):
+                for offset in range(start, end, RESTORE_READ_SIZE):
+                    untar.stdin.write(reader.read(offset, min(offset + RESTORE_READ_SIZE, end)))
+            for path, link_target in detached.items():
+                if link_target not in targets:
+                    raise RuntimeError(f"Target {link_target} of hard link {path} is missing from the archive")
+                copy_member(reader, targets[link_target], path, untar.stdin)
+            # End of archive marker
+            untar.stdin.write(bytes(1024))
+        finally:
+            untar.stdin.close()
+        if untar.wait() != 0:
+            raise RuntimeError(f"Could not restore from {bucket}/{jobname}/{date}, tar exited with code {untar.returncode}")
+
+        restored += len(members)
+
+    return restored
+
+
+def do_restore(color, progress, date, key, engine, catalog, metrics, paths, volume_concurrency, thaw, bucket, jobname,
+               target):
     # Colors
     yellow = color_macro(color, colored.yellow)
     cyan = color_macro(color, colored.cyan)
@@ -23,73 +416,67 @@ def do_restore(color, progress, date, key, bucket, jobname, target):
     if not date:
         puts("No date supplied, trying to restore most recent backup")
         try:
-            out = subprocess.check_output(["aws", "s3", "ls", s3_url(bucket, jobname + "/")]).decode("utf-8")
+            date = catalog.latest(jobname)
         except:
             raise RuntimeError(f"Could not list bucket {bucket}/{jobname}, please double check the name and jobname")
-
-        dates = [x.rsplit(" ", 1)[1].strip("/") for x in out.splitlines()]
-        dates_sorted = sorted(dates)
-        date = dates_sorted[-1]
+        if not date:
+            raise RuntimeError(f"No backups found for {bucket}/{jobname}, please double check the name and jobname")
         puts(f"Most recent backup: {yellow(date)}")
     else:
-        try:
-            datetime.strptime(date, "%Y-%m-%d_%H-%M-%S")
-        except:
-            raise RuntimeError(f"date ({date}) has invalid date format, expected %Y-%m-%d_%H-%M-%S")
+        parse_date(date)
 
-        try:
-            puts(f"Checking if backup for {yellow(date)} exists...", newline=False)
-            # Check if backup with that date actually exists
-            out = subprocess.check_call(
-                ["aws", "s3", "ls", s3_url(bucket, os.path.join(jobname, date))],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            puts(green("OK"))
-        except:
+        puts(f"Checking if backup for {yellow(date)} exists...", newline=False)
+        if not catalog.has_date(jobname, date):
             print()
             raise click.BadOptionUsage("date", red(f"No backup found for date {date}"))
+        puts(green("OK"))
 
     # Next check files, determine if encrypted, compressed or both
-    print(f"Checking files in {bucket}/{jobname}/{date}...", end="")
+    print(f"Resolving backup chain for {bucket}/{jobname}/{date}...", end="", flush=True)
+    chain = resolve_chain(bucket, jobname, date, key, engine, catalog)
+    puts(green("DONE"))
 
-    try:
-        backup_content_str = subprocess.check_output(
-            ["aws", "s3", "ls", s3_url(bucket, os.path.join(jobname, date) + "/")]
-        ).decode("utf-8")
-        backup_content = [x.rsplit(" ", 1)[1].strip("/") for x in backup_content_str.splitlines()]
+    def request_thaw(keys, classes=None):
+        # Thaws are requested for everything up front, each download only waits for its own objects
+        print("Checking for archived objects...", end="", flush=True)
+        pending = thaw.request(keys, classes)
         puts(green("DONE"))
-    except:
-        raise RuntimeError(f"Could not list files in {bucket}/{jobname}/{date}")
+        if pending:
+            puts(f"{cyan(str(pending))} objects are archived, requested a {yellow(thaw.tier)} restore for "
+                 f"{thaw.days} days, downloads start as each object becomes available")
 
-    encrypted = any(".meta.enc" for s in backup_content)
-    compressed = any(".tar.zstd" for s in backup_content)
+    if paths:
+        if not engine:
+            raise click.BadOptionUsage("path", "option path requires --engine native")
+        selected = select_paths(bucket, jobname, chain, paths, engine)
+        # Only the archives holding one of the paths are thawed
+        request_thaw([s[2] for s in selected])
+        print(f"Restoring {', '.join(paths)}...", end="", flush=True)
+        restored = restore_paths(bucket, jobname, selected, target, engine, thaw)
+        puts(green("DONE"))
+        puts(f"Restored {cyan(str(restored))} entries")
+        return
 
-    print(f"Backup is{' not' if not encrypted else ''} encrypted and{' not' if not compressed else ''} compressed")
+    keys = []
+    for chain_date, meta, backup_content in chain:
+        keys += archive_keys(bucket, jobname, chain_date, meta, backup_content, engine)
+    classes = None
+    if any(f"{jobname}.chunks" in backup_content for _, _, backup_content in chain):
+        # Chunks are shared and may have been moved to another class by a lifecycle rule at any time,
+        # one listing of the chunk store covers the chunks of the whole chain
+        classes = list_storage_classes(bucket, CHUNK_PREFIX + "/", engine)
+    request_thaw(keys, classes)
 
+    if metrics:
+        metrics.begin()
+    if len(chain) > 1:
+        puts(f"Backup is incremental, restoring {len(chain)} backups starting at full backup {yellow(chain[0][0])}")
 
-    if encrypted:
-        if not key or not check_file_exists(key):
-            raise click.BadOptionUsage("key", "Key is missing, backup is encrypted")
+    for chain_date, meta, backup_content in chain:
+        print(f"Restoring {yellow(chain_date)}...", end="" if not progress else "\n", flush=True)
+        restore_archive(bucket, jobname, chain_date, meta, backup_content, target, engine, progress, metrics,
+                        volume_concurrency, thaw)
+        puts(green("DONE"))
 
-        print("Downloading metafile...", end="", flush=True)
-        try:
-            metafile_url = s3_url(bucket, os.path.join(jobname, date, f"{jobname}.meta.enc"))
-            # print(metafile_url)
-
-            openssl = subprocess.Popen(
-                ["openssl", "rsautl", "-decrypt", "-inkey", key],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE
-            )
-            openssl_out = openssl.stdout
-
-            aws = subprocess.Popen(
-                ["aws", "s3", "cp", metafile_url, "-"],
-                stdout=openssl.stdin
-            )
-            aws.wait()
-            print("yottek", flush=True)
-            print(openssl_out.readline())
-        except:
-            raise RuntimeError(f"Could not download/decrypt metafile")
\ No newline at end of file
+    if metrics:
+        metrics.publish("restore", jobname)
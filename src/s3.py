@@ -0,0 +1,290 @@
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import ResumeError
+from utils import s3_url
+
+MIB = 1024 * 1024
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * MIB
+MAX_PART_SIZE = 5 * 1024 * MIB
+MAX_PARTS = 10000
+MAX_OBJECT_SIZE = 5 * 1024 * 1024 * MIB
+# Parts grow by PART_STEP every PART_GROWTH parts. Linear growth keeps parts small, from the smallest part size the
+# 10000 parts still hold MAX_OBJECT_SIZE with parts of at most 1.2 GiB.
+PART_GROWTH = 100
+PART_STEP = 12 * MIB
+
+
+def part_size_of(part_number, first):
+    return min(first + (part_number - 1) // PART_GROWTH * PART_STEP, MAX_PART_SIZE)
+
+
+class BufferPool:
+    # Bounds the bytes of the parts read but not uploaded yet. A part larger than the whole pool still fits once
+    # no other part is held, so the pool does not limit the part size.
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, n):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.used or self.used + n <= self.size)
+            self.used += n
+
+    def release(self, n):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+
+def get_client(endpoint_url=None, max_connections=10):
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        max_pool_connections=max_connections,
+        retries={"mode": "adaptive", "max_attempts": 10}
+    )
+    return boto3.session.Session().client("s3", endpoint_url=endpoint_url, config=config)
+
+
+class S3Engine:
+    # Transfers pipeline data in-process instead of piping it through the aws cli
+    def __init__(self, endpoint_url=None, part_size=64 * MIB, concurrency=8):
+        if not MIN_PART_SIZE <= part_size <= MAX_PART_SIZE:
+            raise ValueError(f"part size must be between {MIN_PART_SIZE // MIB} and {MAX_PART_SIZE // MIB} MiB")
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.client = get_client(endpoint_url, concurrency)
+
+    def get_pipe(self, bucket, key, storage_class, input, checkpoint=None, hold=False):
+        upload = MultipartUpload(self.client, bucket, key, storage_class, input, self.part_size, self.concurrency,
+                                 checkpoint, hold)
+        upload.start()
+        return upload
+
+    def get_download_pipe(self, bucket, key):
+        download = RangedDownload(self.client, bucket, key, self.part_size, self.concurrency)
+        download.start()
+        return download
+
+
+class MultipartUpload(threading.Thread):
+    # Behaves like the last Popen of a pipeline: wait() returns an exit code, stdin is writable if there is no input
+    def __init__(self, client, bucket, key, storage_class, input, part_size, concurrency, checkpoint=None, hold=False):
+        super(MultipartUpload, self).__init__(daemon=True)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.storage_class = storage_class
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.checkpoint = checkpoint
+        # With hold set the object is only completed once release(True) confirms the upstream stages succeeded,
+        # a stream cut short by a failing stage must not become a valid looking object
+        self.released = threading.Event() if hold else None
+        self.commit = False
+        self.args = ["s3-multipart", s3_url(bucket, key)]
+        self.stdout = None
+        self.returncode = None
+        self.error = None
+
+        if input:
+            # The pipeline closes its copy of the previous stage's stdout, keep our own
+            self.stdin = None
+            self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        else:
+            r, w = os.pipe()
+            self.stdin = os.fdopen(w, "wb")
+            self.input = os.fdopen(r, "rb")
+
+    def run(self):
+        try:
+            self.upload()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            # Closing the read end lets upstream stages terminate instead of blocking on a full pipe
+            self.input.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            # Keeps its type, the backup starts over on a ResumeError
+            error = ResumeError if isinstance(self.error, ResumeError) else RuntimeError
+            raise error(f"Upload to {self.args[1]} failed: {self.error}")
+        return self.returncode
+
+    def release(self, commit):
+        if self.released:
+            self.commit = commit
+            self.released.set()
+
+    def check_commit(self):
+        if self.released:
+            self.released.wait()
+            if not self.commit:
+                raise RuntimeError("an upstream stage failed")
+
+    def extra_args(self):
+        return {"StorageClass": self.storage_class} if self.storage_class else dict()
+
+    def upload(self):
+        resume = self.checkpoint.upload(self.key) if self.checkpoint else None
+        part_size = resume["part_size"] if resume else self.part_size
+        data = self.input.read(part_size)
+        if len(data) < part_size and not resume:
+            # Fits in a single request
+            self.check_commit()
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=data, **self.extra_args())
+            return
+
+        if resume:
+            upload_id = resume["upload_id"]
+            # S3 is authoritative, the checkpoint may miss parts that finished right before a crash
+            done = dict()
+            paginator = self.client.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=self.bucket, Key=self.key, UploadId=upload_id):
+                done.update({p["PartNumber"]: p["ETag"] for p in page.get("Parts", [])})
+        else:
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args()
+            )["UploadId"]
+            done = dict()
+            if self.checkpoint:
+                self.checkpoint.start_upload(self.key, upload_id, part_size)
+
+        # Parts in flight or queued hold their size in the pool. Memory stays at (concurrency + 1) parts of the
+        # configured size while parts grow, or a single part once one is larger than that.
+        pool = BufferPool((self.concurrency + 1) * part_size)
+        pool.acquire(part_size)
+        first = part_size
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                part_number = 1
+                while data:
+                    if any(f.done() and f.exception() for f in futures):
+                        break
+                    if part_number > MAX_PARTS:
+                        raise RuntimeError(f"Upload to {self.args[1]} exceeds {MAX_PARTS} parts")
+                    if part_number in done:
+                        # Regenerated parts must match what was uploaded before, otherwise the stream changed
+                        if hashlib.md5(data).hexdigest() != done[part_number].strip('"'):
+                            raise ResumeError(f"part {part_number} differs from the interrupted upload")
+                        futures.append(executor.submit(dict, PartNumber=part_number, ETag=done[part_number]))
+                        pool.release(part_size)
+                    else:
+                        futures.append(executor.submit(self.upload_part, upload_id, part_number, data, pool,
+                                                       part_size))
+                    part_number += 1
+                    part_size = part_size_of(part_number, first)
+
+                    pool.acquire(part_size)
+                    data = self.input.read(part_size)
+
+            parts = [f.result() for f in futures]
+            self.check_commit()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+            if self.checkpoint:
+                self.checkpoint.finish_upload(self.key)
+        except ResumeError:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+            self.checkpoint.finish_upload(self.key)
+            raise
+        except:
+            # Keep the parts of a checkpointed upload for the next run
+            if not self.checkpoint:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+            raise
+
+    def upload_part(self, upload_id, part_number, data, pool, reserved):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data
+            )
+            if self.checkpoint:
+                self.checkpoint.add_part(self.key, part_number, response["ETag"])
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            pool.release(reserved)
+
+
+class RangedDownload(threading.Thread):
+    # Behaves like the first Popen of a pipeline, fetches byte ranges in parallel and writes them in order to stdout
+    def __init__(self, client, bucket, key, part_size, concurrency):
+        super(RangedDownload, self).__init__(daemon=True)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.args = ["s3-ranged-get", s3_url(bucket, key)]
+        self.stdin = None
+        self.returncode = None
+        self.error = None
+
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            self.download()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Download of {self.args[1]} failed: {self.error}")
+        return self.returncode
+
+    def get_range(self, etag, start, end):
+        # IfMatch makes sure all ranges come from the same version of the object
+        return self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={start}-{end}",
+            IfMatch=etag
+        )["Body"].read()
+
+    def download(self):
+        head = self.client.head_object(Bucket=self.bucket, Key=self.key)
+        size = head["ContentLength"]
+        etag = head["ETag"]
+
+        # At most concurrency + 1 ranges are buffered, downloaded or in flight
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                for start in range(0, size, self.part_size):
+                    end = min(start + self.part_size, size) - 1
+                    pending.append(executor.submit(self.get_range, etag, start, end))
+                    if len(pending) > self.concurrency:
+                        self.output.write(pending.popleft().result())
+                while pending:
+                    self.output.write(pending.popleft().result())
+            except:
+                for f in pending:
+                    f.cancel()
+                raise
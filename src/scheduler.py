@@ -0,0 +1,199 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import click
+from clint.textui import colored
+from utils import color_macro
+from throttle import parse_limit
+
+PYAWSBACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyawsbackup.py")
+POLL_INTERVAL = 0.5
+# Parallel part uploads of the aws cli (max_concurrent_requests)
+CLI_CONNECTIONS = 10
+
+# Example config:
+# {
+#   "max_jobs": 4, "cpu_workers": 8, "s3_connections": 32, "retries": 2,
+#   "upload_limit": "100M,09:00-18:00=20M", "read_limit": "200M",
+#   "defaults": {"compress": true, "engine": "native", "ionice": "idle"},
+#   "jobs": [
+#     {"folder": "/srv/db", "bucket": "backups", "priority": 10, "storage-class": "STANDARD_IA"},
+#     {"folder": "/srv/www", "bucket": "backups", "encrypt": true, "cert": "/etc/pyawsbackup/pub.pem"}
+#   ]
+# }
+
+
+def load_config(path):
+    with open(path) as f:
+        try:
+            config = json.load(f)
+        except ValueError as e:
+            raise click.UsageError(f"Could not parse config {path}: {e}")
+
+    if not config.get("jobs"):
+        raise click.UsageError(f"No jobs defined in config {path}")
+    for job in config["jobs"]:
+        if "folder" not in job or "bucket" not in job:
+            raise click.UsageError(f"Every job in {path} needs a folder and a bucket")
+    return config
+
+
+def job_args(options):
+    # Job options are the long options of the backup command, with or without dashes
+    args = []
+    for name, value in options.items():
+        flag = "--" + name.replace("_", "-")
+        if value is True:
+            args.append(flag)
+        elif value is False or value is None:
+            continue
+        else:
+            args += [flag, str(value)]
+    return args
+
+
+class Job:
+    def __init__(self, index, spec, config):
+        spec = dict(spec)
+        self.index = index
+        self.folder = spec.pop("folder")
+        self.bucket = spec.pop("bucket")
+        self.priority = spec.pop("priority", 0)
+        self.retries = spec.pop("retries", config.get("retries", 1))
+        self.options = dict(config.get("defaults", dict()))
+        self.options.update({k.replace("_", "-"): v for k, v in spec.items()})
+        self.name = self.options.get("jobname") or os.path.basename(os.path.normpath(self.folder))
+
+        self.attempt = 0
+        self.not_before = 0
+        self.process = None
+        self.log = None
+        self.started = None
+
+        max_jobs = config.get("max_jobs", 2)
+        cpu_workers = config.get("cpu_workers", os.cpu_count())
+        s3_connections = config.get("s3_connections", 32)
+
+        # zstd uses all cores by default, give every job an equal share of the workers instead. The clamped values
+        # are passed on, a job must not use more than it was admitted with.
+        self.cpu = 1
+        if self.options.get("compress"):
+            threads = self.options.get("compression-threads") or max(1, cpu_workers // max_jobs)
+            self.cpu = min(threads, cpu_workers)
+            self.options["compression-threads"] = self.cpu
+
+        if self.options.get("engine") == "native":
+            self.connections = min(self.options.get("upload-concurrency") or 8, s3_connections)
+            self.options["upload-concurrency"] = self.connections
+        else:
+            # The aws cli's concurrency cannot be set per run, a job it does not fit into takes the whole budget
+            self.connections = min(CLI_CONNECTIONS, s3_connections)
+
+        # Global limits are split evenly, a limit set on the job itself takes precedence
+        for limit in ("upload-limit", "read-limit"):
+            spec = config.get(limit.replace("-", "_"))
+            if spec and not self.options.get(limit):
+                self.options[limit] = str(parse_limit(str(spec)).scaled(1 / max_jobs))
+
+    def command(self):
+        return [sys.executable, PYAWSBACKUP, "backup", "--no-progress", "--no-color"] + job_args(self.options) + \
+               [self.folder, self.bucket]
+
+
+def do_backup_all(config, color):
+    # Colors
+    yellow = color_macro(color, colored.yellow)
+    cyan = color_macro(color, colored.cyan)
+    red = color_macro(color, colored.red)
+    green = color_macro(color, colored.green)
+
+    max_jobs = config.get("max_jobs", 2)
+    retry_delay = config.get("retry_delay", 60)
+    log_dir = config.get("log_dir")
+
+    jobs = [Job(i, spec, config) for i, spec in enumerate(config["jobs"])]
+    # Jobs of a bucket share their checkpoint, stat cache and log by jobname
+    seen = set()
+    for job in jobs:
+        if (job.bucket, job.name) in seen:
+            raise click.UsageError(f"Several jobs back up to {job.bucket}/{job.name}, give them distinct jobnames")
+        seen.add((job.bucket, job.name))
+    free = {
+        "cpu": config.get("cpu_workers", os.cpu_count()),
+        "connections": config.get("s3_connections", 32),
+    }
+    print(f"Running {cyan(str(len(jobs)))} jobs, at most {cyan(str(max_jobs))} at a time")
+
+    pending = sorted(jobs, key=lambda j: (-j.priority, j.index))
+    running = []
+    failed = []
+
+    def start(job):
+        job.attempt += 1
+        if log_dir:
+            # Laid out like the bucket, jobs with the same folder name in different places keep their own logs.
+            # Dry runs write to a local folder instead of a bucket.
+            bucket_dir = os.path.join(log_dir, job.bucket.strip("/").replace("/", "_"))
+            os.makedirs(bucket_dir, exist_ok=True)
+            job.log = open(os.path.join(bucket_dir, f"{job.name}.log"), "a+b")
+        else:
+            job.log = tempfile.TemporaryFile()
+        job.process = subprocess.Popen(job.command(), stdout=job.log, stderr=subprocess.STDOUT)
+        job.started = time.monotonic()
+        free["cpu"] -= job.cpu
+        free["connections"] -= job.connections
+        running.append(job)
+        print(f"Started {cyan(job.name)} (attempt {job.attempt}, {job.cpu} cpu, {job.connections} connections)",
+              flush=True)
+
+    def finish(job):
+        running.remove(job)
+        free["cpu"] += job.cpu
+        free["connections"] += job.connections
+        elapsed = time.monotonic() - job.started
+
+        if job.process.returncode == 0:
+            print(f"{cyan(job.name)} {green('DONE')} in {elapsed:.0f}s", flush=True)
+        else:
+            job.log.seek(0)
+            tail = job.log.read().decode("utf-8", "replace").strip().splitlines()[-5:]
+            print(f"{cyan(job.name)} {red('FAILED')} with exit code {job.process.returncode}", flush=True)
+            for line in tail:
+                print(f"    {line}")
+            if job.attempt <= job.retries:
+                print(f"Retrying {cyan(job.name)} in {retry_delay}s", flush=True)
+                job.not_before = time.monotonic() + retry_delay
+                pending.append(job)
+                pending.sort(key=lambda j: (-j.priority, j.index))
+            else:
+                failed.append(job)
+        job.log.close()
+
+    try:
+        while pending or running:
+            for job in [j for j in running if j.process.poll() is not None]:
+                finish(job)
+
+            # Jobs start in priority order, a job that does not fit blocks the ones after it so it cannot starve
+            now = time.monotonic()
+            for job in list(pending):
+                if job.not_before > now:
+                    continue
+                if len(running) >= max_jobs or job.cpu > free["cpu"] or job.connections > free["connections"]:
+                    break
+                pending.remove(job)
+                start(job)
+
+            time.sleep(POLL_INTERVAL)
+    finally:
+        for job in running:
+            job.process.terminate()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(jobs)} jobs failed: {', '.join(j.name for j in failed)}")
+    print(f"All jobs finished {green('successfully')}")
+    if log_dir:
+        print(f"Logs in {yellow(log_dir)}")
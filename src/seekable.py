@@ -0,0 +1,273 @@
+import hashlib
+import json
+import os
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from crypto import GCM_CIPHER, HEADER_SIZE, TAG_SIZE, SegmentDecryptor, native_crypto_available
+from tarstream import BLOCK, READ_SIZE, TarIndexer, TarParseStage
+
+# openssl enc writes "Salted__" and the 8 byte salt in front of the ciphertext
+SALT_HEADER = 16
+PBKDF2_ITERATIONS = 10000
+# A hard link member holds no data, only its header and GNU long name and long link blocks
+LINK_MEMBER_SIZE = 8 * BLOCK
+
+
+class SeekableCompression:
+    # Compresses fixed size blocks of the tar stream into independent zstd frames and indexes the tar members
+    def __init__(self, compression, frame_size=4 * 1024 * 1024):
+        self.compression = compression
+        self.frame_size = frame_size
+
+    def __str__(self):
+        return f"{self.compression} (seekable, {self.frame_size // 1024 // 1024} MiB frames)"
+
+    def get_pipe(self, input):
+        stage = SeekableCompress(self, input)
+        stage.start()
+        return stage
+
+
+class SeekableCompress(threading.Thread):
+    def __init__(self, seekable, input):
+        super(SeekableCompress, self).__init__(daemon=True)
+        self.seekable = seekable
+        self.args = ["seekable-zstd"]
+        self.returncode = None
+        self.error = None
+        self.indexer = TarIndexer()
+        self.frames = []
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            self.compress()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Seekable compression failed: {self.error}")
+        return self.returncode
+
+    def compress(self):
+        import zstandard
+
+        compression = self.seekable.compression
+        threads = compression.threads or os.cpu_count()
+        local = threading.local()
+
+        def compress_frame(data):
+            # ZstdCompressor instances are not thread safe
+            if not hasattr(local, "cctx"):
+                local.cctx = zstandard.ZstdCompressor(level=compression.level)
+            return local.cctx.compress(data)
+
+        uncompressed_offset = 0
+        compressed_offset = 0
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                data = self.input.read(self.seekable.frame_size)
+                if data:
+                    self.indexer.feed(data)
+                    pending.append((len(data), executor.submit(compress_frame, data)))
+
+                # Frames are written in order, at most threads + 1 are held in memory
+                while pending and (len(pending) > threads or not data):
+                    size, future = pending.popleft()
+                    frame = future.result()
+                    self.output.write(frame)
+                    self.frames.append([uncompressed_offset, compressed_offset, len(frame)])
+                    uncompressed_offset += size
+                    compressed_offset += len(frame)
+
+                if not data:
+                    break
+
+    def index(self):
+        return {
+            "version": 1,
+            "frame_size": self.seekable.frame_size,
+            "frames": self.frames,
+            "members": self.indexer.members,
+            "links": self.indexer.link_targets,
+        }
+
+
+class TarIndex(TarParseStage):
+    # Pass-through stage for uncompressed seekable archives, offsets in the index are archive offsets
+    def __init__(self, input):
+        super(TarIndex, self).__init__(TarIndexer(), input, "tar-index")
+
+    def index(self):
+        return {"version": 1, "frame_size": None, "frames": [], "members": self.parser.members,
+                "links": self.parser.link_targets}
+
+
+class Uncompressed:
+    # Stand-in for SeekableCompression when the archive is not compressed
+    def get_pipe(self, input):
+        stage = TarIndex(input)
+        stage.start()
+        return stage
+
+
+def select_members(index, paths):
+    # Members matching a path exactly or lying below it
+    paths = [p.strip("/") for p in paths]
+    return [m for m in index["members"]
+            if any(m[0] == p or m[0].startswith(p + "/") for p in paths)]
+
+
+def merge_ranges(members):
+    ranges = []
+    for _, start, end in sorted(members, key=lambda m: m[1]):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def hard_links(index, members, reader):
+    # {link path: target path} of the hard links among members. Indexes written before links were recorded
+    # only tell by the headers, the members too small to hold any data are read and parsed.
+    if "links" in index:
+        return {m[0]: index["links"][m[0]] for m in members if m[0] in index["links"]}
+    indexer = TarIndexer()
+    for start, end in merge_ranges([m for m in members if m[2] - m[1] <= LINK_MEMBER_SIZE]):
+        indexer.feed(reader.read(start, end))
+    return indexer.link_targets
+
+
+class RangeFile:
+    # File-like view of a byte range of the archive, for tarfile's stream mode
+    def __init__(self, reader, start, end):
+        self.reader = reader
+        self.pos = start
+        self.end = end
+
+    def read(self, size=-1):
+        end = self.end if size < 0 else min(self.end, self.pos + size)
+        data = self.reader.read(self.pos, end) if end > self.pos else b""
+        self.pos = end
+        return data
+
+
+def copy_member(reader, member, name, output):
+    # Writes the member as a regular entry called name, for hard links whose target is not restored with them
+    tar = tarfile.open(fileobj=RangeFile(reader, member[1], member[2]), mode="r|", bufsize=READ_SIZE)
+    info = tar.next()
+    data = tar.extractfile(info)
+    info.name = name
+    output.write(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"))
+    while data:
+        chunk = data.read(READ_SIZE)
+        if not chunk:
+            break
+        output.write(chunk)
+    output.write(bytes(-info.size % BLOCK))
+
+
+def derive_ctr_key(passphrase, salt):
+    # Same derivation as openssl enc -pbkdf2 (sha256, 10000 iterations)
+    material = hashlib.pbkdf2_hmac("sha256", passphrase.encode("utf-8"), salt, PBKDF2_ITERATIONS, 48)
+    return material[:32], int.from_bytes(material[32:], "big")
+
+
+def decrypt_range(key, iv, offset, data):
+    # AES-CTR lets decryption start at any 16 byte block, offset must be block aligned. Decrypting in-process keeps
+    # the key off the openssl command line, where any local user could read it.
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    counter = (iv + offset // 16) % (1 << 128)
+    decryptor = Cipher(algorithms.AES(key), modes.CTR(counter.to_bytes(16, "big"))).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+
+class RangeReader:
+    # Reads uncompressed byte ranges of a seekable archive with S3 Range GETs
+    def __init__(self, client, bucket, key, index, passphrase=None, cipher=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.frames = index["frames"]
+        self.ctr_key = None
+        self.decryptor = None
+
+        if passphrase and cipher == GCM_CIPHER:
+            self.decryptor = SegmentDecryptor(passphrase, self.get(0, HEADER_SIZE))
+            self.size = client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        elif passphrase:
+            if not native_crypto_available():
+                raise RuntimeError("Selective restore of openssl encrypted backups requires cryptography, "
+                                   "install pyawsbackup[native]")
+            salt = self.get(0, SALT_HEADER)[8:]
+            self.ctr_key = derive_ctr_key(passphrase, salt)
+
+    def get(self, start, end):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}")["Body"].read()
+
+    def get_segments(self, start, end):
+        # GCM segments are authenticated one by one, fetch and decrypt every segment the range touches
+        decryptor = self.decryptor
+        stored_segment = decryptor.segment_size + TAG_SIZE
+        segments = -(-(self.size - HEADER_SIZE) // stored_segment)
+        first = start // decryptor.segment_size
+        last = (end - 1) // decryptor.segment_size
+        stored = self.get(decryptor.stored_size(first), min(decryptor.stored_size(last + 1), self.size))
+
+        out = bytearray()
+        for i in range(first, last + 1):
+            pos = (i - first) * stored_segment
+            out += decryptor.decrypt(i, stored[pos:pos + stored_segment], i == segments - 1)
+        offset = first * decryptor.segment_size
+        return bytes(out[start - offset:end - offset])
+
+    def get_stored(self, start, end):
+        # Byte range of the stored object without the encryption header, decrypted
+        if self.decryptor:
+            return self.get_segments(start, end)
+        if not self.ctr_key:
+            return self.get(start, end)
+        aligned = start - start % 16
+        data = self.get(SALT_HEADER + aligned, SALT_HEADER + end)
+        return decrypt_range(self.ctr_key[0], self.ctr_key[1], aligned, data)[start - aligned:]
+
+    def read(self, start, end):
+        if not self.frames:
+            return self.get_stored(start, end)
+
+        import zstandard
+
+        first = max(i for i, f in enumerate(self.frames) if f[0] <= start)
+        last = max(i for i, f in enumerate(self.frames) if f[0] < end)
+        c_start = self.frames[first][1]
+        c_end = self.frames[last][1] + self.frames[last][2]
+        stored = self.get_stored(c_start, c_end)
+
+        dctx = zstandard.ZstdDecompressor()
+        out = bytearray()
+        for frame in self.frames[first:last + 1]:
+            pos = frame[1] - c_start
+            out += dctx.decompress(stored[pos:pos + frame[2]])
+        u_start = self.frames[first][0]
+        return bytes(out[start - u_start:end - u_start])
+
+
+def load_index(data):
+    return json.loads(data.decode("utf-8"))
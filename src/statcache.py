@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import time
+from catalog import catalog_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+                                  ctime INTEGER, sha256 TEXT) WITHOUT ROWID;
+"""
+
+# A file changed this close to the start of the backup may change again without its timestamps changing
+RACY_SECONDS = 2
+
+
+def stat_cache_path(bucket, jobname):
+    return os.path.join(os.path.dirname(catalog_path()), "statcache", bucket, f"{jobname}.sqlite")
+
+
+def stat_key(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class StatCache:
+    # Digests of the files of the last backup of a job, keyed on their stat so unchanged files are not hashed again
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Looked up from the manifest stage, saved from the main thread once the stage finished
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.start = time.time_ns()
+        self.updates = []
+        self.hits = 0
+
+    def close(self):
+        self.db.close()
+
+    def lookup(self, path, size, mtime):
+        # Returns the cached digest, or None and the stat key to store the new digest under
+        try:
+            st = os.lstat("/" + path)
+        except OSError:
+            return None, None
+        if st.st_size != size or int(st.st_mtime) != int(float(mtime)):
+            # The file changed after tar read it, its digest must not be cached
+            return None, None
+
+        key = stat_key(st)
+        row = self.db.execute("SELECT dev, ino, size, mtime, ctime, sha256 FROM files WHERE path = ?",
+                              (os.fsencode(path),)).fetchone()
+        if row and tuple(row[:5]) == key:
+            self.hits += 1
+            return row[5], None
+        if self.start - max(st.st_mtime_ns, st.st_ctime_ns) < RACY_SECONDS * 10 ** 9:
+            return None, None
+        return None, key
+
+    def add(self, path, key, attrs):
+        # attrs receives its digest once the file is hashed
+        self.updates.append((path, key, attrs))
+
+    def save(self, entries):
+        # entries is the complete file list of the backup, rows of files that no longer exist are dropped
+        paths = set(os.fsencode(path) for path in entries)
+        with self.db:
+            gone = [row for row in self.db.execute("SELECT path FROM files") if row[0] not in paths]
+            self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(os.fsencode(path),) + key + (attrs["sha256digest"],)
+                                 for path, key, attrs in self.updates])
+        self.updates = []
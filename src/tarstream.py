@@ -0,0 +1,212 @@
+import os
+import threading
+
+BLOCK = 512
+READ_SIZE = 1024 * 1024
+
+# mtree type names of the tar typeflags
+TYPES = {
+    "0": "file",
+    "\0": "file",
+    "1": "file",
+    "2": "link",
+    "3": "char",
+    "4": "block",
+    "5": "dir",
+    "6": "fifo",
+    "7": "file",
+}
+
+
+class TarIndexer:
+    # Incremental tar header parser, records the byte range of every member in the uncompressed stream
+    def __init__(self):
+        self.offset = 0
+        self.members = []
+        # Target of every hard link by path, restoring a link alone needs its target's data
+        self.link_targets = dict()
+        self.buf = bytearray()
+        self.need = BLOCK
+        self.skip = 0
+        self.data_left = 0
+        self.state = "header"
+        self.member_start = None
+        self.pending = dict()
+        self.entry = None
+        self.ext_type = None
+        self.ext_size = 0
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data):
+            if self.skip:
+                n = min(self.skip, len(data) - pos)
+                if self.data_left:
+                    member_data = min(n, self.data_left)
+                    self.on_data(data[pos:pos + member_data])
+                    self.data_left -= member_data
+                self.skip -= n
+                pos += n
+                self.offset += n
+                if not self.skip:
+                    self.finish_entry()
+                continue
+
+            n = min(self.need - len(self.buf), len(data) - pos)
+            self.buf += data[pos:pos + n]
+            pos += n
+            self.offset += n
+            if len(self.buf) == self.need:
+                block = bytes(self.buf)
+                self.buf = bytearray()
+                if self.state == "header":
+                    self.parse_header(block)
+                else:
+                    self.parse_extension(block)
+
+    def parse_header(self, block):
+        if not any(block):
+            # End of archive marker
+            return
+
+        header_start = self.offset - BLOCK
+        if self.member_start is None:
+            self.member_start = header_start
+
+        typeflag = chr(block[156])
+        size = parse_number(block[124:136])
+        padded = -(-size // BLOCK) * BLOCK
+
+        if typeflag in "LKxg":
+            self.ext_type = typeflag
+            self.ext_size = size
+            if padded:
+                self.state = "extension"
+                self.need = padded
+            return
+
+        header = {
+            "path": self.pending.get("path") or parse_name(block),
+            "type": typeflag,
+            "size": size,
+            "mode": parse_number(block[100:108]) & 0o7777,
+            "uid": parse_number(block[108:116]),
+            "gid": parse_number(block[116:124]),
+            "mtime": self.pending.get("mtime") or str(parse_number(block[136:148])),
+            "link": self.pending.get("linkpath") or block[157:257].split(b"\0", 1)[0],
+            "uname": self.pending.get("uname") or block[265:297].split(b"\0", 1)[0],
+            "gname": self.pending.get("gname") or block[297:329].split(b"\0", 1)[0],
+        }
+        header["path"] = os.fsdecode(header["path"]).rstrip("/")
+        if typeflag == "1":
+            self.link_targets[header["path"]] = os.fsdecode(header["link"]).rstrip("/")
+
+        self.entry = [header["path"], self.member_start]
+        self.member_start = None
+        self.pending = dict()
+        self.on_header(header)
+
+        # Hard links carry no data even if the size field is set
+        self.data_left = size if typeflag not in "1256" else 0
+        self.skip = padded if typeflag not in "1256" else 0
+        if not self.skip:
+            self.finish_entry()
+
+    def parse_extension(self, block):
+        data = block[:self.ext_size]
+        if self.ext_type == "L":
+            self.pending["path"] = data.split(b"\0", 1)[0]
+        elif self.ext_type == "K":
+            self.pending["linkpath"] = data.split(b"\0", 1)[0]
+        elif self.ext_type == "x":
+            for key, value in parse_pax(data):
+                if key in (b"path", b"linkpath", b"uname", b"gname"):
+                    self.pending[key.decode("ascii")] = value
+                elif key == b"mtime":
+                    self.pending["mtime"] = value.decode("ascii")
+        self.state = "header"
+        self.need = BLOCK
+
+    def finish_entry(self):
+        self.entry.append(self.offset)
+        self.members.append(self.entry)
+        self.entry = None
+        self.on_end()
+
+    def on_header(self, header):
+        pass
+
+    def on_data(self, data):
+        pass
+
+    def on_end(self):
+        pass
+
+
+def parse_name(block):
+    name = block[0:100].split(b"\0", 1)[0]
+    if block[257:262] == b"ustar":
+        prefix = block[345:500].split(b"\0", 1)[0]
+        if prefix:
+            name = prefix + b"/" + name
+    return name
+
+
+def parse_number(field):
+    if field[0] & 0x80:
+        # GNU base-256 encoding for values that do not fit the octal field
+        return int.from_bytes(field[1:], "big")
+    return int(field.split(b"\0", 1)[0].strip() or b"0", 8)
+
+
+def parse_pax(data):
+    # Records are "<length> <key>=<value>\n", length includes itself
+    records = []
+    pos = 0
+    while pos < len(data):
+        length = data[pos:].split(b" ", 1)[0]
+        if not length.isdigit():
+            break
+        record = data[pos:pos + int(length)]
+        key, _, value = record.split(b" ", 1)[1].partition(b"=")
+        records.append((key, value.rstrip(b"\n")))
+        pos += int(length)
+    return records
+
+
+class TarParseStage(threading.Thread):
+    # Pass-through stage that feeds the tar stream to a parser on its way to the next stage
+    def __init__(self, parser, input, name="tar-parse"):
+        super(TarParseStage, self).__init__(daemon=True)
+        self.parser = parser
+        self.args = [name]
+        self.returncode = None
+        self.error = None
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            while True:
+                data = self.input.read(READ_SIZE)
+                if not data:
+                    break
+                self.parser.feed(data)
+                self.output.write(data)
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"{self.args[0]} failed: {self.error}")
+        return self.returncode
@@ -0,0 +1,175 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from chunkstore import CHUNK_PREFIX
+
+# Objects in these classes have to be restored before they can be read, GLACIER_IR is readable right away
+ARCHIVE_CLASSES = ("GLACIER", "DEEP_ARCHIVE")
+TIERS = ["Bulk", "Standard", "Expedited"]
+# Polling starts at FIRST_POLL seconds and backs off to about the typical duration of a thaw of the tier,
+# polling more often only costs requests
+FIRST_POLL = 15
+MAX_POLL = {"Expedited": 60, "Standard": 10 * 60, "Bulk": 30 * 60}
+# Above this many keys their states come from listings of their prefixes, one request per 1000 objects instead of
+# one HEAD per key
+LIST_THRESHOLD = 1000
+
+
+def head_object(bucket, key, engine=None):
+    if engine:
+        return engine.client.head_object(Bucket=bucket, Key=key)
+    out = subprocess.check_output(["aws", "s3api", "head-object", "--bucket", bucket, "--key", key, "--output", "json"])
+    return json.loads(out.decode("utf-8"))
+
+
+def object_state(head):
+    # "ready", "archived" or "thawing"
+    if head.get("StorageClass") not in ARCHIVE_CLASSES:
+        return "ready"
+    restore = head.get("Restore")
+    if not restore:
+        return "archived"
+    return "thawing" if 'ongoing-request="true"' in restore else "ready"
+
+
+def listed_state(obj):
+    # Like object_state for an entry of a listing with the RestoreStatus attribute
+    if obj.get("StorageClass", "STANDARD") not in ARCHIVE_CLASSES:
+        return "ready"
+    status = obj.get("RestoreStatus")
+    if not status:
+        return "archived"
+    return "thawing" if status.get("IsRestoreInProgress") else "ready"
+
+
+def list_states(bucket, prefix, engine=None):
+    # States of every object under prefix
+    if engine:
+        states = dict()
+        paginator = engine.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, OptionalObjectAttributes=["RestoreStatus"]):
+            states.update({o["Key"]: listed_state(o) for o in page.get("Contents", [])})
+        return states
+    out = subprocess.check_output(["aws", "s3api", "list-objects-v2", "--bucket", bucket, "--prefix", prefix,
+                                   "--optional-object-attributes", "RestoreStatus", "--output", "json"])
+    listing = json.loads(out.decode("utf-8")) if out.strip() else dict()
+    return {o["Key"]: listed_state(o) for o in listing.get("Contents") or []}
+
+
+def state_prefix(key):
+    # Chunks are spread over 256 directories, a single listing of the store is cheaper
+    return CHUNK_PREFIX + "/" if key.startswith(CHUNK_PREFIX + "/") else os.path.dirname(key) + "/"
+
+
+def list_storage_classes(bucket, prefix, engine):
+    # One request per 1000 objects instead of one per object
+    classes = dict()
+    for page in engine.client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        classes.update({o["Key"]: o.get("StorageClass", "STANDARD") for o in page.get("Contents", [])})
+    return classes
+
+
+def request_thaw(bucket, key, tier, days, engine=None):
+    request = {"Days": days, "GlacierJobParameters": {"Tier": tier}}
+    if engine:
+        from botocore.exceptions import ClientError
+        try:
+            engine.client.restore_object(Bucket=bucket, Key=key, RestoreRequest=request)
+        except ClientError as e:
+            # Another restore asked for it already
+            if e.response["Error"]["Code"] != "RestoreAlreadyInProgress":
+                raise
+        return
+
+    aws = subprocess.run(
+        ["aws", "s3api", "restore-object", "--bucket", bucket, "--key", key, "--restore-request", json.dumps(request)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    if aws.returncode != 0 and b"RestoreAlreadyInProgress" not in aws.stderr:
+        raise RuntimeError(f"Could not request restore of {bucket}/{key}: {aws.stderr.decode('utf-8', 'replace').strip()}")
+
+
+class Thaw:
+    # Requests the restore of all archived objects a restore needs at once, then polls them in the background.
+    # wait(key) blocks until that object can be read, so downloads start as soon as their own object thawed.
+    def __init__(self, bucket, engine=None, tier="Standard", days=1, concurrency=None):
+        self.bucket = bucket
+        self.engine = engine
+        self.tier = tier
+        self.days = days
+        self.concurrency = concurrency or (engine.concurrency if engine else 8)
+        self.ready = dict()
+        self.lock = threading.Lock()
+        self.poller = None
+        self.error = None
+
+    def request(self, keys, classes=None):
+        # classes optionally maps keys to their storage class from a listing, saves a HEAD per listed object
+        # that is not archived
+        classes = classes or dict()
+        keys = [k for k in dict.fromkeys(keys) if k not in self.ready]
+        with self.lock:
+            for key in keys:
+                if key in classes and classes[key] not in ARCHIVE_CLASSES:
+                    self.ready[key] = threading.Event()
+                    self.ready[key].set()
+        keys = [k for k in keys if k not in self.ready]
+
+        states = self.states(keys)
+        archived = [k for k, state in zip(keys, states) if state == "archived"]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(lambda k: request_thaw(self.bucket, k, self.tier, self.days, self.engine), archived))
+
+        pending = len([s for s in states if s != "ready"])
+        with self.lock:
+            for key, state in zip(keys, states):
+                self.ready[key] = threading.Event()
+                if state == "ready":
+                    self.ready[key].set()
+            if pending and not self.poller:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+        return pending
+
+    def states(self, keys):
+        listed = dict()
+        if len(keys) > LIST_THRESHOLD:
+            for prefix in dict.fromkeys(state_prefix(k) for k in keys):
+                listed.update(list_states(self.bucket, prefix, self.engine))
+        # Few keys, or keys a listing did not show yet, are asked one by one
+        heads = [k for k in keys if k not in listed]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            listed.update(zip(heads, executor.map(lambda k: object_state(head_object(self.bucket, k, self.engine)),
+                                                  heads)))
+        return [listed[k] for k in keys]
+
+    def poll(self):
+        interval = FIRST_POLL
+        try:
+            while True:
+                with self.lock:
+                    keys = [k for k, event in self.ready.items() if not event.is_set()]
+                    if not keys:
+                        self.poller = None
+                        return
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_POLL[self.tier])
+                for key, state in zip(keys, self.states(keys)):
+                    if state == "ready":
+                        self.ready[key].set()
+        except Exception as e:
+            # Release the waiting restore, it reports the error
+            self.error = e
+            for event in list(self.ready.values()):
+                event.set()
+
+    def wait(self, key):
+        event = self.ready.get(key)
+        if event:
+            event.wait()
+        if self.error:
+            raise RuntimeError(f"Waiting for {self.bucket}/{key} to thaw failed: {self.error}")
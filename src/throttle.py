@@ -0,0 +1,230 @@
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime
+import click
+from utils import parse_size
+
+READ_SIZE = 256 * 1024
+PAUSE_INTERVAL = 1
+
+
+class Limit:
+    # Byte rate that may depend on the time of day, None is unlimited and 0 pauses the stream
+    def __init__(self, default, windows=()):
+        self.default = default
+        self.windows = list(windows)
+
+    def rate_at(self, now):
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start < end else minute >= start or minute < end
+            if inside:
+                return rate
+        return self.default
+
+    def scaled(self, factor):
+        scale = lambda rate: rate if rate is None else int(rate * factor)
+        return Limit(scale(self.default), [(start, end, scale(rate)) for start, end, rate in self.windows])
+
+    def __str__(self):
+        windows = [f"{start // 60:02}:{start % 60:02}-{end // 60:02}:{end % 60:02}={format_rate(rate)}"
+                   for start, end, rate in self.windows]
+        return ",".join([format_rate(self.default)] + windows)
+
+
+def parse_rate(rate):
+    if rate.strip().lower() in ("off", "none", "unlimited"):
+        return None
+    return parse_size(rate)
+
+
+def format_rate(rate):
+    return "off" if rate is None else str(rate)
+
+
+def parse_minute(value):
+    hours, _, minutes = value.partition(":")
+    minute = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError(value)
+    return minute
+
+
+def parse_limit(spec):
+    # "50M" or a default rate followed by time windows, e.g. "50M,09:00-18:00=5M,22:00-06:00=off"
+    default = None
+    windows = []
+    for part in spec.split(","):
+        if "=" not in part:
+            default = parse_rate(part)
+            continue
+        window, _, rate = part.partition("=")
+        try:
+            start, end = [parse_minute(t) for t in window.split("-")]
+        except ValueError:
+            raise click.BadParameter(f"invalid time window {window}, expected HH:MM-HH:MM")
+        windows.append((start, end, parse_rate(rate)))
+    return Limit(default, windows)
+
+
+class TokenBucket:
+    # Byte rate limit that may be shared by several stages, allows bursts of one second
+    def __init__(self, limit, name="limit"):
+        self.limit = limit
+        self.name = name
+        # Set at runtime through the control socket or signals, takes precedence over the schedule
+        self.override = None
+        self.paused = False
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def rate(self):
+        if self.paused:
+            return 0
+        if self.override is not None:
+            return self.override[0]
+        return self.limit.rate_at(datetime.now())
+
+    def consume(self, n):
+        while True:
+            with self.lock:
+                rate = self.rate()
+                now = time.monotonic()
+                elapsed = now - self.last
+                self.last = now
+                if rate is None:
+                    return
+                if rate == 0:
+                    # Paused, check again later without building up tokens
+                    self.tokens = 0
+                    wait = PAUSE_INTERVAL
+                else:
+                    self.tokens = min(rate, self.tokens + elapsed * rate)
+                    # Going into debt lets reads larger than the bucket pass, later callers wait for it
+                    self.tokens -= n
+                    wait = -self.tokens / rate if self.tokens < 0 else 0
+            time.sleep(wait)
+            if rate:
+                return
+
+    def set_rate(self, rate):
+        # rate may be None to lift the limit until the override is cleared
+        self.override = (rate,)
+
+    def clear_override(self):
+        self.override = None
+
+    def status(self):
+        override = f" (override {format_rate(self.override[0])})" if self.override else ""
+        paused = " (paused)" if self.paused else ""
+        rate = self.rate()
+        current = "unlimited" if rate is None else f"{rate} B/s"
+        return f"{self.name} {current}, schedule {self.limit}{override}{paused}"
+
+
+class ThrottleStage(threading.Thread):
+    # Pass-through stage that lets at most rate bytes per second through
+    def __init__(self, bucket, input):
+        super(ThrottleStage, self).__init__(daemon=True)
+        self.bucket = bucket
+        self.args = ["throttle"]
+        self.returncode = None
+        self.error = None
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def run(self):
+        try:
+            while True:
+                data = self.input.read(READ_SIZE)
+                if not data:
+                    break
+                self.bucket.consume(len(data))
+                self.output.write(data)
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.output.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Throttling failed: {self.error}")
+        return self.returncode
+
+
+def get_throttle_pipe(bucket, input):
+    stage = ThrottleStage(bucket, input)
+    stage.start()
+    return stage
+
+
+class ControlServer(threading.Thread):
+    # Unix socket taking one command per connection:
+    #   status | pause | resume | set <name> <rate|off|schedule>
+    def __init__(self, path, buckets):
+        super(ControlServer, self).__init__(daemon=True)
+        self.path = path
+        self.buckets = {b.name: b for b in buckets}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            with conn:
+                command = conn.makefile("r").readline().split()
+                try:
+                    reply = self.handle(command)
+                except (ValueError, click.BadParameter) as e:
+                    reply = f"error: {e}"
+                conn.sendall((reply + "\n").encode("utf-8"))
+
+    def handle(self, command):
+        if command == ["pause"] or command == ["resume"]:
+            for bucket in self.buckets.values():
+                bucket.paused = command[0] == "pause"
+        elif len(command) == 3 and command[0] == "set":
+            if command[1] not in self.buckets:
+                raise ValueError(f"unknown limit {command[1]}, one of {', '.join(self.buckets)}")
+            if command[2] == "schedule":
+                self.buckets[command[1]].clear_override()
+            else:
+                self.buckets[command[1]].set_rate(parse_rate(command[2]))
+        elif command != ["status"]:
+            raise ValueError("expected status, pause, resume or set <name> <rate|off|schedule>")
+        return "\n".join(b.status() for b in self.buckets.values())
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def install_signal_handlers(buckets):
+    # SIGUSR1 pauses or resumes all limited stages, SIGUSR2 drops runtime overrides
+    def toggle(signum, frame):
+        for bucket in buckets:
+            bucket.paused = not bucket.paused
+
+    def reset(signum, frame):
+        for bucket in buckets:
+            bucket.paused = False
+            bucket.clear_override()
+
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, reset)
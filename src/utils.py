@@ -1,39 +1,73 @@
 import click
 import subprocess
 import os
+import shutil
+from datetime import datetime
+from functools import lru_cache
 
 from clint.textui import colored
 
-def check_dependencies(compression, crypto):
-    try:
-        subprocess.check_call(["which", "tar"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except:
+DATE_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+@lru_cache(maxsize=None)
+def which(tool):
+    # Resolved once per process instead of forking which for every check
+    return shutil.which(tool)
+
+
+def check_dependencies(compression, crypto, native=False, native_compression=False, native_crypto=False):
+    if not which("tar"):
         raise click.UsageError("pyawsbackup requires the tar utility to be installed in your $PATH")
 
-    try:
-        subprocess.check_call(["which", "aws"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except:
+    if native:
+        try:
+            import boto3
+        except ImportError:
+            raise click.BadOptionUsage("engine", "native engine requires boto3, install pyawsbackup[native]")
+    elif not which("aws"):
         raise click.UsageError("pyawsbackup requires the aws cli to be installed in your $PATH")
 
-    if crypto:
+    if crypto and native_crypto:
         try:
-            subprocess.check_call(["which", "openssl"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except:
-            raise click.BadOptionUsage("encrypt", "option encrypt requires openssl in your $PATH")
+            import cryptography
+        except ImportError:
+            raise click.BadOptionUsage("native-crypto", "option native-crypto requires cryptography, install pyawsbackup[native]")
+    elif crypto and not which("openssl"):
+        raise click.BadOptionUsage("encrypt", "option encrypt requires openssl in your $PATH")
 
-    if compression:
+    if compression and native_compression:
         try:
-            subprocess.check_call(["which", "zstd"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except:
-            raise click.BadOptionUsage("compress", "option compress requires zstd in your $PATH")
+            import zstandard
+        except ImportError:
+            raise click.BadOptionUsage("native-compression", "option native-compression requires python-zstandard, install pyawsbackup[native]")
+    elif compression and not which("zstd"):
+        raise click.BadOptionUsage("compress", "option compress requires zstd in your $PATH")
 
 
 def supports_pv():
-    try:
-        subprocess.check_call(["which", "pv"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return True
-    except:
-        return False
+    return which("pv") is not None
+
+
+def get_pv_pipe(input):
+    pv = subprocess.Popen(
+        ["pv", "-f"],
+        stdin=input if input else subprocess.PIPE,
+        stdout=subprocess.PIPE
+    )
+    return pv
+
+
+def lower_priority(nice, ionice):
+    # Child stages inherit the cpu and io priority of this process
+    if nice:
+        os.nice(nice)
+    if ionice:
+        io_class = {"idle": ["-c", "3"], "best-effort": ["-c", "2", "-n", "7"]}[ionice]
+        try:
+            subprocess.check_call(["ionice"] + io_class + ["-p", str(os.getpid())], stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            raise click.BadOptionUsage("ionice", "option ionice requires the ionice utility (util-linux)")
 
 
 def check_folder_exists(folder):
@@ -53,4 +87,28 @@ def s3_url(bucket, path):
     if path:
         return f"s3://{bucket}/{path}"
     else:
-        return f"s3://{bucket}"
\ No newline at end of file
+        return f"s3://{bucket}"
+
+def s3_list(bucket, prefix):
+    # Lists the immediate children (objects and common prefixes) below prefix
+    out = subprocess.check_output(["aws", "s3", "ls", s3_url(bucket, prefix)]).decode("utf-8")
+    return [x.rsplit(" ", 1)[1].strip("/") for x in out.splitlines()]
+
+
+def parse_size(size):
+    # Sizes like 512K, 20M or 1G, plain numbers are bytes
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in units else ""
+    try:
+        value = float(size[:len(size) - len(unit)])
+    except ValueError:
+        raise click.BadParameter(f"invalid size {size}, expected a number with an optional K, M or G suffix")
+    return int(value * units[unit])
+
+
+def parse_date(date):
+    try:
+        return datetime.strptime(date, DATE_FORMAT)
+    except:
+        raise RuntimeError(f"date ({date}) has invalid date format, expected {DATE_FORMAT}")
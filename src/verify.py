@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from catalog import list_objects
+from clint.textui import colored, puts
+from metrics import link
+from mtree import ManifestBuilder, parse_mtree
+from restore import archive_keys, build_archive_pipeline, build_download_pipeline, fetch_list, iter_pipeline, \
+    open_list, resolve_chain, wait_pipeline
+from s3 import MIN_PART_SIZE
+from tarstream import READ_SIZE
+from thaw import ARCHIVE_CLASSES
+from utils import color_macro, parse_date
+
+
+def check_object(key, obj):
+    # Returns a problem description, or None if the listing looks like a complete upload
+    if obj is None:
+        return f"{key}: missing"
+    if obj["Size"] == 0:
+        return f"{key}: empty"
+    etag = obj.get("ETag", "").strip('"')
+    parts = etag.partition("-")[2]
+    if parts and (not parts.isdigit() or obj["Size"] <= (int(parts) - 1) * MIN_PART_SIZE):
+        # Every part of a multipart upload but the last is at least MIN_PART_SIZE
+        return f"{key}: size {obj['Size']} does not fit its etag {etag}"
+    if obj.get("StorageClass") in ARCHIVE_CLASSES:
+        return f"{key}: archived in {obj['StorageClass']}, thaw it with restore before a full verify"
+    return None
+
+
+def quick_verify(bucket, jobname, date, meta, backup_content, engine):
+    # Only the listings are read, no object is downloaded
+    keys = archive_keys(bucket, jobname, date, meta, backup_content, engine)
+    objects = list_objects(bucket, os.path.join(jobname, date) + "/", engine)
+    if any(k.startswith("chunks/") for k in keys):
+        objects.update(list_objects(bucket, "chunks/", engine))
+
+    list_name = next((x for x in backup_content if x in (f"{jobname}.list", f"{jobname}.list.aes")), None)
+    problems = [] if list_name else [f"{os.path.join(jobname, date)}: file list missing"]
+    problems += [p for p in (check_object(k, objects.get(k)) for k in dict.fromkeys(keys)) if p]
+    return problems, len(keys)
+
+
+class VerifyStage(threading.Thread):
+    # Last stage of a download pipeline, hashes the entries of the tar stream without extracting them
+    def __init__(self, input):
+        super(VerifyStage, self).__init__(daemon=True)
+        self.builder = ManifestBuilder()
+        self.args = ["verify"]
+        self.stdout = None
+        self.returncode = None
+        self.error = None
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+
+    def run(self):
+        try:
+            while True:
+                data = self.input.read(READ_SIZE)
+                if not data:
+                    break
+                self.builder.feed(data)
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            self.builder.close()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise RuntimeError(f"Reading the archive failed: {self.error}")
+        return self.returncode
+
+    def entries(self):
+        return self.builder.resolve()
+
+
+def get_verify_pipe(input):
+    stage = VerifyStage(input)
+    stage.start()
+    return stage
+
+
+def verify_pipeline(pipe):
+    stage = get_verify_pipe(link(pipe, None))
+    pipe.append(stage)
+    wait_pipeline(pipe)
+    return stage.entries()
+
+
+def compare_entries(expected, archived, complete):
+    # archived holds the entries read from the archive, complete is set if it has to contain every file of the list
+    problems = []
+    for path, attrs in archived.items():
+        listed = expected.get(path)
+        if listed is None:
+            problems.append(f"{path}: not in the file list")
+            continue
+        for k in ("size", "sha256digest"):
+            if k in attrs and k in listed and attrs[k] != listed[k]:
+                problems.append(f"{path}: {k} is {attrs[k]}, the file list has {listed[k]}")
+    if complete:
+        problems += [f"{path}: missing from the archive" for path, attrs in expected.items()
+                     if path not in archived and attrs.get("type") == "file"]
+    return problems
+
+
+def full_verify(bucket, jobname, date, meta, backup_content, engine, volume_concurrency):
+    # Streams the archive through download, decryption and decompression and hashes every entry
+    pipe = open_list(bucket, jobname, date, "list", meta, backup_content, engine)
+    if pipe is None:
+        return [f"{os.path.join(jobname, date)}: file list missing"], 0
+    expected = parse_mtree(iter_pipeline(pipe))
+
+    volumes = fetch_list(bucket, jobname, date, "volumes", meta, backup_content, engine)
+    if volumes:
+        names = [v["name"] for v in json.loads(volumes.decode("utf-8"))["volumes"]]
+        with ThreadPoolExecutor(max_workers=volume_concurrency) as executor:
+            parts = list(executor.map(
+                lambda name: verify_pipeline(build_archive_pipeline(bucket, jobname, date, name, meta, engine, False)),
+                names
+            ))
+        archived = dict()
+        for part in parts:
+            archived.update(part)
+    else:
+        archived = verify_pipeline(build_download_pipeline(bucket, jobname, date, meta, backup_content, engine, False))
+
+    # Incremental archives only hold the changed entries, their file list covers the whole tree
+    return compare_entries(expected, archived, meta.get("type", "full") == "full"), len(archived)
+
+
+def verify_backup(bucket, jobname, date, meta, backup_content, engine, quick, volume_concurrency):
+    # Returns the number of checked objects or entries and the problems found
+    try:
+        if quick:
+            return quick_verify(bucket, jobname, date, meta, backup_content, engine)
+        return full_verify(bucket, jobname, date, meta, backup_content, engine, volume_concurrency)
+    except Exception as e:
+        # A missing object, a denied request or a failing stage only fails this backup, the others are still checked
+        return [str(e) or type(e).__name__], 0
+
+
+def do_verify(color, date, key, engine, catalog, quick, volume_concurrency, job_concurrency, bucket, jobname):
+    # Colors
+    yellow = color_macro(color, colored.yellow)
+    cyan = color_macro(color, colored.cyan)
+    red = color_macro(color, colored.red)
+    green = color_macro(color, colored.green)
+
+    if date:
+        parse_date(date)
+    try:
+        jobs = [jobname] if jobname else catalog.jobs()
+    except:
+        raise RuntimeError(f"Could not list bucket {bucket}, please double check the name")
+
+    # A backup can only be restored together with the backups it is based on. The chains are resolved here,
+    # the catalog's sqlite connection belongs to this thread.
+    print(f"Resolving backup chains of {len(jobs)} jobs...", end="", flush=True)
+    backups = []
+    failed = []
+    for job in jobs:
+        job_date = date or catalog.latest(job)
+        if not job_date or not catalog.has_date(job, job_date):
+            print()
+            puts(f"{cyan(job)}: no backup{' for ' + date if date else ''} found, {red('FAILED')}")
+            failed.append(job)
+            continue
+        try:
+            chain = resolve_chain(bucket, job, job_date, key, engine, catalog)
+        except Exception as e:
+            print()
+            puts(f"{cyan(job)} {yellow(job_date)}: {e}, {red('FAILED')}")
+            failed.append(job)
+            continue
+        backups += [(job, chain_date, meta, backup_content) for chain_date, meta, backup_content in chain]
+    puts(green("DONE"))
+
+    mode = "objects" if quick else "entries"
+    puts(f"Verifying {cyan(str(len(backups)))} backups in AWS S3 bucket {yellow(bucket)}"
+         f"{' (objects only)' if quick else ''}")
+
+    lock = threading.Lock()
+
+    def verify(backup):
+        job, backup_date, meta, backup_content = backup
+        problems, checked = verify_backup(bucket, job, backup_date, meta, backup_content, engine, quick,
+                                          volume_concurrency)
+        # Backups finish in any order, keep the lines of one together
+        with lock:
+            puts(f"{cyan(job)} {yellow(backup_date)}: {checked} {mode} checked, "
+                 f"{red('FAILED') if problems else green('OK')}")
+            for problem in problems:
+                puts(f"  {problem}")
+        return problems
+
+    with ThreadPoolExecutor(max_workers=job_concurrency) as executor:
+        failed += [backup[0] for backup, problems in zip(backups, executor.map(verify, backups)) if problems]
+
+    if failed:
+        raise RuntimeError(f"Verification failed for {', '.join(dict.fromkeys(failed))}")
+    puts(green(f"All {len(backups)} backups verified"))
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import threading
+from collections import deque
+from checkpoint import ResumeError
+from tarstream import BLOCK, READ_SIZE, TarIndexer
+
+# Appended to every volume but the last so each volume is a complete tar archive on its own
+END_OF_ARCHIVE = bytes(2 * BLOCK)
+
+
+def volume_name(jobname, index, suffix):
+    # suffix is the extension of a single archive, e.g. ".tar.zstd.aes"
+    return f"{jobname}.vol{index:05}{suffix}"
+
+
+def volume_salt(salt, index):
+    # Volumes share the passphrase, each needs its own salt or their keystreams would repeat
+    if not salt:
+        return None
+    return hashlib.sha256(bytes.fromhex(salt) + index.to_bytes(4, "big")).hexdigest()[:len(salt)]
+
+
+class VolumeCutter(TarIndexer):
+    # Finds the member boundaries at which a volume that reached its size is closed
+    def __init__(self, volume_size):
+        super(VolumeCutter, self).__init__()
+        self.volume_size = volume_size
+        self.volume = 0
+        self.volume_start = 0
+        self.last_member_volume = -1
+        self.cuts = []
+        # Volume of every file, hard links to a file in another volume are recreated after all volumes are extracted
+        self.file_volumes = dict()
+        self.links = []
+
+    def on_header(self, header):
+        self.last_member_volume = self.volume
+        if header["type"] == "1":
+            target = os.fsdecode(header["link"]).rstrip("/")
+            if self.file_volumes.get(target, self.volume) != self.volume:
+                self.links.append([header["path"], target, self.volume])
+        elif header["type"] in "07\0":
+            self.file_volumes[header["path"]] = self.volume
+
+    def on_end(self):
+        if self.offset - self.volume_start >= self.volume_size:
+            self.cuts.append(self.offset)
+            self.volume_start = self.offset
+            self.volume += 1
+
+
+class VolumeSource:
+    # First stage of the upload pipeline of a volume, written to by the VolumeWriter
+    def __init__(self):
+        self.args = ["volume"]
+        self.returncode = 0
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "rb")
+        self.output = os.fdopen(w, "wb")
+
+    def wait(self):
+        return self.returncode
+
+
+class VolumeWriter(threading.Thread):
+    # Last stage of a pipeline, cuts the tar stream into volumes at member boundaries and streams every volume
+    # through its own pipeline from open_volume(index, source). At most concurrency volumes are in flight.
+    def __init__(self, volume_size, concurrency, open_volume, wait_volume, input):
+        super(VolumeWriter, self).__init__(daemon=True)
+        self.cutter = VolumeCutter(volume_size)
+        self.concurrency = concurrency
+        self.open_volume = open_volume
+        self.wait_volume = wait_volume
+        self.args = ["volumes"]
+        self.stdout = None
+        self.returncode = None
+        self.error = None
+        self.sizes = []
+
+        self.current = None
+        self.written = 0
+        # Bytes after a cut that do not belong to a member yet, the end of archive marker if no member follows
+        self.held = bytearray()
+        self.pending = deque()
+
+        # The pipeline closes its copy of the previous stage's stdout, keep our own
+        self.input = os.fdopen(os.dup(input.fileno()), "rb")
+
+    def run(self):
+        try:
+            self.split()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self.input.close()
+            if self.current:
+                self.current[0].output.close()
+                self.pending.append(self.current[1])
+            # Wait for the volumes in flight even after a failure, their stages must not outlive the backup
+            while self.pending:
+                try:
+                    self.wait_volume(self.pending.popleft())
+                except Exception as e:
+                    if not self.error:
+                        self.error = e
+                        self.returncode = 1
+
+    def wait(self):
+        self.join()
+        if self.error:
+            error = ResumeError if isinstance(self.error, ResumeError) else RuntimeError
+            raise error(f"Writing volumes failed: {self.error}")
+        return self.returncode
+
+    def split(self):
+        while True:
+            data = self.input.read(READ_SIZE)
+            if not data:
+                break
+            start = self.cutter.offset
+            first_cut = len(self.cutter.cuts)
+            self.cutter.feed(data)
+
+            pos = 0
+            for cut in self.cutter.cuts[first_cut:]:
+                self.write(data[pos:cut - start])
+                self.close_volume()
+                pos = cut - start
+            self.write(data[pos:])
+
+        if not self.sizes and not self.current:
+            # An archive without members still gets a volume
+            self.start_volume()
+        if self.current:
+            # The last volume already ends with the end of archive marker of the stream
+            self.close_volume(terminate=False)
+
+    def start_volume(self):
+        source = VolumeSource()
+        pipeline = self.open_volume(len(self.sizes), source)
+        self.current = (source, pipeline)
+        self.written = 0
+        self.write(bytes(self.held))
+        self.held = bytearray()
+
+    def write(self, data):
+        if not self.current and self.cutter.last_member_volume < len(self.sizes):
+            self.held += data
+            return
+        if not self.current:
+            self.start_volume()
+        self.current[0].output.write(data)
+        self.written += len(data)
+
+    def close_volume(self, terminate=True):
+        if not self.current:
+            return
+        source, pipeline = self.current
+        if terminate:
+            source.output.write(END_OF_ARCHIVE)
+        source.output.close()
+        self.sizes.append(self.written)
+        self.current = None
+
+        self.pending.append(pipeline)
+        while len(self.pending) >= self.concurrency:
+            self.wait_volume(self.pending.popleft())
+
+    def manifest(self, names):
+        return {
+            "version": 1,
+            "volume_size": self.cutter.volume_size,
+            "volumes": [{"name": name, "size": size} for name, size in zip(names, self.sizes)],
+            "links": self.cutter.links,
+        }
+
+
+def get_volume_pipe(volume_size, concurrency, open_volume, wait_volume, input):
+    writer = VolumeWriter(volume_size, concurrency, open_volume, wait_volume, input)
+    writer.start()
+    return writer